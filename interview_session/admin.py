@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import InterviewSession, Explanation, Question, Answer, SessionTimeoutTimer
+from .models import InterviewSession, Explanation, Question, Answer, SessionTimeoutTimer, TurnTrace, ExplanationSegment
 
 
 @admin.register(InterviewSession)
@@ -34,3 +34,16 @@ class AnswerAdmin(admin.ModelAdmin):
 class SessionTimeoutTimerAdmin(admin.ModelAdmin):
     list_display = ['id', 'session', 'question', 'timeout_seconds', 'is_active']
     list_filter = ['is_active']
+
+
+@admin.register(TurnTrace)
+class TurnTraceAdmin(admin.ModelAdmin):
+    list_display = ['id', 'session', 'turn_index', 'result_status', 'total_ms', 'llm_calls', 'created_at']
+    list_filter = ['result_status', 'created_at']
+    readonly_fields = ['created_at']
+
+
+@admin.register(ExplanationSegment)
+class ExplanationSegmentAdmin(admin.ModelAdmin):
+    list_display = ['id', 'session', 'index', 'created_at']
+    readonly_fields = ['created_at']
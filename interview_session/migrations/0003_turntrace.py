@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0007_documentchunk_chunk_index'),
+        ('interview_session', '0002_alter_question_node_alter_question_question_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TurnTrace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('turn_index', models.IntegerField(verbose_name='ターン番号')),
+                ('result_status', models.CharField(blank=True, max_length=30, verbose_name='結果')),
+                ('total_ms', models.FloatField(verbose_name='合計時間[ms]')),
+                ('phase_durations', models.JSONField(default=dict, verbose_name='フェーズ別時間[ms]')),
+                ('spans', models.JSONField(default=list, verbose_name='スパン')),
+                ('llm_calls', models.IntegerField(default=0, verbose_name='LLM呼び出し回数')),
+                ('prompt_tokens', models.IntegerField(default=0, verbose_name='入力トークン数')),
+                ('completion_tokens', models.IntegerField(default=0, verbose_name='出力トークン数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('node', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='knowledge_tree.knowledgenode', verbose_name='次のノード')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='turn_traces', to='interview_session.interviewsession', verbose_name='セッション')),
+            ],
+            options={
+                'verbose_name': 'ターントレース',
+                'verbose_name_plural': 'ターントレース',
+                'ordering': ['session', 'turn_index'],
+            },
+        ),
+    ]
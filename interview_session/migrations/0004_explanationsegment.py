@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interview_session', '0003_turntrace'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExplanationSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField(verbose_name='区間番号')),
+                ('content', models.TextField(verbose_name='文字起こし')),
+                ('embedding', models.BinaryField(blank=True, null=True, verbose_name='埋め込み')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='explanation_segments', to='interview_session.interviewsession', verbose_name='セッション')),
+            ],
+            options={
+                'verbose_name': '説明の区間',
+                'verbose_name_plural': '説明の区間',
+                'ordering': ['session', 'index'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interview_session', '0004_explanationsegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='turntrace',
+            name='error',
+            field=models.TextField(blank=True, verbose_name='エラー'),
+        ),
+    ]
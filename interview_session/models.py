@@ -140,3 +140,55 @@ class SessionTimeoutTimer(models.Model):
     
     def __str__(self):
         return f"Timer for {self.session} ({self.timeout_seconds}s)"
+
+
+class TurnTrace(models.Model):
+    """インタビュー 1 ターン（interview_next_step 1 回）の処理時間の内訳"""
+    session = models.ForeignKey(
+        InterviewSession, on_delete=models.CASCADE,
+        related_name='turn_traces', verbose_name="セッション"
+    )
+    turn_index = models.IntegerField(verbose_name="ターン番号")
+    node = models.ForeignKey(
+        KnowledgeNode, on_delete=models.SET_NULL, null=True, blank=True,
+        verbose_name="次のノード"
+    )
+    result_status = models.CharField(max_length=30, blank=True, verbose_name="結果")
+    error = models.TextField(blank=True, verbose_name="エラー")  # 例外で終わったターンの例外の種類とメッセージ
+    total_ms = models.FloatField(verbose_name="合計時間[ms]")
+    phase_durations = models.JSONField(default=dict, verbose_name="フェーズ別時間[ms]")
+    spans = models.JSONField(default=list, verbose_name="スパン")
+    llm_calls = models.IntegerField(default=0, verbose_name="LLM呼び出し回数")
+    prompt_tokens = models.IntegerField(default=0, verbose_name="入力トークン数")
+    completion_tokens = models.IntegerField(default=0, verbose_name="出力トークン数")
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "ターントレース"
+        verbose_name_plural = "ターントレース"
+        ordering = ['session', 'turn_index']
+
+    def __str__(self):
+        return f"Trace {self.session_id}#{self.turn_index} ({self.total_ms:.0f}ms)"
+
+
+class ExplanationSegment(models.Model):
+    """説明フェーズの文字起こしの確定区間（発話の途中からバックグラウンドで解析する）"""
+    session = models.ForeignKey(
+        InterviewSession, on_delete=models.CASCADE,
+        related_name='explanation_segments', verbose_name="セッション"
+    )
+    index = models.IntegerField(verbose_name="区間番号")
+    content = models.TextField(verbose_name="文字起こし")
+    embedding = models.BinaryField(null=True, blank=True, verbose_name="埋め込み")  # 正規化した float16 ベクトル（KnowledgeNode.embedding と同じ形式）
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "説明の区間"
+        verbose_name_plural = "説明の区間"
+        ordering = ['session', 'index']
+
+    def __str__(self):
+        return f"Segment {self.session_id}#{self.index}: {self.content[:30]}"
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import InterviewSession, Explanation, Question, Answer, SessionTimeoutTimer
+from .models import InterviewSession, Explanation, Question, Answer, SessionTimeoutTimer, TurnTrace
 from knowledge_tree.serializers import KnowledgeNodeSerializer
 
 
@@ -55,3 +55,13 @@ class SessionTimeoutTimerSerializer(serializers.ModelSerializer):
             'id', 'session', 'question', 'start_time', 'timeout_seconds',
             'is_active'
         ]
+
+
+class TurnTraceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TurnTrace
+        fields = [
+            'id', 'session', 'turn_index', 'node', 'result_status', 'error', 'total_ms',
+            'phase_durations', 'spans', 'llm_calls', 'prompt_tokens',
+            'completion_tokens', 'created_at'
+        ]
@@ -3,12 +3,14 @@ import base64
 import wave
 import json
 import asyncio
-import websockets
-from openai import OpenAI
 from django.conf import settings
 from django.core.files.base import ContentFile
-from sentence_transformers import SentenceTransformer
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from llm_gateway.routing import json_validator
 from knowledge_tree.models import KnowledgeNode, DocumentChunk
+from knowledge_tree.node_index import NodeEmbeddingIndex, embed_texts
+from knowledge_tree.coverage import split_segments
 from .models import Explanation
 
 
@@ -23,6 +25,7 @@ class AudioProcessor:
     # 音声処理クラス - 現在未使用
     
     def __init__(self):
+        from openai import OpenAI
         self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
         self.audio_buffer = []
         self.is_speaking = False
@@ -78,8 +81,8 @@ class ExplanationAnalyzer:
     """説明分析クラス"""
     
     def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.llm = LLMClient()
+        self.config = settings.TOPIC_DETECTION
     
     def analyze_explanation(self, explanation_text, material):
         """説明を分析してトピックを抽出"""
@@ -87,67 +90,85 @@ class ExplanationAnalyzer:
             print(f"Analyzing explanation for material: {material.id}")
             
             # 当該教材の知識ツリーのノードを取得
-            if not material.root_node:
+            if not material.root_node or not explanation_text:
                 return []
             
-            # ルートノードの子孫ノードのみを取得（ルート自体は除外）
-            nodes = material.root_node.get_descendants().values_list(
-                'id', 'title', 'description'
-            )
-            
-            # ノード情報を文字列に変換
-            node_info = "\n".join([
-                f"ID: {node[0]}, タイトル: {node[1]}, 説明: {node[2]}"
-                for node in nodes
-            ])
-            
-            # LLMでトピック抽出
-            prompt = f"""
-            以下の学習者の説明から、言及されているトピックを特定してください。
-            
-            学習者の説明:
-            {explanation_text}
-            
-            利用可能なトピック:
-            {node_info}
-            
-            言及されているトピックのIDをJSON配列で返してください。
-            例: [1, 3, 5]
-            """
-            
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "あなたは学習内容の分析専門家です。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1
+            # 説明の区間ごとの埋め込みとノードの埋め込みの類似度で候補を絞る（ルート自体は除外）
+            index = NodeEmbeddingIndex.for_root(material.root_node, self.llm)
+            if not index.complete: # 埋め込みのないノードがある教材（埋め込みを保存する前に生成したツリーなど）は LLM で全ノードから探す
+                print(f"[topics] material {material.id}: ノードの埋め込みがそろっていないため LLM でトピックを抽出します")
+                nodes = list(material.root_node.get_descendants())
+                topic_ids = set(self._confirm_topics(explanation_text, [(node, None) for node in nodes])) if nodes else set()
+                return [
+                    {'id': node.id, 'title': node.title, 'description': node.description, 'similarity': None}
+                    for node in nodes if node.id in topic_ids
+                ]
+            segments = split_segments(explanation_text, settings.COVERAGE_PREPASS.get('SEGMENT_CHARS', 200))
+            if not segments:
+                return []
+            node_ids = [node_id for node_id in index.node_ids.tolist() if node_id != material.root_node.id]
+            candidates = index.best_matches(
+                embed_texts(segments, llm=self.llm), node_ids,
+                self.config.get('MIN_SIMILARITY', 0.4), self.config.get('MAX_TOPICS', 15)
             )
-            
-            # 結果を解析
-            import json
-            topic_ids = json.loads(response.choices[0].message.content)
-            
-            # トピック情報を取得
-            topics = []
-            for topic_id in topic_ids:
-                try:
-                    node = KnowledgeNode.objects.get(id=topic_id)
-                    topics.append({
-                        'id': node.id,
-                        'title': node.title,
-                        'description': node.description,
-                        'understanding_score': node.understanding_score
-                    })
-                except KnowledgeNode.DoesNotExist:
-                    continue
-            
-            return topics
+            print(f"[topics] 候補 {len(candidates)} ノード: {[(node.title, round(score, 2)) for node, score in candidates]}")
+            
+            # 候補だけを LLM で確認する
+            if candidates and self.config.get('CONFIRM', True):
+                topic_ids = set(self._confirm_topics(explanation_text, candidates))
+                candidates = [(node, score) for node, score in candidates if node.id in topic_ids]
+            
+            return [
+                {
+                    'id': node.id,
+                    'title': node.title,
+                    'description': node.description,
+                    'similarity': round(score, 3)
+                }
+                for node, score in candidates
+            ]
             
         except Exception as e:
             print(f"Explanation analysis error: {e}")
             return []
     
+    def _confirm_topics(self, explanation_text, candidates):
+        """候補 [(ノード, 類似度)] のうち、説明で実際に言及されているトピックの ID を返す（埋め込みがなければ全ノードが候補）"""
+        sections = PromptBuilder('detect_topics').section(
+            'topics', [f"ID: {node.id}, タイトル: {node.title}, 説明: {node.brief('gist')}" for node, _ in candidates]
+        ).section('explanation', explanation_text, priority=1).build()
+        
+        prompt = f"""
+        以下の学習者の説明から、言及されているトピックを特定してください。
+        
+        学習者の説明:
+        {sections['explanation']}
+        
+        候補のトピック:
+        {sections['topics']}
+        
+        言及されているトピックのIDをJSONで返してください。
+        例: {{"topic_ids": [1, 3, 5]}}
+        """
+        
+        response = self.llm.chat(
+            'detect_topics',
+            messages=[
+                {"role": "system", "content": "あなたは学習内容の分析専門家です。"},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.1,
+            validator=json_validator('topic_ids')
+        )
+        
+        candidate_ids = {node.id for node, _ in candidates}
+        try:
+            return [int(topic_id) for topic_id in json.loads(response).get('topic_ids', []) if int(topic_id) in candidate_ids]
+        except (TypeError, ValueError) as e:
+            print(f"Topic confirmation parse error: {e}")
+            return []
+    
     def create_explanation_record(self, session, content, topics, audio_file=None):
         """説明レコードを作成"""
         explanation = Explanation.objects.create(
@@ -156,13 +177,12 @@ class ExplanationAnalyzer:
             audio_file=audio_file
         )
         
-        # トピックを関連付け
-        for topic_data in topics:
-            try:
-                node = KnowledgeNode.objects.get(id=topic_data['id'])
-                explanation.topics_mentioned.add(node)
-            except KnowledgeNode.DoesNotExist:
-                continue
+        # トピックの関連付けはまとめて 1 回で挿入する
+        Through = Explanation.topics_mentioned.through
+        Through.objects.bulk_create(
+            [Through(explanation_id=explanation.id, knowledgenode_id=topic_data['id']) for topic_data in topics],
+            ignore_conflicts=True
+        )
         
         return explanation
 
@@ -1,12 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import InterviewSessionViewSet, ExplanationViewSet, QuestionViewSet, AnswerViewSet
+from .views import InterviewSessionViewSet, ExplanationViewSet, QuestionViewSet, AnswerViewSet, TurnTraceViewSet
 
 router = DefaultRouter()
 router.register(r'sessions', InterviewSessionViewSet)
 router.register(r'explanations', ExplanationViewSet)
 router.register(r'questions', QuestionViewSet)
 router.register(r'answers', AnswerViewSet)
+router.register(r'turn-traces', TurnTraceViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
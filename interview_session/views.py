@@ -7,20 +7,24 @@ from rest_framework.decorators import api_view
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.contrib.auth.models import User
 from knowledge_tree.models import LearningMaterial
-from .models import InterviewSession, Explanation, Question, Answer
+from .models import InterviewSession, Explanation, Question, Answer, TurnTrace, ExplanationSegment
 from .serializers import (
     InterviewSessionSerializer, ExplanationSerializer,
-    QuestionSerializer, AnswerSerializer
+    QuestionSerializer, AnswerSerializer, TurnTraceSerializer
 )
 from .services import ExplanationAnalyzer, SessionManager
 from .serializers import QuestionSerializer
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from llm_gateway.tracing import percentile
+from knowledge_tree.services import analyze_explanation_segment_task, warm_explanation_task
 
-import os, requests
-import openai
+import os
 from django.http import JsonResponse
 from django.views.decorators.http import require_GET
 from django.views.decorators.csrf import csrf_exempt
@@ -29,6 +33,8 @@ from django.conf import settings
 from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_502_BAD_GATEWAY
 import sys
 import json
+from datetime import timedelta
+from django.utils import timezone
 
 
 OPENAI_API_KEY = settings.OPENAI_API_KEY
@@ -47,6 +53,13 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
         # 認証されたユーザーでセッションを作成
         serializer.save(user=self.request.user)
 
+    @action(detail=True, methods=['get'])
+    def traces(self, request, pk=None):
+        """セッションの各ターンの処理時間の内訳を取得"""
+        session = self.get_object()
+        serializer = TurnTraceSerializer(session.turn_traces.all(), many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=["get"], url_path="realtime/session")
     def create_realtime_session(self, request, pk=None):
         """
@@ -57,6 +70,7 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
         # session = self.get_object()
         # if session.owner != request.user: return Response(status=403)
 
+        import requests # このアクションでしか使わないので、使うときに読み込む
         try:
             url = "https://api.openai.com/v1/realtime/transcription_sessions"
             headers = {
@@ -102,6 +116,35 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
             'session': self.get_serializer(session).data
         })
     
+    @action(detail=True, methods=['post'])
+    def explanation_segments(self, request, pk=None):
+        """説明フェーズで確定した文字起こしの区間を受け取り、バックグラウンドで解析する"""
+        session = self.get_object()
+        content = request.data.get('content', '').strip()
+
+        if session.status != 'explaining':
+            return Response(
+                {'error': '説明の区間を受け付けるのは説明フェーズ中のみです。'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not content:
+            return Response(
+                {'error': '文字起こしが指定されていません。'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        with transaction.atomic():
+            # 区間が同時に届いても index が重ならないよう、セッションの行をロックしてから数える
+            InterviewSession.objects.select_for_update().get(pk=session.pk)
+            segment = ExplanationSegment.objects.create(
+                session=session,
+                index=session.explanation_segments.count(),
+                content=content
+            )
+        # 新しい区間が続けて届く間は先読みを待つ（最後の区間のタスクだけが説明全体を解析する）
+        analyze_explanation_segment_task.apply_async((segment.id,), countdown=settings.EXPLANATION_WARMUP.get('DEBOUNCE_SECONDS', 3))
+        return Response({'segment_id': segment.id, 'index': segment.index}, status=status.HTTP_202_ACCEPTED)
+
     @action(detail=True, methods=['post'])
     def start_questioning_phase(self, request, pk=None):
         """質問フェーズを開始"""
@@ -179,7 +222,7 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
             
-            client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+            llm = LLMClient()
             
             # 校正タイプに応じてプロンプトを調整
             if correction_type == 'explanation':
@@ -194,8 +237,8 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
                 system_prompt = """あなたは文章校正の専門家です。以下のテキストを文法的に正しく、より読みやすい文章に校正してください。元の意味は保持してください。"""
            
             print("[DEBUG] OK3", file=sys.stderr)
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = llm.chat(
+                'correct_text',
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": f"以下のテキストを校正してください：\n\n{text}"}
@@ -205,7 +248,9 @@ class InterviewSessionViewSet(viewsets.ModelViewSet):
             )
             
             print("[DEBUG] OK2", file=sys.stderr)
-            corrected_text = response.choices[0].message.content.strip()
+            corrected_text = response.strip()
+            if correction_type == 'explanation' and session.status == 'explaining':
+                warm_explanation_task.delay(session.id, corrected_text) # 校正後の説明文で質問フェーズに進む場合に備えて先読みする
             return Response({
                 'success': True,
                 'corrected_text': corrected_text,
@@ -296,6 +341,36 @@ class QuestionViewSet(viewsets.ReadOnlyModelViewSet):
         )
 
 
+class TurnTraceViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = TurnTrace.objects.all()
+    serializer_class = TurnTraceSerializer
+    permission_classes = [IsAdminUser]
+
+    @action(detail=False, methods=['get'])
+    def phase_stats(self, request):
+        """フェーズごとの p50 / p95 [ms] を日別に集計（?days=7）"""
+        try:
+            days = int(request.query_params.get('days', 7))
+        except ValueError:
+            return Response({'error': 'days は整数で指定してください。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        since = timezone.now() - timedelta(days=days)
+        samples = {} # 日付 -> フェーズ名 -> 所要時間のリスト
+        for created_at, total_ms, phase_durations in TurnTrace.objects.filter(created_at__gte=since).values_list('created_at', 'total_ms', 'phase_durations'):
+            day = samples.setdefault(timezone.localdate(created_at).isoformat(), {})
+            day.setdefault('total', []).append(total_ms)
+            for phase, duration_ms in phase_durations.items():
+                day.setdefault(phase, []).append(duration_ms)
+
+        return Response({
+            date: {
+                phase: {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95)}
+                for phase, values in phases.items()
+            }
+            for date, phases in sorted(samples.items())
+        })
+
+
 class AnswerViewSet(viewsets.ModelViewSet):
     queryset = Answer.objects.all()
     serializer_class = AnswerSerializer
@@ -382,7 +457,7 @@ class AnswerViewSet(viewsets.ModelViewSet):
             import openai
             from django.conf import settings
             
-            client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+            llm = LLMClient()
             
             # 説明文を取得
             explanation = Explanation.objects.filter(session=session).first()
@@ -393,7 +468,13 @@ class AnswerViewSet(viewsets.ModelViewSet):
                 if hasattr(q, 'answer'):
                     qa_history.append(f"質問: {q.content}\n回答: {q.answer.content}")
             
-            history_text = "\n\n".join(qa_history) if qa_history else "なし"
+            # 説明文・履歴・前回の回答を予算内に収める（履歴は直近を優先）
+            sections = PromptBuilder('follow_up_question').section(
+                'explanation', explanation.content if explanation else "", priority=1
+            ).section('history', qa_history, keep='tail', separator="\n\n").section(
+                'answer', previous_answer.content, priority=2
+            ).build()
+            history_text = sections['history'] or "なし"
             
             system_prompt = """あなたは教育的なAI面接官です。学習者の説明と前回の回答を受けて、さらに理解を深めるための質問を行います。
 
@@ -405,17 +486,17 @@ class AnswerViewSet(viewsets.ModelViewSet):
 5. 日本語で出力してください
 6. 前回と同じような質問は避けてください"""
 
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = llm.chat(
+                'follow_up_question',
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": f"""学習者の説明：
-{explanation.content if explanation else "なし"}
+{sections['explanation'] or "なし"}
 
 これまでの質問と回答の履歴：
 {history_text}
 
-前回の回答：{previous_answer.content}
+前回の回答：{sections['answer']}
 
 上記を踏まえて、理解をさらに深めるための次の質問を1つ生成してください。"""}
                 ],
@@ -423,7 +504,7 @@ class AnswerViewSet(viewsets.ModelViewSet):
                 temperature=0.7
             )
             
-            question_content = response.choices[0].message.content.strip()
+            question_content = response.strip()
             
             # 質問をデータベースに保存
             question = Question.objects.create(
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import LearningMaterial, KnowledgeNode, DocumentChunk
+from .models import LearningMaterial, KnowledgeNode, DocumentChunk, PooledQuestion
 
 
 @admin.register(LearningMaterial)
@@ -19,6 +19,13 @@ class KnowledgeNodeAdmin(admin.ModelAdmin):
 
 @admin.register(DocumentChunk)
 class DocumentChunkAdmin(admin.ModelAdmin):
-    list_display = ['id', 'learning_material', 'learning_material_id', 'page_number', 'chunk_index', 'created_at']
+    list_display = ['id', 'learning_material', 'learning_material_id', 'page_number', 'page_number_end', 'chunk_index', 'created_at']
     list_filter = ['page_number', 'created_at']
     readonly_fields = ['created_at']
+
+
+@admin.register(PooledQuestion)
+class PooledQuestionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'node', 'socratic_stage', 'is_remedial', 'created_at']
+    list_filter = ['socratic_stage', 'is_remedial', 'created_at']
+    readonly_fields = ['created_at']
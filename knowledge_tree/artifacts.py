@@ -0,0 +1,47 @@
+import shutil
+from pathlib import Path
+from django.conf import settings
+
+
+class ArtifactStore:
+    """教材処理の途中データ（ページ画像・ページの分析結果など）を置くローカルのディレクトリ
+
+    Celery のメッセージと結果バックエンドには教材 ID・ページ番号だけを流し、大きなデータはここに置く。
+    PIPELINE_ARTIFACT_ROOT は Web プロセスと全ワーカーから同じパスで見える場所にする。
+    """
+
+    def __init__(self, material_id):
+        self.material_id = material_id
+        self.root = Path(settings.PIPELINE_ARTIFACT_ROOT) / str(material_id)
+
+    def path(self, stage, name):
+        return self.root / stage / name
+
+    def save(self, stage, name, data):
+        """data（bytes または str）を保存してパスを返す（途中まで書いたファイルを読まれないよう、書き終えてから置き換える）"""
+        path = self.path(stage, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        if isinstance(data, str):
+            tmp.write_text(data, encoding='utf-8')
+        else:
+            tmp.write_bytes(data)
+        tmp.replace(path)
+        return path
+
+    def load_bytes(self, stage, name):
+        return self.path(stage, name).read_bytes()
+
+    def load_text(self, stage, name):
+        return self.path(stage, name).read_text(encoding='utf-8')
+
+    def exists(self, stage, name):
+        return self.path(stage, name).exists()
+
+    def cleanup(self):
+        """教材の途中データをすべて削除する（ツリー生成が終わったら不要）"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def page_name(page_number, suffix):
+    return f"page-{page_number:04d}.{suffix}"
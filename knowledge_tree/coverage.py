@@ -0,0 +1,92 @@
+import re
+import sys
+import json
+from django.conf import settings
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from llm_gateway.routing import json_validator
+from .node_index import NodeEmbeddingIndex, embed_texts
+
+
+def split_segments(text, max_chars=200):
+    """文（。！？・改行）単位で区切り、max_chars 程度ずつにまとめる"""
+    sentences = [s.strip() for s in re.split(r'(?<=[。．！？!?])|\n', text or '') if s and s.strip()]
+    segments, current = [], ""
+    for sentence in sentences:
+        if current and len(current) + len(sentence) > max_chars:
+            segments.append(current)
+            current = ""
+        current += sentence
+    if current:
+        segments.append(current)
+    return segments
+
+
+class ExplanationCoverage:
+    """学習者の説明で既に説明された葉ノードを、埋め込みの類似度で候補に絞り、1 回の LLM 呼び出しで確認する"""
+
+    def __init__(self, root, llm=None):
+        self.root = root
+        self.llm = llm or LLMClient()
+        self.config = settings.COVERAGE_PREPASS
+        self.index = NodeEmbeddingIndex.for_root(root, self.llm)
+
+    def candidates(self, explanation, node_ids, segment_vectors=None):
+        """説明のいずれかの区切りと類似度が高い葉ノード [(ノード, 類似度)]（高い順）"""
+        leaf_ids = [node_id for node_id in node_ids if node_id in self.index.nodes and node_id != self.root.id and not self.index.children.get(node_id)]
+        if not leaf_ids:
+            return []
+        if segment_vectors is None:
+            segments = split_segments(explanation, self.config.get('SEGMENT_CHARS', 200))
+            if not segments:
+                return []
+            segment_vectors = embed_texts(segments, llm=self.llm)
+        return self.index.best_matches(
+            segment_vectors, leaf_ids, self.config.get('MIN_SIMILARITY', 0.45), self.config.get('MAX_CANDIDATES', 20)
+        )
+
+    def confirm(self, explanation, candidates):
+        """候補のうち、説明で十分に述べられているノードの ID を 1 回の呼び出しでまとめて確認する"""
+        if not candidates:
+            return []
+        sections = PromptBuilder('confirm_coverage').section(
+            'topics', [f"- ID {node.id}: {node.title} / {node.brief('summary')}" for node, _ in candidates], priority=1
+        ).section('explanation', explanation).build()
+        prompt = f"""
+        あなたは {self.root.title} の専門家です。学習者の説明に基づき、以下のトピックのうち、その内容がすでに十分に説明されているものの ID を列挙してください。
+
+        ■ 学習者の説明:
+        {sections['explanation']}
+
+        ■ トピック:
+        {sections['topics']}
+
+        ■ 要件:
+        - トピック名に触れただけでなく、その説明の要点を学習者が自分の言葉で述べている場合だけ含めてください。
+        - 少しでも疑わしい場合は含めないでください。
+
+        ■ 出力形式 (JSON):
+        {{"covered_ids": [10, 15, ...]}}
+        """
+        response = self.llm.chat(
+            'confirm_coverage',
+            messages=[
+                {"role": "system", "content": "あなたは学習者の説明を分析し、十分に説明済みのトピックIDのみをJSON配列で返します。"},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.0,
+            validator=json_validator('covered_ids')
+        )
+        candidate_ids = {node.id for node, _ in candidates}
+        try:
+            return [int(node_id) for node_id in json.loads(response).get('covered_ids', []) if int(node_id) in candidate_ids]
+        except (TypeError, ValueError) as e:
+            print(f"[coverage] parse error: {e}", file=sys.stderr)
+            return []
+
+    def covered_leaves(self, explanation, node_ids, segment_vectors=None):
+        """説明済みと判断した葉ノードの ID のリスト（segment_vectors: 説明の区間ごとの埋め込みが既にあれば使い回す）"""
+        candidates = self.candidates(explanation, node_ids, segment_vectors)
+        print(f"[coverage] 候補 {len(candidates)} ノード: {[(node.title, round(score, 2)) for node, score in candidates]}", file=sys.stderr)
+        return self.confirm(explanation, candidates)
@@ -0,0 +1,130 @@
+import re
+from django.conf import settings
+
+
+def _expand(rect, margin):
+    return (rect[0] - margin, rect[1] - margin, rect[2] + margin, rect[3] + margin)
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _area(rect):
+    return max(0.0, rect[2] - rect[0]) * max(0.0, rect[3] - rect[1])
+
+
+def _contains_center(outer, inner):
+    x, y = (inner[0] + inner[2]) / 2, (inner[1] + inner[3]) / 2
+    return outer[0] <= x <= outer[2] and outer[1] <= y <= outer[3]
+
+
+def merge_regions(rects, margin):
+    """margin 以内に近づいている矩形をまとめる（1 つの図を構成する線・画像・図形を 1 つの領域にする）
+
+    まとめた結果の外接矩形が別の領域に近づくことがあるので、領域の数が減らなくなるまで繰り返す。
+    """
+    regions = [tuple(rect) for rect in rects]
+    while True:
+        merged = _merge_once(regions, margin)
+        if len(merged) == len(regions):
+            return merged
+        regions = merged
+
+
+def _merge_once(regions, margin):
+    """左端の座標順に走査し、x 方向に重なり得る領域同士だけを比べて union-find でまとめる"""
+    parent = list(range(len(regions)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    active = []  # 今見ている領域の左端より右まで伸びている領域
+    for i in sorted(range(len(regions)), key=lambda i: regions[i][0]):
+        expanded = _expand(regions[i], margin)
+        active = [j for j in active if regions[j][2] > expanded[0]]
+        for j in active:
+            if _intersects(expanded, regions[j]):
+                parent[find(j)] = find(i)
+        active.append(i)
+
+    groups = {}
+    for i, rect in enumerate(regions):
+        root = find(i)
+        groups[root] = _union(groups[root], rect) if root in groups else rect
+    return list(groups.values())
+
+
+def extract_layout(page):
+    """PyMuPDF のテキストブロック・画像ブロック・描画の位置から、ページを読み順のテキストと図の領域に分ける
+
+    戻り値: {'mode': 'layout' | 'full', 'items': [{'type': 'text', 'bbox', 'text'} | {'type': 'figure', 'bbox'}, ...]}
+    テキスト層がほとんどないページ（スキャン画像など）、図がページの大半を占めるページ、
+    描画の数が PAGE_LAYOUT['MAX_DRAWINGS'] を超えるページは 'full'（ページ全体を画像で分析する）。
+    """
+    config = settings.PAGE_LAYOUT
+    page_rect = tuple(page.rect)
+    page_area = _area(page_rect)
+    math_fonts = re.compile(config.get('MATH_FONT_PATTERN', r'CMMI|CMSY|CMEX|Math|Symbol'), re.IGNORECASE)
+
+    texts, figure_rects = [], []
+    for block in page.get_text('dict')['blocks']:
+        if block.get('type') == 1: # 画像ブロック
+            figure_rects.append(tuple(block['bbox']))
+            continue
+        spans = [span for line in block.get('lines', []) for span in line.get('spans', []) if span.get('text', '').strip()]
+        if not spans:
+            continue
+        # 数式用フォントが大半のブロックは、テキスト層では記号の配置が崩れるので図と同じく画像で読む
+        if sum(1 for span in spans if math_fonts.search(span.get('font', ''))) >= len(spans) * 0.5:
+            figure_rects.append(tuple(block['bbox']))
+            continue
+        text = '\n'.join(''.join(span['text'] for span in line.get('spans', [])) for line in block.get('lines', [])).strip()
+        texts.append({'type': 'text', 'bbox': tuple(block['bbox']), 'text': text})
+
+    drawings = page.get_drawings()
+    if len(drawings) > config.get('MAX_DRAWINGS', 500): # グラフの点・細かい図形が大量にあるページは、領域を分けずにページ全体を分析する
+        return {'mode': 'full', 'items': []}
+    for drawing in drawings:
+        rect = tuple(drawing['rect'])
+        if _area(rect) < page_area * 0.9: # ページ全体の背景・枠は除く
+            figure_rects.append(rect)
+
+    figures = [
+        region for region in merge_regions(figure_rects, config.get('MERGE_MARGIN', 8))
+        if _area(region) >= page_area * config.get('MIN_FIGURE_AREA_RATIO', 0.01) # 区切り線・小さなアイコンは除く
+    ]
+    text_chars = sum(len(item['text']) for item in texts)
+    if text_chars < config.get('MIN_TEXT_CHARS', 20) or sum(_area(region) for region in figures) > page_area * config.get('MAX_FIGURE_AREA_RATIO', 0.6):
+        return {'mode': 'full', 'items': []}
+
+    # 図の中のラベルなどのテキストは切り出した画像に含まれるので、テキストとしては出さない
+    texts = [item for item in texts if not any(_contains_center(region, item['bbox']) for region in figures)]
+    items = texts + [{'type': 'figure', 'bbox': region} for region in figures]
+    items.sort(key=lambda item: (round(item['bbox'][1]), item['bbox'][0]))
+    for number, item in enumerate((item for item in items if item['type'] == 'figure'), start=1): # 図の番号は読み順
+        item['figure'] = number
+    return {'mode': 'layout', 'items': items}
+
+
+def render_region(page, bbox):
+    """ページの bbox の範囲だけを PAGE_RENDER['ZOOM'] の解像度で PNG にする"""
+    import fitz  # PyMuPDF（教材処理のワーカーでだけ読み込む）
+    zoom = settings.PAGE_RENDER.get('ZOOM', 2.0)
+    clip = fitz.Rect(_expand(bbox, settings.PAGE_LAYOUT.get('CROP_MARGIN', 4))) & page.rect
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip).tobytes("png")
+
+
+def merge_page_text(items, descriptions):
+    """読み順のテキストと図の説明を 1 ページ分のテキストにする（descriptions[i] は figure 番号 i + 1 の図の説明）"""
+    return '\n\n'.join(
+        item['text'] if item['type'] == 'text' else f"[図{item['figure']}] {descriptions[item['figure'] - 1]}"
+        for item in items
+    )
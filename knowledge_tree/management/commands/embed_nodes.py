@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from knowledge_tree.models import LearningMaterial
+from knowledge_tree.node_index import embed_nodes, tree_nodes
+
+
+class Command(BaseCommand):
+    help = "埋め込みのない知識ツリーのノードを埋め込む（ノードの埋め込みを保存する前に生成した教材・埋め込みに失敗した教材用）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--material', type=int, action='append', help="対象の教材 ID（省略時はツリーのあるすべての教材）")
+        parser.add_argument('--dry-run', action='store_true', help="埋め込むノード数を表示するだけで保存しない")
+
+    def handle(self, *args, **options):
+        materials = LearningMaterial.objects.filter(root_node__isnull=False).select_related('root_node').order_by('id')
+        if options['material']:
+            materials = materials.filter(id__in=options['material'])
+            missing = set(options['material']) - set(materials.values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"知識ツリーのある教材が見つかりません: {sorted(missing)}")
+
+        total = 0
+        for material in materials:
+            nodes = [node for node in tree_nodes(material.root_node) if not node.embedding]
+            if not nodes:
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"material {material.id} ({material.title}): {len(nodes)} ノード")
+            else:
+                count = embed_nodes(nodes)
+                self.stdout.write(f"material {material.id} ({material.title}): {count} ノードを埋め込みました")
+            total += len(nodes)
+        self.stdout.write(self.style.SUCCESS(f"合計 {total} ノード"))
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0007_documentchunk_chunk_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledQuestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('socratic_stage', models.IntegerField(verbose_name='ソクラテス段階')),
+                ('is_remedial', models.BooleanField(default=False, verbose_name='リメディアル質問')),
+                ('content', models.TextField(verbose_name='質問内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pooled_questions', to='knowledge_tree.knowledgenode', verbose_name='知識ノード')),
+            ],
+            options={
+                'verbose_name': '事前生成質問',
+                'verbose_name_plural': '事前生成質問',
+                'ordering': ['node', 'socratic_stage', 'is_remedial', 'id'],
+                'indexes': [models.Index(fields=['node', 'socratic_stage', 'is_remedial'], name='knowledge_t_node_id_340625_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0008_pooledquestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgenode',
+            name='rubric',
+            field=models.JSONField(blank=True, default=dict, verbose_name='採点基準'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0009_knowledgenode_rubric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgenode',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True, verbose_name='埋め込みベクトル'),
+        ),
+    ]
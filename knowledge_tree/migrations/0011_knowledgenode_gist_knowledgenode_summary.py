@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0010_knowledgenode_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgenode',
+            name='gist',
+            field=models.CharField(blank=True, max_length=100, verbose_name='一行要旨'),
+        ),
+        migrations.AddField(
+            model_name='knowledgenode',
+            name='summary',
+            field=models.TextField(blank=True, verbose_name='要約'),
+        ),
+    ]
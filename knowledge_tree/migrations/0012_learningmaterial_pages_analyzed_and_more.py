@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0011_knowledgenode_gist_knowledgenode_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='learningmaterial',
+            name='pages_analyzed',
+            field=models.IntegerField(default=0, verbose_name='分析済みページ数'),
+        ),
+        migrations.AddField(
+            model_name='learningmaterial',
+            name='pages_total',
+            field=models.IntegerField(default=0, verbose_name='総ページ数'),
+        ),
+    ]
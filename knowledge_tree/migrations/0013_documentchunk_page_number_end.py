@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_tree', '0012_learningmaterial_pages_analyzed_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='page_number_end',
+            field=models.IntegerField(blank=True, null=True, verbose_name='最終ページ番号'),
+        ),
+    ]
@@ -6,10 +6,14 @@ class KnowledgeNode(models.Model):
     """知識ツリーのノード（トピック）"""
     title = models.CharField(max_length=200, verbose_name="ノード名")
     description = models.TextField(verbose_name="説明")
+    gist = models.CharField(max_length=100, blank=True, verbose_name="一行要旨") # 多数のノードを並べるプロンプト用
+    summary = models.TextField(blank=True, verbose_name="要約") # 数ノードを比べるプロンプト用
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children', verbose_name="親ノード")
     level = models.IntegerField(default=0, verbose_name="階層レベル")
     order = models.IntegerField(default=0, verbose_name="順序")
     related_chunks = models.ManyToManyField('DocumentChunk', related_name='knowledge_nodes', blank=True, verbose_name="関連チャンク")
+    rubric = models.JSONField(default=dict, blank=True, verbose_name="採点基準") # 要点・期待される用語・要点の埋め込みベクトル
+    embedding = models.BinaryField(null=True, blank=True, verbose_name="埋め込みベクトル") # タイトル+説明の正規化済みベクトル (float16)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -44,6 +48,14 @@ class KnowledgeNode(models.Model):
             return self.__class__.objects.none() # 空
         return self.parent.children.exclude(id=self.id) # 親ノードの子ノードのうち、自分自身以外をすべて返す
 
+    # プロンプトに載せる説明（要旨・要約が未生成なら元の説明を使う）
+    def brief(self, level='summary'):
+        if level == 'gist' and self.gist:
+            return self.gist
+        if level in ('gist', 'summary') and self.summary:
+            return self.summary
+        return self.description
+
     # 再帰的に根ノードを取得する関数（現在地のノードから知識ツリーの根のタイトルを参照して LLM プロンプトの中で使う）
     def get_root(self):
         current = self
@@ -52,12 +64,32 @@ class KnowledgeNode(models.Model):
         return current
 
 
+class PooledQuestion(models.Model):
+    """教材処理時に事前生成しておく質問（ノード・ソクラテス段階ごと）"""
+    node = models.ForeignKey(KnowledgeNode, on_delete=models.CASCADE, related_name='pooled_questions', verbose_name="知識ノード")
+    socratic_stage = models.IntegerField(verbose_name="ソクラテス段階")
+    is_remedial = models.BooleanField(default=False, verbose_name="リメディアル質問")
+    content = models.TextField(verbose_name="質問内容")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "事前生成質問"
+        verbose_name_plural = "事前生成質問"
+        ordering = ['node', 'socratic_stage', 'is_remedial', 'id']
+        indexes = [models.Index(fields=['node', 'socratic_stage', 'is_remedial'])]
+
+    def __str__(self):
+        kind = "リメディアル" if self.is_remedial else "通常"
+        return f"{self.node.title} - 第{self.socratic_stage}段階（{kind}）"
+
+
 class DocumentChunk(models.Model):
     """PDFから抽出されたチャンク"""
     learning_material = models.ForeignKey('LearningMaterial', on_delete=models.CASCADE, related_name='chunks', verbose_name="学習教材")
     content = models.TextField(verbose_name="内容")
     embedding = models.JSONField(verbose_name="埋め込みベクトル")
     page_number = models.IntegerField(verbose_name="ページ番号")
+    page_number_end = models.IntegerField(null=True, blank=True, verbose_name="最終ページ番号") # アニメーションの途中経過のページをまとめて分析したときの最後のページ
     chunk_index = models.IntegerField(verbose_name="チャンクID", null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
@@ -67,7 +99,14 @@ class DocumentChunk(models.Model):
         ordering = ['-learning_material_id', 'page_number']
     
     def __str__(self):
-        return f"{self.learning_material.title} - Page {self.page_number} - Chunk {self.chunk_index}"
+        return f"{self.learning_material.title} - Page {self.page_label} - Chunk {self.chunk_index}"
+    
+    @property
+    def page_label(self):
+        """引用用のページ表記（複数ページをまとめたチャンクは "3-5"）"""
+        if self.page_number_end and self.page_number_end != self.page_number:
+            return f"{self.page_number}-{self.page_number_end}"
+        return str(self.page_number)
 
 
 class LearningMaterial(models.Model):
@@ -75,6 +114,8 @@ class LearningMaterial(models.Model):
     title = models.CharField(max_length=200, verbose_name="タイトル")
     file_path = models.FileField(upload_to='materials/', verbose_name="ファイル")
     processed = models.BooleanField(default=False, verbose_name="処理済み")
+    pages_total = models.IntegerField(default=0, verbose_name="総ページ数")
+    pages_analyzed = models.IntegerField(default=0, verbose_name="分析済みページ数") # ページごとのタスクが原子的に加算し、最後のページでツリー生成を始める
     root_node = models.OneToOneField(KnowledgeNode, on_delete=models.CASCADE, null=True, blank=True, related_name='material', verbose_name="ルートノード")
     
     created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,226 @@
+import sys
+import threading
+import numpy as np
+from django.conf import settings
+from llm_gateway.client import LLMClient
+from .models import KnowledgeNode, DocumentChunk
+
+
+def encode_vector(vector):
+    """正規化して float16 のバイト列にする（KnowledgeNode.embedding に保存する形式）"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector = vector / norm
+    return vector.astype(np.float16).tobytes()
+
+
+def decode_vector(data):
+    return np.frombuffer(bytes(data), dtype=np.float16).astype(np.float32)
+
+
+def node_text(node):
+    return f"{node.title}: {node.description}"
+
+
+def tree_nodes(root):
+    """ツリーの全ノードを階層ごとのクエリでまとめて取得する（get_descendants はノード数だけクエリを発行するため）"""
+    nodes = [root]
+    parent_ids = [root.id]
+    while parent_ids:
+        children = list(KnowledgeNode.objects.filter(parent_id__in=parent_ids))
+        nodes += children
+        parent_ids = [child.id for child in children]
+    return nodes
+
+
+def embed_texts(texts, call_site='embed_query', llm=None):
+    """NODE_EMBEDDING の設定でテキストを埋め込む（バッチサイズごとに分割して送信）"""
+    config = settings.NODE_EMBEDDING
+    llm = llm or LLMClient()
+    vectors = []
+    batch_size = config.get('BATCH_SIZE', 256)
+    for i in range(0, len(texts), batch_size):
+        vectors += llm.embed(call_site, texts[i:i + batch_size], model=config['MODEL'], dimensions=config['DIMENSIONS'])
+    return vectors
+
+
+def embed_nodes(nodes, llm=None):
+    """ノードのタイトルと説明を一括で埋め込み、KnowledgeNode.embedding に保存する"""
+    nodes = list(nodes)
+    if not nodes:
+        return 0
+    vectors = embed_texts([node_text(node) for node in nodes], call_site='embed_nodes', llm=llm)
+    for node, vector in zip(nodes, vectors):
+        node.embedding = encode_vector(vector)
+    KnowledgeNode.objects.bulk_update(nodes, ['embedding'], batch_size=500)
+    return len(nodes)
+
+
+class NodeEmbeddingIndex:
+    """1 つの知識ツリーのノード埋め込みを行列で保持し、テキストに近いノードを返す"""
+
+    _cache = {}  # ルートノードID -> インデックス（ツリーは生成後に変わらないのでプロセス内で使い回す）
+    _lock = threading.Lock()
+
+    def __init__(self, root, llm=None):
+        self.llm = llm
+        all_nodes = tree_nodes(root)
+        nodes = [node for node in all_nodes if node.embedding]
+        self.complete = bool(nodes) and len(nodes) == len(all_nodes)
+        self.node_ids = np.array([node.id for node in nodes], dtype=np.int64)
+        self.nodes = {node.id: node for node in nodes}
+        self.children = {}
+        for node in all_nodes:
+            self.children.setdefault(node.parent_id, []).append(node.id)
+        self.matrix = np.vstack([decode_vector(node.embedding) for node in nodes]) if nodes else np.zeros((0, settings.NODE_EMBEDDING['DIMENSIONS']), dtype=np.float32)
+
+    @classmethod
+    def for_root(cls, root, llm=None):
+        with cls._lock:
+            index = cls._cache.get(root.id)
+        if index is None:
+            index = cls(root, llm)
+            if index.complete: # 埋め込みが揃う前のインデックスはキャッシュしない
+                with cls._lock:
+                    cls._cache[root.id] = index
+        return index
+
+    def descendant_ids(self, node_id):
+        """node_id の子孫（自身を含まない）の ID 集合（DB にはアクセスしない）"""
+        descendants = set()
+        stack = list(self.children.get(node_id, []))
+        while stack:
+            child_id = stack.pop()
+            descendants.add(child_id)
+            stack += self.children.get(child_id, [])
+        return descendants
+
+    def embed(self, text):
+        """クエリ用に正規化したベクトルを返す（同じテキストで複数回検索するときに使い回す）"""
+        vector = np.asarray(embed_texts([text], llm=self.llm)[0], dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def similarities(self, query, node_ids=None):
+        """{ノードID: コサイン類似度}（node_ids を指定するとその中だけ）"""
+        ids, scores = self._scores(query, node_ids)
+        return dict(zip(ids.tolist(), scores.tolist()))
+
+    def top_k(self, query, k=5, node_ids=None, subtree=None):
+        """query（テキストまたは embed() のベクトル）に近い順に [(ノード, 類似度)] を返す
+
+        node_ids: この ID の中から探す（未クリアのノードなど）
+        subtree: このノードの子孫（自身を含まない）の中から探す
+        """
+        if subtree is not None:
+            descendant_ids = self.descendant_ids(subtree.id)
+            node_ids = descendant_ids if node_ids is None else descendant_ids & set(node_ids)
+        ids, scores = self._scores(query, node_ids)
+        if len(ids) == 0:
+            return []
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.nodes[int(ids[i])], float(scores[i])) for i in top]
+
+    def best_matches(self, vectors, node_ids=None, min_similarity=0.0, limit=None):
+        """複数のベクトル（説明の区間ごとの埋め込みなど）のいずれかと最も近い類似度で並べた [(ノード, 類似度)]"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if node_ids is None:
+            ids, matrix = self.node_ids, self.matrix
+        else:
+            mask = np.isin(self.node_ids, list(node_ids))
+            ids, matrix = self.node_ids[mask], self.matrix[mask]
+        if len(ids) == 0:
+            return []
+        best = (matrix @ vectors.T).max(axis=1) # ノードごとに最も近いベクトルとの類似度
+        order = np.argsort(-best)
+        order = order[best[order] >= min_similarity][:limit]
+        return [(self.nodes[int(ids[i])], float(best[i])) for i in order]
+
+    def _scores(self, query, node_ids):
+        if isinstance(query, str):
+            query = self.embed(query)
+        if node_ids is None:
+            ids, matrix = self.node_ids, self.matrix
+        else:
+            mask = np.isin(self.node_ids, list(node_ids))
+            ids, matrix = self.node_ids[mask], self.matrix[mask]
+        if len(ids) == 0:
+            return ids, np.zeros(0, dtype=np.float32)
+        return ids, matrix @ query
+
+
+def chunk_matrix(embeddings, dimensions):
+    """チャンクの埋め込みをノードと同じ次元にそろえて正規化する
+
+    text-embedding-3 系は先頭の次元を切り出して正規化すると dimensions を指定した場合と同等になる。
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)[:, :dimensions]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def link_related_chunks(root, material, hints=None):
+    """ノードと関連チャンクの対応を埋め込みの類似度で決めて一括で保存する
+
+    hints: {ノードID: LLM が挙げた chunk_index のリスト}。ノードが扱うページ範囲の推定にだけ使う
+           （範囲外のチャンクは候補にしない。手がかりがなければ親ノードの範囲を引き継ぐ）
+    """
+    config = settings.CHUNK_LINKING
+    hints = hints or {}
+    nodes = [node for node in tree_nodes(root) if node.parent_id is not None] # ルートは教材全体なので対象外
+    chunks = list(DocumentChunk.objects.filter(learning_material=material).values_list('id', 'chunk_index', 'page_number', 'embedding'))
+    if not nodes or not chunks:
+        return 0
+    chunk_ids = np.array([chunk[0] for chunk in chunks])
+    chunk_pages = np.array([chunk[2] for chunk in chunks])
+    page_of_index = {chunk[1]: chunk[2] for chunk in chunks}
+
+    # ノードごとのページ範囲（親から順に決める）
+    margin = config.get('PAGE_MARGIN', 1)
+    spans = {root.id: None}
+    for node in nodes: # tree_nodes は階層順なので親の範囲が先に決まっている
+        pages = [page_of_index[i] for i in hints.get(node.id, []) if i in page_of_index]
+        spans[node.id] = (min(pages) - margin, max(pages) + margin) if pages else spans.get(node.parent_id)
+
+    embedded = [node for node in nodes if node.embedding]
+    if not embedded: # ノードの埋め込みがなければ LLM の挙げたチャンクをそのまま使う
+        id_of_index = {chunk[1]: chunk[0] for chunk in chunks}
+        links = {node.id: [id_of_index[i] for i in hints.get(node.id, []) if i in id_of_index] for node in nodes}
+    else:
+        node_matrix = np.vstack([decode_vector(node.embedding) for node in embedded])
+        scores = node_matrix @ chunk_matrix([chunk[3] for chunk in chunks], node_matrix.shape[1]).T # (ノード数, チャンク数)
+        for row, node in enumerate(embedded):
+            span = spans[node.id]
+            if span is not None:
+                scores[row, (chunk_pages < span[0]) | (chunk_pages > span[1])] = -np.inf
+        scores[scores < config.get('MIN_SIMILARITY', 0.3)] = -np.inf
+
+        k = min(config.get('TOP_K', 3), len(chunks))
+        top = np.argsort(-scores, axis=1)[:, :k]
+        links = {
+            node.id: [int(chunk_ids[col]) for col in top[row] if np.isfinite(scores[row, col])]
+            for row, node in enumerate(embedded)
+        }
+
+    Through = KnowledgeNode.related_chunks.through
+    Through.objects.filter(knowledgenode_id__in=[node.id for node in nodes]).delete()
+    rows = [Through(knowledgenode_id=node_id, documentchunk_id=chunk_id) for node_id, linked in links.items() for chunk_id in linked]
+    Through.objects.bulk_create(rows, batch_size=1000)
+    print(f"[node index] {root.title}: {len(rows)} 件のチャンク対応を保存しました", file=sys.stderr)
+    return len(rows)
+
+
+def build_node_embeddings(root):
+    """ツリー生成直後に全ノードを埋め込む（失敗してもツリー生成は止めない）"""
+    try:
+        count = embed_nodes(tree_nodes(root))
+        print(f"[node index] {root.title}: {count} ノードを埋め込みました", file=sys.stderr)
+        return count
+    except Exception as e:
+        print(f"[node index] embedding error: {e}", file=sys.stderr)
+        return 0
@@ -0,0 +1,49 @@
+import math
+import struct
+from django.conf import settings
+
+MAX_COMPLETION_TOKENS = 16000  # 1 回の分析の応答の max_tokens の上限（GPT-4o の出力トークン数の上限以下）
+
+
+def png_size(data):
+    """PNG の幅と高さ（IHDR チャンクから読む。PNG でなければ None）"""
+    if len(data) < 24 or not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def estimate_image_tokens(width, height):
+    """GPT-4o（detail: high）の画像の入力トークン数の見積もり
+
+    2048px 四方に収まるよう縮小し、短辺を 768px にしてから 512px のタイル 1 枚あたり 170 トークン + 85 トークン。
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def batch_max_tokens(page_count):
+    """page_count ページをまとめて分析するときの応答の max_tokens（1 ページあたり MAX_TOKENS_PER_PAGE）"""
+    return min(MAX_COMPLETION_TOKENS, settings.PAGE_BATCH.get('MAX_TOKENS_PER_PAGE', 4000) * page_count)
+
+
+def pack_page_batches(candidates):
+    """まとめて分析できるページを、見積もりトークン数とページ数の上限まで順に詰めてバッチにする
+
+    ページ数の上限は MAX_PAGES と、応答の max_tokens を 1 ページあたり MAX_TOKENS_PER_PAGE ずつ確保できるページ数の小さい方。
+
+    candidates: [(ページのグループ, 画像の見積もりトークン数), ...]（ページ順）
+    戻り値: [[ページのグループ, ...], ...]。1 グループだけのバッチは通常どおり 1 ページずつ分析する
+    """
+    config = settings.PAGE_BATCH
+    max_pages = min(config.get('MAX_PAGES', 4), MAX_COMPLETION_TOKENS // config.get('MAX_TOKENS_PER_PAGE', 4000))
+    batches, tokens = [], 0
+    for span, page_tokens in candidates:
+        if not batches or len(batches[-1]) >= max_pages or tokens + page_tokens > config.get('MAX_IMAGE_TOKENS', 5000):
+            batches.append([])
+            tokens = 0
+        batches[-1].append(span)
+        tokens += page_tokens
+    return batches
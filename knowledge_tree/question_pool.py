@@ -0,0 +1,134 @@
+import sys
+from typing import List
+from django.conf import settings
+from pydantic import BaseModel
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from .models import KnowledgeNode, PooledQuestion
+
+
+# 各ソクラテス段階で問う内容（InterviewOrchestrator._generate_question と同じ段階定義）
+STAGE_QUESTION_TYPES = {
+    1: "定義、主要な事実、専門用語を問う質問",
+    2: "理由・原因、動作原理を問う質問",
+    3: "応用やより一般的な質問",
+}
+
+
+class StageQuestions(BaseModel):
+    socratic_stage: int
+    questions: List[str]
+    remedial_questions: List[str]
+
+
+class NodeQuestionPool(BaseModel):
+    stages: List[StageQuestions]
+
+
+class QuestionPoolGenerator:
+    """ノードごとに第1~3段階の質問とリメディアル質問をまとめて生成し、PooledQuestion に保存する"""
+
+    def __init__(self):
+        self.llm = LLMClient()
+        self.config = settings.QUESTION_POOL
+
+    def generate(self, node: KnowledgeNode):
+        related_chunks = list(node.related_chunks.all()) if not node.children.exists() else [] # 葉ノードは講義資料の具体的な記述から質問を作る（_generate_question と同じ方針）
+        sections = PromptBuilder('generate_question_pool').section(
+            'excerpts', [f"- {chunk.content}" for chunk in related_chunks], priority=1
+        ).section('description', node.description, priority=2).build()
+        lecture_content = ""
+        if sections['excerpts']:
+            lecture_content = "■ 講義資料の抜粋:\n" + sections['excerpts'] + "\n"
+            lecture_content += "# 指示: 必ず上記の「講義資料の抜粋」に含まれる情報だけを元に質問を作成してください。"
+
+        stage_text = "\n".join(f"        - 第{stage}段階: {question_type}" for stage, question_type in STAGE_QUESTION_TYPES.items())
+        prompt = f"""
+        あなたは {node.get_root().title} の専門家です。以下の情報に基づいて {node.title} に関するソクラテス式の質問を段階ごとに作成してください。
+
+        ■ 概要: {sections['description']}
+
+        {lecture_content}
+
+        ■ 段階:
+{stage_text}
+
+        ■ 要件:
+        - 各段階につき、通常の質問 (questions) を {self.config.get('QUESTIONS_PER_STAGE', 3)} 個、互いに異なる観点で作成してください。
+        - 各段階につき、その段階の質問に答えられなかった学習者向けに「異なる視点」や「より簡単なレベル」の質問 (remedial_questions) を {self.config.get('REMEDIAL_PER_STAGE', 2)} 個作成してください。
+        - 1 つの質問で問う事項は必ず1つだけに絞ってください。
+        - 質問文を囲む鍵括弧は不要です。
+        """
+        pool = self.llm.parse(
+            'generate_question_pool',
+            response_format=NodeQuestionPool,
+            messages=[
+                {"role": "system", "content": "あなたは教育専門家です。提供された資料に基づき、段階ごとの質問をJSONで返します。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7
+        )
+        if pool is None:
+            print(f"[question pool] {node.title}: 質問を生成できませんでした", file=sys.stderr)
+            return 0
+
+        questions = []
+        for stage in pool.stages:
+            if stage.socratic_stage not in STAGE_QUESTION_TYPES:
+                continue
+            questions += [PooledQuestion(node=node, socratic_stage=stage.socratic_stage, is_remedial=False, content=q.strip()) for q in stage.questions if q.strip()]
+            questions += [PooledQuestion(node=node, socratic_stage=stage.socratic_stage, is_remedial=True, content=q.strip()) for q in stage.remedial_questions if q.strip()]
+        node.pooled_questions.all().delete() # 再生成時は入れ替える
+        PooledQuestion.objects.bulk_create(questions)
+        return len(questions)
+
+
+class QuestionPool:
+    """インタビュー中に事前生成済みの質問を取り出す"""
+
+    def __init__(self, llm=None):
+        self.llm = llm or LLMClient()
+        self.config = settings.QUESTION_POOL
+
+    def pick(self, node: KnowledgeNode, socratic_stage: int, remedial: bool, asked_questions: list):
+        """まだ出題していない質問を 1 つ返す（プールが空・使い切った場合は None）"""
+        if not self.config.get('ENABLED', True):
+            return None
+        for question in node.pooled_questions.filter(socratic_stage=socratic_stage, is_remedial=remedial):
+            if not any(question.content in asked for asked in asked_questions): # 一声を付け足した質問も出題済みとみなす
+                return question.content
+        return None
+
+    def personalize(self, question: str, last_history: dict = None):
+        """直前のやり取りに対する短い一声を質問の前に付け足す（質問そのものは変えない）"""
+        if not self.config.get('PERSONALIZE', True) or not last_history:
+            return question
+        sections = PromptBuilder('personalize_question').section(
+            'question', last_history['question'], priority=1
+        ).section('answer', last_history['answer'], keep='tail').build()
+        prompt = f"""
+        学習者との直前のやり取りに対して、次の質問の前に添える短い一声（1文・40文字以内）を作成してください。
+
+        ■ 直前の質問: {sections['question']}
+        ■ 学習者の回答: {sections['answer']}
+        ■ 次の質問: {question}
+
+        ■ 重要な指示:
+        - 一声だけを出力し、次の質問は繰り返さないでください。
+        - 回答の正誤を断定したり、答えを教えたりしないでください。
+        """
+        try:
+            lead = self.llm.chat(
+                'personalize_question',
+                messages=[
+                    {"role": "system", "content": "あなたは学習者と対話する教育専門家です。"},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=80,
+                temperature=0.3
+            )
+        except Exception as e: # 一声は必須ではないので、失敗したら質問だけを返す
+            print(f"[question pool] personalize error: {e}", file=sys.stderr)
+            return question
+        lead = (lead or "").strip()
+        return f"{lead}{question}" if lead else question
@@ -0,0 +1,133 @@
+import sys
+import random
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from django.utils import timezone
+from celery.exceptions import Retry
+from redis.exceptions import RedisError
+from llm_gateway.backend import get_redis
+from llm_gateway.hedging import transient_errors, LLMDeadlineExceeded
+from llm_gateway.governor import LLMRateLimited
+
+
+def retryable_errors():
+    """Celery のタスク単位で再試行する OpenAI の一時的なエラー（レート制御の枠が空くのを待つ場合も含む）"""
+    return transient_errors() + (LLMDeadlineExceeded, LLMRateLimited)
+
+
+def retry_after_seconds(exc):
+    """レート制限などの応答に付いている retry-after-ms / retry-after ヘッダの待ち時間[秒]（なければ None）
+
+    LLMRateLimited（レート制御の枠待ち）はバケットが空くまでの秒数を使う。
+    """
+    if isinstance(exc, LLMRateLimited):
+        return exc.retry_after
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if value:
+            try:
+                return float(value)
+            except ValueError: # HTTP 日付形式
+                return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def retry_countdown(exc, retries):
+    """次の再試行までの待ち時間[秒]。プロバイダの指定があれば従い、なければ指数バックオフ（フルジッター）"""
+    config = settings.PIPELINE_RETRY
+    if isinstance(exc, LLMRateLimited): # 枠待ちはゲートウェイが順番に割り当てた時刻まで待つ（MAX_DELAY で切らない）
+        return exc.retry_after + random.uniform(0, 1 + exc.retry_after * 0.1)
+    hint = retry_after_seconds(exc)
+    if hint is not None:
+        return min(config.get('MAX_DELAY', 120), hint + random.uniform(0, 1)) # 同時に待っていたタスクが一斉に再開しないように少しずらす
+    return random.uniform(0, min(config.get('MAX_DELAY', 120), config.get('BASE_DELAY', 2) * 2 ** retries))
+
+
+class PipelineRetryStats:
+    """教材ごと・タスクごとの再試行回数と待ち時間（Redis に保存し、進捗エンドポイントで返す）"""
+
+    KEY = 'pipeline_retries:{material_id}'
+    TTL = 60 * 60 * 24 * 7
+
+    def __init__(self, material_id):
+        self.key = self.KEY.format(material_id=material_id)
+        self.redis = get_redis()
+
+    def record(self, task_name, countdown, kind='retries'):
+        """kind: 'retries'（API のエラー）または 'deferrals'（レート制御の枠待ち）"""
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.key, f'{task_name}:{kind}', 1)
+            pipe.hincrbyfloat(self.key, f'{task_name}:wait_seconds', countdown)
+            pipe.expire(self.key, self.TTL)
+            pipe.execute()
+        except RedisError as e:
+            print(f"[pipeline] retry stats error: {e}", file=sys.stderr)
+
+    def stats(self):
+        try:
+            raw = self.redis.hgetall(self.key)
+        except RedisError as e:
+            return {'error': str(e)}
+        tasks = {}
+        for field, value in raw.items():
+            task_name, kind = field.decode().rsplit(':', 1)
+            tasks.setdefault(task_name, {'retries': 0, 'deferrals': 0, 'wait_seconds': 0.0})[kind] = round(float(value), 1) if kind == 'wait_seconds' else int(value)
+        return tasks
+
+
+DEFERRALS_HEADER = 'llm_deferrals'
+
+
+def deferral_count(task):
+    """このタスクがレート制御の枠待ちで再投入された回数（メッセージのヘッダに持たせる）"""
+    request = task.request
+    return int(request.get(DEFERRALS_HEADER) or (request.headers or {}).get(DEFERRALS_HEADER) or 0)
+
+
+def can_retry(task, exc):
+    """retry_task で再投入できるか（枠待ちは MAX_DEFERRALS 回、API のエラーは max_retries 回まで）"""
+    if isinstance(exc, LLMRateLimited):
+        return deferral_count(task) < settings.PIPELINE_RETRY.get('MAX_DEFERRALS', 50)
+    return task.request.retries < task.max_retries
+
+
+def retry_task(task, exc, material_id):
+    """一時的なエラーのタスクを countdown 付きで Celery に再投入する（待つ間ワーカーは他のページを処理できる）"""
+    if isinstance(exc, LLMRateLimited):
+        return defer_task(task, exc, material_id)
+    countdown = retry_countdown(exc, task.request.retries)
+    if task.request.retries < task.max_retries:
+        PipelineRetryStats(material_id).record(task.name.rsplit('.', 1)[-1], countdown)
+        print(f"[pipeline] {task.name} retry {task.request.retries + 1}/{task.max_retries} in {countdown:.1f}s: {exc}", file=sys.stderr)
+    return task.retry(exc=exc, countdown=countdown, max_retries=task.max_retries)
+
+
+def defer_task(task, exc, material_id):
+    """レート制御の枠待ちのタスクを、再試行回数（max_retries）を増やさずに再投入する
+
+    枠待ちは API のエラーではないので、大きな教材で多くのページが順番を待っても max_retries を使い切らない。
+    MAX_DEFERRALS 回を超えたら exc を返す（呼び出し元が送出し、タスクは失敗する）。
+    """
+    deferrals = deferral_count(task) + 1
+    max_deferrals = settings.PIPELINE_RETRY.get('MAX_DEFERRALS', 50)
+    if deferrals > max_deferrals:
+        print(f"[pipeline] {task.name}: 枠待ちの再投入が {max_deferrals} 回を超えました: {exc}", file=sys.stderr)
+        return exc
+    countdown = retry_countdown(exc, task.request.retries)
+    PipelineRetryStats(material_id).record(task.name.rsplit('.', 1)[-1], countdown, kind='deferrals')
+    print(f"[pipeline] {task.name} deferred {deferrals}/{max_deferrals} in {countdown:.1f}s: {exc}", file=sys.stderr)
+    request = task.request
+    signature = task.signature_from_request(
+        request, countdown=countdown, headers={**(request.headers or {}), DEFERRALS_HEADER: deferrals}
+    )
+    if not request.is_eager: # Task.retry と同じく、eager 実行では apply() が signature を実行し直す
+        signature.apply_async()
+    return Retry(exc=exc, when=countdown, is_eager=request.is_eager, sig=signature)
@@ -0,0 +1,79 @@
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from llm_gateway.tokens import count_tokens
+from .models import DocumentChunk
+from .node_index import NodeEmbeddingIndex, chunk_matrix, decode_vector, embed_texts
+
+
+class ContextRetriever:
+    """質問生成のプロンプトに入れる講義資料の抜粋を選ぶ
+
+    ノード（と子孫）の関連チャンクを、ノードとの類似度に学習者の直前の回答との類似度を加えて順位付けし、
+    トークン予算に収まる分だけ返す。ノードとの類似度とトークン数はノードごとにキャッシュする。
+    """
+
+    CACHE_KEY = 'retrieval:node:{node_id}'
+
+    def __init__(self, llm=None):
+        self.llm = llm
+        self.config = settings.RETRIEVAL
+
+    def select(self, node, last_answer=None, token_budget=None):
+        """選んだ DocumentChunk のリスト（関連度の高い順）"""
+        token_budget = token_budget or self.config.get('TOKEN_BUDGET', 1200)
+        candidates = self._candidates(node)
+        if not candidates:
+            return []
+
+        scores = np.array([candidate['score'] for candidate in candidates], dtype=np.float32)
+        answer_weight = self.config.get('ANSWER_WEIGHT', 0.5)
+        if last_answer and answer_weight and len(candidates) > 1:
+            chunks = DocumentChunk.objects.in_bulk([candidate['id'] for candidate in candidates])
+            matrix = chunk_matrix([chunks[candidate['id']].embedding for candidate in candidates], settings.NODE_EMBEDDING['DIMENSIONS'])
+            answer_vector = np.asarray(embed_texts([last_answer], llm=self.llm)[0], dtype=np.float32)
+            scores = scores + answer_weight * (matrix @ (answer_vector / (np.linalg.norm(answer_vector) or 1.0)))
+
+        selected, used = [], 0
+        for i in np.argsort(-scores):
+            candidate = candidates[i]
+            if used + candidate['tokens'] > token_budget:
+                continue
+            selected.append(candidate['id'])
+            used += candidate['tokens']
+            if len(selected) >= self.config.get('MAX_PASSAGES', 5):
+                break
+        chunks = DocumentChunk.objects.in_bulk(selected)
+        if not selected: # 1 つも予算に収まらなければ最上位のチャンクを予算分だけ切り詰めて使う
+            top = DocumentChunk.objects.get(id=candidates[int(np.argmax(scores))]['id'])
+            top.content = self._truncate(top.content, token_budget)
+            return [top]
+        return [chunks[chunk_id] for chunk_id in selected]
+
+    def _candidates(self, node):
+        """[{'id', 'score'（ノードとの類似度）, 'tokens'}]（ノードごとにキャッシュ）"""
+        key = self.CACHE_KEY.format(node_id=node.id)
+        candidates = cache.get(key)
+        if candidates is not None:
+            return candidates
+
+        root = node.get_root()
+        index = NodeEmbeddingIndex.for_root(root, self.llm)
+        node_ids = [node.id] + list(index.descendant_ids(node.id))
+        chunks = list(DocumentChunk.objects.filter(knowledge_nodes__id__in=node_ids).distinct().order_by('page_number', 'chunk_index'))
+        if not chunks:
+            candidates = []
+        elif node.embedding:
+            matrix = chunk_matrix([chunk.embedding for chunk in chunks], settings.NODE_EMBEDDING['DIMENSIONS'])
+            similarities = matrix @ decode_vector(node.embedding)
+            candidates = [{'id': chunk.id, 'score': float(score), 'tokens': count_tokens(chunk.content)} for chunk, score in zip(chunks, similarities)]
+        else: # ノードの埋め込みがなければページ順
+            candidates = [{'id': chunk.id, 'score': -i / len(chunks), 'tokens': count_tokens(chunk.content)} for i, chunk in enumerate(chunks)]
+        cache.set(key, candidates, self.config.get('CACHE_TTL', 60 * 60))
+        return candidates
+
+    @staticmethod
+    def _truncate(text, token_budget):
+        while text and count_tokens(text) > token_budget:
+            text = text[:int(len(text) * 0.9)]
+        return text
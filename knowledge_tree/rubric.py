@@ -0,0 +1,127 @@
+import re
+import sys
+import unicodedata
+import numpy as np
+from typing import List
+from django.conf import settings
+from pydantic import BaseModel
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from .models import KnowledgeNode
+
+
+class NodeRubric(BaseModel):
+    key_points: List[str]
+    expected_terms: List[str]
+
+
+class RubricGenerator:
+    """ノードの説明と関連チャンクから採点基準（押さえるべき要点・期待される用語）を抽出して保存する"""
+
+    def __init__(self):
+        self.llm = LLMClient()
+        self.config = settings.RUBRIC
+
+    def generate(self, node: KnowledgeNode):
+        sections = PromptBuilder('generate_rubric').section(
+            'excerpts', [f"- {chunk.content}" for chunk in node.related_chunks.all()], priority=1
+        ).section('description', node.description, priority=2).build()
+        prompt = f"""
+        あなたは {node.get_root().title} の専門家です。{node.title} について学習者が説明・回答するときの採点基準を作成してください。
+
+        ■ トピック:
+        {node.title}: {sections['description']}
+
+        ■ 講義資料の抜粋:
+        {sections['excerpts']}
+
+        ■ 要件:
+        - key_points: 正しい理解を示す回答が押さえるべき要点を、それぞれ1文で3~5個。講義資料の内容だけを使ってください。
+        - expected_terms: 理解している学習者の回答に現れるはずの専門用語・キーワードを3~8個（表記は講義資料どおり）。
+        """
+        rubric = self.llm.parse(
+            'generate_rubric',
+            response_format=NodeRubric,
+            messages=[
+                {"role": "system", "content": "あなたは教育評価の専門家です。講義資料に基づく採点基準をJSONで返します。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.0
+        )
+        if rubric is None or not rubric.key_points:
+            print(f"[rubric] {node.title}: 採点基準を抽出できませんでした", file=sys.stderr)
+            return None
+
+        model = self.config.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+        node.rubric = {
+            'key_points': rubric.key_points,
+            'expected_terms': rubric.expected_terms,
+            'embedding_model': model,
+            'key_point_embeddings': self.llm.embed('embed_rubric', rubric.key_points, model=model),
+        }
+        node.save(update_fields=['rubric'])
+        return node.rubric
+
+
+def normalize_answer(text):
+    """全角・半角をそろえ、空白と句読点・記号を除いた回答（ギブアップの言葉と回答全体で比べる）"""
+    text = unicodedata.normalize('NFKC', text or '')
+    return ''.join(ch for ch in text if not (ch.isspace() or unicodedata.category(ch)[0] in 'PS')).lower()
+
+
+class RubricScorer:
+    """採点基準を使って回答を手元で事前採点する
+
+    明らかな合格・不合格だけを判定し、どちらとも言えない回答は None を返して LLM の評価に任せる。
+    採点基準はノードの定義・用語から作るので、合格と判定するのは PASS_STAGES の段階（定義を問う質問）だけ。
+    """
+
+    def __init__(self, llm=None):
+        self.llm = llm or LLMClient()
+        self.config = settings.RUBRIC
+
+    def prescore(self, node: KnowledgeNode, answer_text: str, socratic_stage: int = 1):
+        """('pass' | 'fail' | None, 判定の根拠) を返す
+
+        socratic_stage: 回答している質問の段階（理由・応用を問う段階では、定義を言い直しただけの回答を合格にしない）
+        """
+        if not self.config.get('ENABLED', True):
+            return None, {}
+        answer = re.sub(r'\s+', '', answer_text or '')
+
+        # 空の回答・ギブアップの言葉だけの回答は採点基準がなくても不合格
+        # （短くても正しい回答（「DNA」など）や、ギブアップの言葉を一部に含む回答（「パスカルの原理」など）は LLM に任せる）
+        normalized = normalize_answer(answer_text)
+        if not normalized:
+            return 'fail', {'reason': 'blank'}
+        if normalized in {normalize_answer(phrase) for phrase in self.config.get('GIVE_UP_PHRASES', [])}:
+            return 'fail', {'reason': 'give_up'}
+
+        rubric = node.rubric or {}
+        if not rubric.get('key_point_embeddings'):
+            return None, {'reason': 'no_rubric'}
+
+        terms = rubric.get('expected_terms', [])
+        covered = [term for term in terms if re.sub(r'\s+', '', term).lower() in answer.lower()]
+        coverage = len(covered) / len(terms) if terms else 0.0
+        try:
+            similarity = self._max_similarity(answer_text, rubric)
+        except Exception as e: # 事前採点できなければ LLM の評価に任せる
+            print(f"[rubric] prescore error: {e}", file=sys.stderr)
+            return None, {'reason': 'embedding_error'}
+        detail = {'coverage': round(coverage, 2), 'similarity': round(similarity, 3), 'covered_terms': covered}
+
+        if similarity < self.config.get('FAIL_SIMILARITY', 0.2) and not covered: # 話題が外れている
+            return 'fail', dict(detail, reason='off_topic')
+        if similarity >= self.config.get('PASS_SIMILARITY', 0.6) and coverage >= self.config.get('PASS_COVERAGE', 0.5):
+            if socratic_stage not in self.config.get('PASS_STAGES', [1]): # 質問に答えているかは LLM に任せる
+                return None, dict(detail, reason='stage')
+            return 'pass', dict(detail, reason='rubric_match')
+        return None, dict(detail, reason='borderline')
+
+    def _max_similarity(self, answer_text, rubric):
+        """回答と各要点のコサイン類似度の最大値"""
+        answer_embedding = np.array(self.llm.embed('embed_answer', [answer_text], model=rubric['embedding_model'])[0])
+        key_points = np.array(rubric['key_point_embeddings'])
+        similarities = key_points @ answer_embedding / (np.linalg.norm(key_points, axis=1) * np.linalg.norm(answer_embedding))
+        return float(similarities.max())
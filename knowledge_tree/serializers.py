@@ -20,7 +20,7 @@ class DocumentChunkSerializer(serializers.ModelSerializer):
     class Meta:
         model = DocumentChunk
         fields = [
-            'id', 'content', 'page_number', 'knowledge_nodes', 'created_at'
+            'id', 'content', 'page_number', 'page_number_end', 'knowledge_nodes', 'created_at'
         ]
 
 
@@ -30,6 +30,6 @@ class LearningMaterialSerializer(serializers.ModelSerializer):
     class Meta:
         model = LearningMaterial
         fields = [
-            'id', 'title', 'file_path', 'processed', 'root_node',
-            'created_at', 'updated_at'
+            'id', 'title', 'file_path', 'processed', 'pages_total',
+            'pages_analyzed', 'root_node', 'created_at', 'updated_at'
         ]
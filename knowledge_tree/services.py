@@ -2,18 +2,32 @@ import os
 import sys
 import time
 import json
-import chromadb
 import base64
-import fitz  # PyMuPDF
-from celery import shared_task, group, chord, chain
-from sentence_transformers import SentenceTransformer
+from celery import shared_task, group, chain, chord
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.core.files.storage import default_storage
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from pydantic import BaseModel
 from typing import List
+from llm_gateway.client import LLMClient
+from llm_gateway.routing import json_validator
+from llm_gateway.tracing import span, start_trace
+from llm_gateway.prompting import PromptBuilder
 from .models import LearningMaterial, DocumentChunk, KnowledgeNode
+from interview_session.models import InterviewSession, ExplanationSegment
+from .question_pool import QuestionPool, QuestionPoolGenerator
+from .rubric import RubricGenerator, RubricScorer
+from .node_index import build_node_embeddings, link_related_chunks, tree_nodes, embed_texts, encode_vector, decode_vector
+from .retrieval import ContextRetriever
+from .summaries import NodeSummarizer
+from .coverage import ExplanationCoverage
+from .warmup import load_warmup, save_warmup
+from .artifacts import ArtifactStore, page_name
+from .retries import retryable_errors, retry_task, can_retry
+from .slides import page_thumbnail, page_words, group_build_pages
+from .layout import extract_layout, render_region, merge_page_text
+from .page_batches import png_size, estimate_image_tokens, pack_page_batches, batch_max_tokens
 
 
 class KGNode(BaseModel):
@@ -23,34 +37,65 @@ class KGNode(BaseModel):
     related_chunks: List[int] = []
     children: List['KGNode'] = []
 
+class FigureDescription(BaseModel):
+    figure: int
+    description: str
+
+class PageFigures(BaseModel):
+    """ページから切り出した図・数式の説明（図の番号ごと）"""
+    figures: List[FigureDescription]
+
+class PageAnalysis(BaseModel):
+    page: int
+    content: str
+
+class PageBatchAnalysis(BaseModel):
+    """複数ページをまとめて分析したときのページごとの結果"""
+    pages: List[PageAnalysis]
+
+PAGE_ANALYSIS_PROMPT = """この講義資料のページの内容を詳細に分析し、以下の情報を含めて説明してください：
+1. テキスト: ページに書かれているすべてのテキストを正確に抽出
+2. 図表・グラフ: 存在する場合、内容と数値データを詳細に説明
+3. 画像・イラスト: 存在する場合、視覚的要素の内容と意味
+4. 数式・記号: 数学的表現や特殊記号があれば正確に記録
+"""
+
 # グローバル関数として定義
-@shared_task
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=1, max=10),
-    retry=retry_if_exception_type((Exception,))
-)
-def analyze_page_task(page_number, image_data):
-    """GPT-4oを使用してページ画像を包括的に分析（リトライ機能付き）"""
-    # 画像データをbase64エンコード
-    openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
-    base64_image = base64.b64encode(image_data).decode('utf-8')
+@shared_task(bind=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES'])
+def analyze_page_task(self, material_id, page_number):
+    """GPT-4oを使用してページ画像を包括的に分析（一時的なエラーは Celery の countdown 付きで再試行）
+
+    画像は ArtifactStore から読み、分析結果も ArtifactStore に書いて、次のタスクにはページ番号だけを渡す。
+    レイアウト（layout/）があるページは、テキスト層のテキストをそのまま使い、切り出した図・数式だけを GPT-4o に送る。
+    """
+    llm = LLMClient()
+    store = ArtifactStore(material_id)
     
     # GPT-4oで詳細分析
-    response = openai_client.chat.completions.create(
-        model= "gpt-4o-2024-11-20",
+    try:
+        content = None
+        if store.exists('layout', page_name(page_number, 'json')):
+            content = _analyze_page_layout(llm, store, json.loads(store.load_text('layout', page_name(page_number, 'json'))))
+        if content is None: # レイアウトがない・図の説明がそろわなかったページはページ全体の画像で分析する
+            # 画像データをbase64エンコード
+            base64_image = base64.b64encode(store.load_bytes('pages', page_name(page_number, 'png'))).decode('utf-8')
+            content = _analyze_page_image(llm, base64_image)
+    except retryable_errors() as e: # 待つ間ワーカーを占有しないよう、スリープせずにタスクごと再投入する
+        raise retry_task(self, e, material_id)
+    store.save('analysis', page_name(page_number, 'txt'), content)
+    return page_number
+
+def _analyze_page_image(llm, base64_image):
+    """ページ画像の内容を GPT-4o で書き起こしたテキスト"""
+    return llm.chat(
+        'analyze_page',
         messages=[
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": f"""この講義資料のページの内容を詳細に分析し、以下の情報を含めて説明してください：
-1. テキスト: ページに書かれているすべてのテキストを正確に抽出
-2. 図表・グラフ: 存在する場合、内容と数値データを詳細に説明
-3. 画像・イラスト: 存在する場合、視覚的要素の内容と意味
-4. 数式・記号: 数学的表現や特殊記号があれば正確に記録
-"""
+                        "text": PAGE_ANALYSIS_PROMPT
                     },
                     {
                         "type": "image_url",
@@ -64,49 +109,185 @@ def analyze_page_task(page_number, image_data):
         max_tokens=16000,
         temperature=0.0
     )
-    return {"page_number": page_number, "content": response.choices[0].message.content}
 
-@shared_task
-def collect_pages_result(pages_results):
-    return sorted(pages_results, key=lambda x: x['page_number'])
+@shared_task(bind=True, ignore_result=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES'])
+def analyze_pages_batch_task(self, material_id, spans):
+    """複数ページの画像を 1 回の GPT-4o 呼び出しで分析し、ページごとの結果に分けてからチャンク化・埋め込みに進む
+
+    spans: [[最初のページ, 分析するページ], ...]（dispatch_pages_task のページのグループ）。
+    応答をページごとに分けられなかったときは、1 ページずつの分析（page_pipeline）に切り替える。
+    """
+    llm = LLMClient()
+    store = ArtifactStore(material_id)
+    try:
+        contents = _analyze_page_images(llm, store, [span[-1] for span in spans])
+    except retryable_errors() as e:
+        if can_retry(self, e):
+            raise retry_task(self, e, material_id)
+        contents = None # 再試行を使い切ったら 1 ページずつの分析（それぞれ再試行できる）に任せる
+    except Exception as e:
+        print(f"[pipeline] material {material_id} batch {spans} error: {e}", file=sys.stderr)
+        contents = None
+    
+    if contents is None:
+        print(f"[pipeline] material {material_id}: pages {[span[-1] for span in spans]} を 1 ページずつ分析します", file=sys.stderr)
+        _analyze_pages_one_by_one(material_id, spans)
+        return
+    dispatched = 0
+    try:
+        for span in spans:
+            store.save('analysis', page_name(span[-1], 'txt'), contents[span[-1]])
+            PDFProcessor.chunk_and_embed_page_task.s(span[-1], material_id, first_page=span[0]).on_error(
+                page_failed_task.s(material_id, span[-1], span[0])
+            ).apply_async()
+            dispatched += 1
+    except Exception as e: # 保存・投入できなかったページも数えられるよう、残りは 1 ページずつの分析に任せる
+        print(f"[pipeline] material {material_id} batch {spans} dispatch error: {e}", file=sys.stderr)
+        _analyze_pages_one_by_one(material_id, spans[dispatched:])
+
+@shared_task(ignore_result=True)
+def batch_failed_task(request, exc, traceback, material_id, spans):
+    """まとめて分析するタスク自体が失敗したら、バッチのすべてのページを処理済みとして数える"""
+    print(f"[pipeline] material {material_id} batch {[span[-1] for span in spans]} failed: {exc}", file=sys.stderr)
+    for span in spans:
+        finish_page(material_id, span[-1], span[0])
+
+def _analyze_pages_one_by_one(material_id, spans):
+    """まとめて分析できなかったページを page_pipeline で 1 ページずつ分析する（投入もできなければ処理済みとして数える）"""
+    try:
+        group(page_pipeline(material_id, span) for span in spans).apply_async()
+    except Exception as e:
+        print(f"[pipeline] material {material_id} pages {[span[-1] for span in spans]} dispatch error: {e}", file=sys.stderr)
+        for span in spans:
+            finish_page(material_id, span[-1], span[0])
+
+def _analyze_page_images(llm, store, page_numbers):
+    """複数ページの画像を 1 回で分析した {ページ番号: テキスト}（ページごとに分けられなければ None）"""
+    content = [{
+        "type": "text",
+        "text": f"""以下は講義資料の {len(page_numbers)} ページ分の画像です（各画像の直前に「ページ N:」と示します）。
+{PAGE_ANALYSIS_PROMPT}
+ページごとに分けて、page にページ番号、content にそのページの分析結果を入れて返してください。
+他のページの内容を混ぜないでください。
+"""
+    }]
+    for page_number in page_numbers:
+        base64_image = base64.b64encode(store.load_bytes('pages', page_name(page_number, 'png'))).decode('utf-8')
+        content.append({"type": "text", "text": f"ページ {page_number}:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}})
+    
+    result = llm.parse(
+        'analyze_pages',
+        response_format=PageBatchAnalysis,
+        messages=[{"role": "user", "content": content}],
+        max_tokens=batch_max_tokens(len(page_numbers)),
+        temperature=0.0
+    )
+    contents = {page.page: page.content for page in (result.pages if result else []) if page.content.strip()}
+    if set(contents) != set(page_numbers):
+        print(f"[pipeline] batch pages mismatch: expected {page_numbers}, got {sorted(contents)}", file=sys.stderr)
+        return None
+    return contents
+
+def _analyze_page_layout(llm, store, layout):
+    """テキスト層のテキストと、切り出した図・数式の説明を読み順に並べたテキスト（図の説明がそろわなければ None）"""
+    items = layout['items']
+    figures = [item for item in items if item['type'] == 'figure']
+    if not figures: # テキストだけのページは GPT-4o を呼ばない
+        return merge_page_text(items, [])
+    
+    page_text = merge_page_text([item for item in items if item['type'] == 'text'], [])
+    content = [{
+        "type": "text",
+        "text": f"""講義資料の 1 ページから切り出した図・グラフ・数式の画像です（図1〜図{len(figures)}）。
+それぞれについて、以下を含めて説明してください：
+1. 図表・グラフ: 内容と数値データを詳細に
+2. 画像・イラスト: 視覚的要素の内容と意味
+3. 数式・記号: 数式は LaTeX で正確に記録
+4. 図の中のテキスト・ラベル: 正確に抽出
+
+参考: 同じページのテキスト
+{page_text[:settings.PAGE_LAYOUT.get('CONTEXT_CHARS', 1500)]}
+"""
+    }]
+    for item in figures:
+        content.append({"type": "text", "text": f"図{item['figure']}:"})
+        base64_image = base64.b64encode(store.load_bytes('figures', item['image'])).decode('utf-8')
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}})
+    
+    result = llm.parse(
+        'analyze_figures',
+        response_format=PageFigures,
+        messages=[{"role": "user", "content": content}],
+        temperature=0.0
+    )
+    descriptions = {figure.figure: figure.description for figure in (result.figures if result else [])}
+    if set(descriptions) != {item['figure'] for item in figures}:
+        print(f"[pipeline] figure descriptions mismatch: {sorted(descriptions)}", file=sys.stderr)
+        return None
+    return merge_page_text(items, [descriptions[number] for number in sorted(descriptions)])
+
+def save_page_layout(store, page_number, page):
+    """ページのレイアウトを求め、図・数式の領域を切り出して ArtifactStore に置く（ページ全体を分析するページは何も置かない）"""
+    layout = extract_layout(page)
+    if layout['mode'] != 'layout':
+        return False
+    for item in layout['items']:
+        if item['type'] == 'figure':
+            item['image'] = page_name(page_number, f"fig-{item['figure']}.png")
+            store.save('figures', item['image'], render_region(page, item['bbox']))
+    store.save('layout', page_name(page_number, 'json'), json.dumps(layout, ensure_ascii=False))
+    return True
 
 class PDFProcessor:
     """PDFからテキストを抽出し、チャンク化する"""
     
     def __init__(self):
-        self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.llm = LLMClient()
         self.embedding_model = "text-embedding-3-large"
 
     def _render_page_to_image(self, page):
         """ページを高解像度画像としてレンダリング"""
-        mat = fitz.Matrix(2.0, 2.0)  # 2倍ズーム for better quality
+        import fitz  # PyMuPDF（教材処理のワーカーでだけ読み込む）
+        zoom = settings.PAGE_RENDER.get('ZOOM', 2.0)
+        mat = fitz.Matrix(zoom, zoom)  # 2倍ズーム for better quality
         pix = page.get_pixmap(matrix=mat)
         return pix.tobytes("png")
 
-    @shared_task # 新しい Celery タスクとして定義
-    def chunk_and_embed_task(pages_text, material_id):
-        """ページテキストをチャンク化し、Embeddingを生成し、DBに保存する"""
-        # print("[DEBUG] pages_text:", pages_text, file=sys.stderr)
+    @shared_task(bind=True, ignore_result=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES']) # 新しい Celery タスクとして定義
+    def chunk_and_embed_page_task(task, page_number, material_id, first_page=None):
+        """1 ページ分の分析結果を届いた順にチャンク化・埋め込みして保存し、最後のページならツリー生成を始める
+
+        first_page: アニメーションの途中経過のページをまとめて最後のページ（page_number）だけを分析したときの最初のページ。
+        チャンクには first_page〜page_number のページ範囲を記録する。
+        """
         processor = PDFProcessor() # インスタンスをタスク内で再生成
+        content = ArtifactStore(material_id).load_text('analysis', page_name(page_number, 'txt'))
+        first_page = first_page or page_number
         
-        # 1. テキストをチャンク化
-        chunks = processor.chunk_text(pages_text)
-        # print("[DEBUG] chunks:", chunks, file=sys.stderr)
-        # 2. 埋め込みベクトルを生成
-        chunks_with_embeddings = processor.generate_embeddings(chunks)
-        
-        # 3. データベースにチャンクを保存
-        material = LearningMaterial.objects.get(id=material_id)
-        for chunk_data in chunks_with_embeddings:
-            DocumentChunk.objects.create(
-                learning_material=material,
-                content=chunk_data['content'],
-                embedding=chunk_data['embedding'],
-                page_number=chunk_data['page_number'],
-                chunk_index=chunk_data['chunk_index']
-            )
+        # 1. テキストをチャンク化（chunk_index はページ内の順番。全ページがそろったら通し番号に振り直す）
+        chunks = processor.chunk_text([{'page_number': first_page, 'content': content}])
+        if chunks:
+            # 2. 埋め込みベクトルを生成（一時的なエラーは Celery の countdown 付きで再試行）
+            try:
+                chunks_with_embeddings = processor.generate_embeddings(chunks)
+            except retryable_errors() as e:
+                raise retry_task(task, e, material_id)
             
-        return material_id, chunks_with_embeddings # 次のタスク（generate_knowledge_tree_task() の result_tuple）に必要な情報を返す
+            # 3. データベースにチャンクを保存（保存した時点で検索できる）
+            DocumentChunk.objects.bulk_create([
+                DocumentChunk(
+                    learning_material_id=material_id,
+                    content=chunk_data['content'],
+                    embedding=chunk_data['embedding'],
+                    page_number=chunk_data['page_number'],
+                    page_number_end=page_number,
+                    chunk_index=chunk_data['chunk_index']
+                )
+                for chunk_data in chunks_with_embeddings
+            ])
+        
+        finish_page(material_id, page_number, first_page)
 
     def chunk_text(self, pages_text, chunk_size=500, overlap=0):
         """テキストをチャンク化"""
@@ -131,18 +312,9 @@ class PDFProcessor:
         
         return chunks
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=1, max=10),
-        retry=retry_if_exception_type((Exception,))
-    )
     def _get_embeddings_batch(self, contents):
-        """複数のコンテンツに対してEmbeddingを一括取得（リトライ付き）"""
-        response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=contents  # リストで複数テキストを送信
-        )
-        return [item.embedding for item in response.data]
+        """複数のコンテンツに対してEmbeddingを一括取得（再試行は呼び出し元のタスクが行う）"""
+        return self.llm.embed('embed_chunks', contents, model=self.embedding_model)  # リストで複数テキストを送信
 
     def generate_embeddings(self, chunks):
         """チャンクの埋め込みベクトルを生成（OpenAI Embeddingを使用、バッチ処理）"""
@@ -163,13 +335,16 @@ class KnowledgeTreeGenerator:
     """LLMを使用して知識ツリーを生成"""
     
     def __init__(self):
-        self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        self.model = "gpt-4o-2024-11-20"
+        self.llm = LLMClient()
+        self.chunk_hints = {} # ノードID -> LLM が挙げた chunk_index（link_related_chunks でページ範囲の推定に使う）
 
     def generate_knowledge_tree(self, chunks, material_title):
         """チャンクから知識ツリーを生成"""
         # チャンクの内容を結合
-        full_content = '\n\n'.join([f"chunk_index: {chunk['chunk_index']}, content: {chunk['content']}" for chunk in chunks])
+        sections = PromptBuilder('generate_tree').section(
+            'material', [f"chunk_index: {chunk['chunk_index']}, content: {chunk['content']}" for chunk in chunks], separator='\n\n'
+        ).build()
+        full_content = sections['material']
         print("[DEBUG] full_content:", full_content, file=sys.stderr)
         prompt = f"""
         あなたは、提供された講義資料の内容を、学習者が理解するための非常に深く階層化された深さ6以上の巨大知識ツリー（KGNode）に変換する専門家です。
@@ -197,8 +372,8 @@ class KnowledgeTreeGenerator:
         ■ 教材内容:
         {full_content}
         """
-        response = self.openai_client.beta.chat.completions.parse(
-            model=self.model,
+        knowledge_tree = self.llm.parse(
+            'generate_tree',
             response_format=KGNode,
             messages=[
                 {"role": "system", "content": "あなたは教育専門家です。提供された講義資料の内容のみを扱い、抽象的なメタ情報を含まない、具体的な主題を記述した深さ6以上の巨大ツリー構造ノード（KGNode）を生成してください。各ノードの説明文は、「～について解説」や「～について記述」、「～を説明」のような語尾ではなく、単に講義資料に書かれている内容だけを述べるだけにしなさい。また、各ノードのdescriptionは講義資料の内容に基づいて極力詳細にせよ（descriptionは必ず3文以上にせよ）。"},
@@ -207,8 +382,7 @@ class KnowledgeTreeGenerator:
             temperature=0.0
         )
         try:
-            # Structured Outputsで解析されたKGNodeモデルを取得
-            knowledge_tree = response.choices[0].message.parsed
+            # Structured Outputsで解析されたKGNodeモデル
             if knowledge_tree:
                 # PydanticモデルをDictに変換（このdictが新しいルート構造となる）
                 return knowledge_tree.model_dump()
@@ -235,7 +409,7 @@ class KnowledgeTreeGenerator:
             level=level,
             order=order
         )
-        node.related_chunks.set(tree_data.get('related_chunks', []))
+        self.chunk_hints[node.id] = tree_data.get('related_chunks') or []
         
         for i, child_data in enumerate(tree_data.get('children', [])):
             child_data['order'] = i
@@ -243,47 +417,261 @@ class KnowledgeTreeGenerator:
         
         return node
 
-@shared_task # 新しい Celery タスクとして定義
-def generate_knowledge_tree_task(result_tuple):
-    """知識ツリーを生成し、教材を更新する"""
-    
-    material_id, chunks_with_embeddings = result_tuple
+@shared_task(ignore_result=True)
+def page_failed_task(request, exc, traceback, material_id, page_number, first_page=None):
+    """ページの分析・埋め込みが失敗しても、そのページを処理済みとして数えて残りのページでツリーを生成する"""
+    print(f"[pipeline] material {material_id} page {page_number} failed: {exc}", file=sys.stderr)
+    finish_page(material_id, page_number, first_page)
+
+def page_pipeline(material_id, span):
+    """1 グループ分の Step A: ページ分析 -> Step B: チャンク化と Embedding 生成（失敗しても処理済みとして数える）"""
+    return chain(
+        analyze_page_task.s(material_id, span[-1]),
+        PDFProcessor.chunk_and_embed_page_task.s(material_id, first_page=span[0])
+    ).on_error(page_failed_task.s(material_id, span[-1], span[0]))
+
+def finish_page(material_id, page_number, first_page=None):
+    """分析済みページ数を原子的に増やし（まとめて分析したページは first_page〜page_number の分）、
+    最後のページであればチャンクの番号を振り直してツリー生成を始める"""
+    pages = page_number - (first_page or page_number) + 1
+    with transaction.atomic():
+        LearningMaterial.objects.filter(id=material_id).update(pages_analyzed=F('pages_analyzed') + pages)
+        pages_analyzed, pages_total = LearningMaterial.objects.filter(id=material_id).values_list('pages_analyzed', 'pages_total').get()
+    print(f"[pipeline] material {material_id}: page {page_number} ({pages_analyzed}/{pages_total})", file=sys.stderr)
+    if pages_analyzed != pages_total: # 更新で行がロックされるので、ちょうど総ページ数に達するのは最後のページのタスクだけ
+        return False
+    renumber_chunks(material_id)
+    tree_workflow(material_id).apply_async()
+    return True
+
+def renumber_chunks(material_id):
+    """ページ順・ページ内の順に chunk_index を通し番号に振り直す（ツリー生成のプロンプトと関連チャンクの手がかりで使う）"""
+    chunks = list(DocumentChunk.objects.filter(learning_material_id=material_id).order_by('page_number', 'chunk_index', 'id').only('id', 'chunk_index'))
+    for index, chunk in enumerate(chunks):
+        chunk.chunk_index = index
+    DocumentChunk.objects.bulk_update(chunks, ['chunk_index'], batch_size=1000)
+    return len(chunks)
+
+def tree_workflow(material_id):
+    """全ページのチャンクがそろったあとの処理"""
+    return chain(
+        generate_knowledge_tree_task.s(material_id), # Step C: 知識ツリー生成とDB更新
+        generate_node_summaries_task.s(),            # Step D: ノードの要旨・要約の生成（多数のノードを並べるプロンプトを短くするため）
+        generate_rubrics_task.s(),                   # Step E: 採点基準の抽出（明らかな合格・不合格の回答で LLM の評価を省略するため）
+        generate_question_pool_task.s()              # Step F: 質問プールの事前生成（インタビュー中の質問生成を DB の読み出しで済ませるため）
+    )
+
+@shared_task(bind=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES']) # 新しい Celery タスクとして定義
+def generate_knowledge_tree_task(self, material_id):
+    """保存済みのチャンクから知識ツリーを生成し、教材を更新する
+
+    ツリー生成の呼び出しはノードを作る前なので、一時的なエラー・枠待ちは Celery の countdown 付きで再試行する。
+    """
     
     material = LearningMaterial.objects.get(id=material_id)
+    chunks = list(DocumentChunk.objects.filter(learning_material=material).order_by('chunk_index').values('chunk_index', 'content'))
     tree_generator = KnowledgeTreeGenerator()
     
     # 知識ツリーを生成
-    tree_data = tree_generator.generate_knowledge_tree(chunks_with_embeddings, material.title)
+    try:
+        tree_data = tree_generator.generate_knowledge_tree(chunks, material.title)
+    except retryable_errors() as e:
+        raise retry_task(self, e, material_id)
     print("[DEBUG] tree_data:", tree_data, file=sys.stderr)
     # 知識ノードを作成
     root_node = tree_generator.create_knowledge_nodes(tree_data)
+    # ノードの埋め込みをまとめて生成（関連度判定・網羅チェック・説明分析で使う）
+    build_node_embeddings(root_node)
+    # ノードと関連チャンクの対応を埋め込みの類似度で決める
+    link_related_chunks(root_node, material, hints=tree_generator.chunk_hints)
     
     # 教材を更新
     material.root_node = root_node
     material.processed = True
     material.save()
+    # ページ画像・分析結果はチャンクとして DB に保存済みなので削除する
+    ArtifactStore(material_id).cleanup()
     
     return material.id
 
+@shared_task
+def generate_node_summaries_task(material_id):
+    """知識ツリーの全ノードの要旨・要約を、数十ノードずつのバッチで並列に生成する"""
+    material = LearningMaterial.objects.get(id=material_id)
+    if material.root_node is None:
+        return material_id
+    node_ids = [node.id for node in tree_nodes(material.root_node)]
+    batch_size = settings.NODE_SUMMARY_BATCH_SIZE
+    group(summarize_nodes_task.s(node_ids[i:i + batch_size], material_id) for i in range(0, len(node_ids), batch_size)).apply_async()
+    return material_id
+
+@shared_task(bind=True, ignore_result=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES'])
+def summarize_nodes_task(self, node_ids, material_id=None):
+    """1 バッチ分のノードの要旨・要約を生成する（一時的なエラー・枠待ちは Celery の countdown 付きで再試行）"""
+    try:
+        return NodeSummarizer().summarize(KnowledgeNode.objects.filter(id__in=node_ids))
+    except retryable_errors() as e:
+        raise retry_task(self, e, material_id)
+
+@shared_task
+def generate_rubrics_task(material_id):
+    """知識ツリーの全ノードについて、採点基準の抽出をノードごとに並列で開始する"""
+    material = LearningMaterial.objects.get(id=material_id)
+    if not settings.RUBRIC.get('ENABLED', True) or material.root_node is None:
+        return material_id
+    nodes = tree_nodes(material.root_node)
+    group(generate_node_rubric_task.s(node.id, material_id) for node in nodes).apply_async()
+    return material_id
+
+@shared_task(bind=True, ignore_result=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES'])
+def generate_node_rubric_task(self, node_id, material_id=None):
+    """1 ノード分の採点基準を抽出する（一時的なエラー・枠待ちは Celery の countdown 付きで再試行）"""
+    node = KnowledgeNode.objects.get(id=node_id)
+    try:
+        rubric = RubricGenerator().generate(node)
+    except retryable_errors() as e:
+        raise retry_task(self, e, material_id)
+    return rubric is not None
+
+@shared_task(ignore_result=True)
+def generate_question_pool_task(material_id):
+    """知識ツリーの全ノードについて、質問プールの生成をノードごとに並列で開始する"""
+    material = LearningMaterial.objects.get(id=material_id)
+    if not settings.QUESTION_POOL.get('ENABLED', True) or material.root_node is None:
+        return material_id
+    nodes = tree_nodes(material.root_node)
+    group(generate_node_question_pool_task.s(node.id, material_id) for node in nodes).apply_async()
+    return material_id
+
+@shared_task(bind=True, ignore_result=True, max_retries=settings.PIPELINE_RETRY['MAX_RETRIES'])
+def generate_node_question_pool_task(self, node_id, material_id=None):
+    """1 ノード分の質問プールを生成する（一時的なエラー・枠待ちは Celery の countdown 付きで再試行）"""
+    node = KnowledgeNode.objects.get(id=node_id)
+    try:
+        count = QuestionPoolGenerator().generate(node)
+    except retryable_errors() as e:
+        raise retry_task(self, e, material_id)
+    print(f"[question pool] {node.title}: {count} 問", file=sys.stderr)
+    return count
+
+@shared_task
+def render_pages_task(material_id, first_page, last_page):
+    """ページ範囲 [first_page, last_page] を画像化して ArtifactStore に置き、画像化できたページ番号を返す
+
+    タスクごとに PDF を開き直すので、ページ範囲ごとのタスクは別々のワーカープロセスで並列に動く。
+    アニメーションの途中経過のページを見分けるための縮小画像とテキスト層の単語（thumbs）と、
+    テキスト・図の領域のレイアウト（layout / figures）も一緒に置く。
+    """
+    import fitz  # PyMuPDF（教材処理のワーカーでだけ読み込む）
+    material = LearningMaterial.objects.get(id=material_id)
+    processor = PDFProcessor()
+    store = ArtifactStore(material_id)
+    rendered = []
+    started = time.monotonic()
+    doc = fitz.open(material.file_path.path)
+    try:
+        for page_num in range(first_page, last_page + 1):
+            try:
+                page = doc[page_num - 1]
+                store.save('pages', page_name(page_num, 'png'), processor._render_page_to_image(page))
+                rendered.append(page_num)
+            except Exception as e: # 壊れたページがあっても残りのページは処理する
+                print(f"[pipeline] material {material_id} page {page_num} render error: {e}", file=sys.stderr)
+                continue
+            # 縮小画像が取れないページは単独のグループ、レイアウトが取れないページはページ全体の画像で分析する
+            # （画像化できたページはどちらに失敗しても分析する）
+            if settings.SLIDE_DEDUP.get('ENABLED', True):
+                try:
+                    thumbnail, words = page_thumbnail(page), page_words(page)
+                    store.save('thumbs', page_name(page_num, 'bin'), thumbnail)
+                    store.save('thumbs', page_name(page_num, 'json'), json.dumps(words, ensure_ascii=False))
+                except Exception as e:
+                    print(f"[pipeline] material {material_id} page {page_num} thumbnail error: {e}", file=sys.stderr)
+            if settings.PAGE_LAYOUT.get('ENABLED', True):
+                try:
+                    save_page_layout(store, page_num, page)
+                except Exception as e:
+                    print(f"[pipeline] material {material_id} page {page_num} layout error: {e}", file=sys.stderr)
+    finally:
+        doc.close()
+    print(f"[pipeline] material {material_id}: pages {first_page}-{last_page} rendered ({(time.monotonic() - started) * 1000:.0f}ms)", file=sys.stderr)
+    return rendered
+
+@shared_task(ignore_result=True)
+def dispatch_pages_task(rendered, material_id):
+    """すべてのページ範囲の画像化が終わったら、ページごとの分析・埋め込みのワークフローを始める"""
+    pages = sorted(page_number for page_numbers in rendered for page_number in page_numbers)
+    LearningMaterial.objects.filter(id=material_id).update(pages_total=len(pages), pages_analyzed=0)
+    if not pages:
+        print(f"[pipeline] material {material_id}: 画像化できたページがありません", file=sys.stderr)
+        return
+    
+    # アニメーションの途中経過のページをまとめ、各グループの最後のページ（前のページの内容をすべて含む）だけを分析する
+    store = ArtifactStore(material_id)
+    page_groups = [[page_number] for page_number in pages]
+    if settings.SLIDE_DEDUP.get('ENABLED', True):
+        thumbnails = {
+            page_number: store.load_bytes('thumbs', page_name(page_number, 'bin'))
+            for page_number in pages if store.exists('thumbs', page_name(page_number, 'bin'))
+        }
+        words = {
+            page_number: json.loads(store.load_text('thumbs', page_name(page_number, 'json')))
+            for page_number in thumbnails if store.exists('thumbs', page_name(page_number, 'json'))
+        }
+        page_groups = group_build_pages(pages, thumbnails, words)
+        print(f"[pipeline] material {material_id}: {len(pages)} ページ -> {len(page_groups)} 回の分析 "
+              f"{[f'{span[0]}-{span[-1]}' for span in page_groups if len(span) > 1]}", file=sys.stderr)
+    
+    # ページ全体の画像で分析する小さなページ（情報量の少ないスライド）は、見積もりトークン数の上限まで 1 回の呼び出しにまとめる
+    singles, candidates = [], []
+    for span in page_groups:
+        path = store.path('pages', page_name(span[-1], 'png'))
+        size = None
+        if (
+            settings.PAGE_BATCH.get('ENABLED', True)
+            and not store.exists('layout', page_name(span[-1], 'json')) # レイアウトのあるページは図だけを分析する
+            and path.stat().st_size <= settings.PAGE_BATCH.get('SMALL_PAGE_BYTES', 250000)
+        ):
+            with open(path, 'rb') as f:
+                size = png_size(f.read(24))
+        if size:
+            candidates.append(([span[0], span[-1]], estimate_image_tokens(*size)))
+        else:
+            singles.append(span)
+    batches = []
+    for batch in pack_page_batches(candidates):
+        if len(batch) > 1:
+            batches.append(batch)
+        else:
+            singles.extend(batch)
+    if batches:
+        print(f"[pipeline] material {material_id}: まとめて分析するページ {[[span[-1] for span in batch] for batch in batches]}", file=sys.stderr)
+    
+    # 各ページ: Step A: ページ分析 -> Step B: チャンク化と Embedding 生成（分析が終わったページから順に保存する）
+    # 最後のページの Step B が tree_workflow()（Step C 以降）を始める
+    group(
+        [page_pipeline(material_id, span) for span in singles]
+        + [analyze_pages_batch_task.s(material_id, batch).on_error(batch_failed_task.s(material_id, batch)) for batch in batches]
+    ).apply_async()
+
+def page_ranges(page_count, pages_per_task):
+    """1..page_count を pages_per_task ページずつの (最初のページ, 最後のページ) に分ける"""
+    return [(first, min(first + pages_per_task - 1, page_count)) for first in range(1, page_count + 1, pages_per_task)]
+
+
 class MaterialProcessor:
     """教材処理の統合クラス"""
     
-    @shared_task # 外部からのトリガー用タスク
+    @shared_task(ignore_result=True) # 外部からのトリガー用タスク
     def start_processing_workflow(material_id):
         """教材処理の非同期ワークフロー全体を開始する"""
         
-        # 1. PDFから画像抽出（この部分はまだ同期的にメインプロセスで実行）
+        # 1. ページ数だけを数える（画像化はページ範囲ごとのタスクで並列に行う）
         try:
             material = LearningMaterial.objects.get(id=material_id)
-            file_path = material.file_path.path
-            
-            # PDFページを画像化
-            pages = []
-            doc = fitz.open(file_path)
-            processor = PDFProcessor()
-            for page_num, page in enumerate(doc, start=1):
-                img_data = processor._render_page_to_image(page)
-                pages.append({'page_number': page_num, 'image': img_data})
+            import fitz  # PyMuPDF（教材処理のワーカーでだけ読み込む）
+            doc = fitz.open(material.file_path.path)
+            page_count = doc.page_count
             doc.close()
             
         except Exception as e:
@@ -292,30 +680,20 @@ class MaterialProcessor:
             raise e
 
         # 2. Celery ワークフローの構築
-        # Step A: ページ分析 (並列) -> Step B: 結果収集 (コールバック)
-        page_analysis_group = group(analyze_page_task.s(page['page_number'], page['image']) for page in pages) # 各ページに対して非同期タスクを作成して group でまとめて並列処理
-        
-        # Step C: チャンク化とEmbedding生成 (material_id を引数に追加)
-        chunk_embed_task = PDFProcessor.chunk_and_embed_task.s(material_id) 
-        
-        # Step D: 知識ツリー生成とDB更新
-        tree_gen_task = generate_knowledge_tree_task.s()
-
-        # 3. ワークフローの実行 (chord -> chain)
-        workflow = chain(
-            chord(page_analysis_group, collect_pages_result.s()), # A -> B (Pages_Text を生成)
-            chunk_embed_task,                                     # B の結果を C に渡す (Chunks_With_Embeddings を生成)
-            tree_gen_task                                         # C の結果を D に渡す (最終更新)
+        # ページ範囲ごとに画像化 -> すべて終わったら dispatch_pages_task がページごとの分析・埋め込みを始める
+        LearningMaterial.objects.filter(id=material_id).update(pages_total=0, pages_analyzed=0)
+        ranges = page_ranges(page_count, max(1, settings.PAGE_RENDER.get('PAGES_PER_TASK', 8)))
+        workflow = chord(
+            (render_pages_task.s(material_id, first, last) for first, last in ranges),
+            dispatch_pages_task.s(material_id)
         )
         
-        # ワークフローを開始
+        # 3. ワークフローの実行
         workflow.apply_async()
         
         return f"Material {material_id} processed successfully"
 
-###
-### 新しく追加しました！！views.py で使用するクラスです！！
-###
+
 class InterviewOrchestrator:
     """インタビューの進行を管理するクラス"""
     
@@ -324,21 +702,53 @@ class InterviewOrchestrator:
     def __init__(self, material_id):
         try:
             self.material = LearningMaterial.objects.get(id=material_id)
-            self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
-            self.model = "gpt-4o-2024-11-20"
+            self.llm = LLMClient()
+            self.question_pool = QuestionPool(self.llm)
+            self.rubric_scorer = RubricScorer(self.llm)
+            self.retriever = ContextRetriever(self.llm)
         except LearningMaterial.DoesNotExist:
             raise ValueError("指定された教材が見つかりません")
     
-    def determine_next_step(self, user_answer, current_node_id, uncleared_node_ids, current_question=None, consec_fail_count=0, socratic_stage=1, full_history=[]):
+    def clear_explained_nodes(self, explanation, uncleared_node_ids, segment_vectors=None):
+        """説明フェーズの発話ですでに説明された葉ノードを、質問を始める前にまとめてクリアする"""
+        if not settings.COVERAGE_PREPASS.get('ENABLED', True) or not explanation:
+            return []
+        try:
+            with span('coverage'):
+                covered_ids = ExplanationCoverage(self.material.root_node, self.llm).covered_leaves(explanation, uncleared_node_ids, segment_vectors)
+        except Exception as e: # 事前のクリアは省略しても質問フェーズで拾えるので、失敗してもインタビューは続ける
+            print(f"[coverage] error: {e}", file=sys.stderr)
+            return []
+        for node_id in covered_ids:
+            if node_id in uncleared_node_ids:
+                uncleared_node_ids.remove(node_id)
+                print("# 説明済みのためクリア", KnowledgeNode.objects.get(id=node_id).title, file=sys.stderr)
+        return covered_ids
+
+    def prepare_first_step(self, explanation, segment_vectors=None):
+        """説明フェーズの最初の呼び出しで行う網羅チェックと最初の移動先の決定を、説明の途中で先に済ませておく"""
+        root_node = self.material.root_node
+        uncleared_node_ids = [node.id for node in tree_nodes(root_node)]
+        self.clear_explained_nodes(explanation, uncleared_node_ids, segment_vectors)
+        uncleared_node_ids.remove(root_node.id)
+        next_node = self._shift_next_node(explanation, root_node, uncleared_node_ids, [])
+        return {'uncleared_node_ids': uncleared_node_ids, 'next_node_id': next_node.id if next_node else None}
+
+    def determine_next_step(self, user_answer, current_node_id, uncleared_node_ids, current_question=None, consec_fail_count=0, socratic_stage=1, full_history=[], prepared_node_id=None):
         
         current_node = KnowledgeNode.objects.get(id=current_node_id)
 
         if current_question is None: # 初回は回答評価はせず、回答に関連するノードに進む処理だけを行う
             print("# 初回", file=sys.stderr)
             uncleared_node_ids.remove(current_node.id) # ルートノードは真っ先にクリアにしてしまう
-            next_node = self._shift_next_node(user_answer, current_node, uncleared_node_ids, full_history)
+            with span('route'):
+                if prepared_node_id is not None: # 説明フェーズの途中で先に決めておいた移動先を使う
+                    next_node = KnowledgeNode.objects.get(id=prepared_node_id)
+                else:
+                    next_node = self._shift_next_node(user_answer, current_node, uncleared_node_ids, full_history)
         else: # 初回以外はまず回答を評価する
-            evaluation = self._evaluate_answer(current_node, current_question, user_answer)
+            with span('evaluate'):
+                evaluation = self._evaluate_answer(current_node, current_question, user_answer, socratic_stage)
             if evaluation >= 3: # 5段階評価で3以上であればリメディアル終了、または次のソクラテス段階に進む、またはすでに最終段階であればそのノードはクリアして次のノードに移動
                 if consec_fail_count > 0: #（段階を問わず）リメディアル質問に正解した場合
                     print(f"# 評価値: {evaluation}（リメディアルから脱出）", file=sys.stderr)
@@ -356,31 +766,34 @@ class InterviewOrchestrator:
                     if current_node.id in uncleared_node_ids:
                         uncleared_node_ids.remove(current_node.id)
                     print("[DEBUG] 省略審査開始", file=sys.stderr)
-                    while True: # スキップ可能な限り（未クリアの子ノードの数が 1 であり、かつそのノードの内容をすでに発話している場合）はどんどん先に進む
-                        print("")
-                        uncleared_child = []
-                        for child in current_node.children.all():
-                            if child.id in uncleared_node_ids:
-                                uncleared_child.append(child)
-                        print("[DEBUG] 省略前の現在地:", current_node.title, "( 未クリアの子ノード数:", len(uncleared_child), ")", file=sys.stderr)
-                        if len(uncleared_child) == 1:
-                            child = current_node.children.get(id=uncleared_child[0].id)
-                            if self._can_skip_child(child, full_history):
-                                # 子ノードをクリアにして現在地を進める
-                                uncleared_node_ids.remove(child.id)
-                                print("# 省略", child.title, file=sys.stderr)
-                                current_node = child
-                                print("[DEBUG] 省略後の現在地:", current_node.title, file=sys.stderr)
+                    with span('skip_review'):
+                        while True: # スキップ可能な限り（未クリアの子ノードの数が 1 であり、かつそのノードの内容をすでに発話している場合）はどんどん先に進む
+                            print("")
+                            uncleared_child = []
+                            for child in current_node.children.all():
+                                if child.id in uncleared_node_ids:
+                                    uncleared_child.append(child)
+                            print("[DEBUG] 省略前の現在地:", current_node.title, "( 未クリアの子ノード数:", len(uncleared_child), ")", file=sys.stderr)
+                            if len(uncleared_child) == 1:
+                                child = current_node.children.get(id=uncleared_child[0].id)
+                                if self._can_skip_child(child, full_history):
+                                    # 子ノードをクリアにして現在地を進める
+                                    uncleared_node_ids.remove(child.id)
+                                    print("# 省略", child.title, file=sys.stderr)
+                                    current_node = child
+                                    print("[DEBUG] 省略後の現在地:", current_node.title, file=sys.stderr)
+                                else:
+                                    break
                             else:
                                 break
-                        else:
-                            break
                     print("[DEBUG] 省略審査終了", file=sys.stderr)
                     
                     print("[DEBUG] 剪定審査開始", file=sys.stderr)
-                    self._skip_sibling(current_node, uncleared_node_ids, full_history)
+                    with span('prune'):
+                        self._skip_sibling(current_node, uncleared_node_ids, full_history)
                     print("[DEBUG] 剪定審査終了", file=sys.stderr)
-                    next_node = self._shift_next_node(user_answer, current_node, uncleared_node_ids, full_history) # 全ノードクリアした場合は None が返る
+                    with span('route'):
+                        next_node = self._shift_next_node(user_answer, current_node, uncleared_node_ids, full_history) # 全ノードクリアした場合は None が返る
                 if next_node is None: # ツリーをすべて網羅した場合
                     print("# すべてクリア", file=sys.stderr)
                     return {'status': 'interview_completed'}
@@ -391,7 +804,8 @@ class InterviewOrchestrator:
         print("# 現在地:", next_node.title, "/", next_node.description, file=sys.stderr)
         
         # 質問生成
-        next_question = self._generate_question(next_node, socratic_stage, consec_fail_count, full_history)
+        with span('generate'):
+            next_question = self._generate_question(next_node, socratic_stage, consec_fail_count, full_history)
         print(f"# 質問（第{socratic_stage}段階 - 連続失敗回数: {consec_fail_count}）: {next_question}", file=sys.stderr)
         return {
             'interview_next_question': next_question,
@@ -413,9 +827,10 @@ class InterviewOrchestrator:
 
     # 未クリアで（current_node は参照渡しなので関数内で変更されうる）
     def _can_skip_child(self, child: KnowledgeNode, full_history: list):
-        history_text = ""
-        for history in full_history:
-            history_text += f"  [Q] {history['question']}\n  [A] {history['answer']}"
+        sections = PromptBuilder('can_skip_child').section(
+            'history', [f"  [Q] {history['question']}\n  [A] {history['answer']}" for history in full_history], keep='tail' # 直近のやり取りを優先
+        ).section('topic', f"{child.title}: {child.description}", priority=1).build()
+        history_text = sections['history']
         
         prompt = f"""
         あなたは {child.get_root().title} の専門家です。学習者の回答履歴に基づき、{child.title} にすでに言及されているか、そうでないかを判断してください。
@@ -424,25 +839,26 @@ class InterviewOrchestrator:
         {history_text}
         
         ■ トピック:
-        {child.title}: {child.description}
+        {sections['topic']}
                 
         ■ 判定基準
         - 回答履歴が当該トピックの説明に言及されている場合 → true
         - 触れていない場合 → false
 
         ■ 出力形式 (JSON):
-        {{"is_sufficient": true または false}}
+        {{"is_sufficient": true または false, "confidence": 判定の確信度 (0.0~1.0)}}
         """
-        response = self.openai_client.chat.completions.create(
-            model=self.model,
+        response = self.llm.chat(
+            'can_skip_child',
             messages=[
                 {"role": "system", "content": "あなたは回答履歴を分析し、トピックに言及されているかをtrue/falseで返します。"},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"},
-            temperature=0.0
+            temperature=0.0,
+            validator=json_validator('is_sufficient')
         )
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(response)
         print("       ", result['is_sufficient'], file=sys.stderr)
         return result['is_sufficient']
 
@@ -451,11 +867,13 @@ class InterviewOrchestrator:
         uncleared_sibling_nodes = [node for node in current_node.get_siblings() if node.id in uncleared_node_ids and not node.children.exists()] # 未クリアの兄弟ノードで葉ノードである（子を持たない）ノードのリスト
         if not uncleared_sibling_nodes:
             return
-        nodes_to_compare = "\n".join([f"- ID {node.id}: {node.title} / {node.description}" for node in uncleared_sibling_nodes])
-
-        history_text = ""
-        for history in full_history:
-            history_text += f"  [Q] {history['question']}\n  [A] {history['answer']}"
+        sections = PromptBuilder('skip_sibling').section(
+            'history', [f"  [Q] {history['question']}\n  [A] {history['answer']}" for history in full_history], keep='tail' # 直近のやり取りを優先
+        ).section(
+            'topics', [f"- ID {node.id}: {node.title} / {node.brief('summary')}" for node in uncleared_sibling_nodes], priority=1
+        ).build()
+        nodes_to_compare = sections['topics']
+        history_text = sections['history']
         
         prompt = f"""
         あなたは知識の剪定師です。学習者の回答履歴に基づき、以下のトピックのうち、すでに明言されているものがあればその ID を列挙してください。
@@ -473,16 +891,17 @@ class InterviewOrchestrator:
         ■ 出力形式 (JSON):
         {{"pruned_ids": [10, 15, 22, ...]}}
         """
-        response = self.openai_client.chat.completions.create(
-            model=self.model,
+        response = self.llm.chat(
+            'skip_sibling',
             messages=[
                 {"role": "system", "content": "あなたは回答履歴を分析し、カバー済みのトピックIDのみをJSON配列で返します。"},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"},
-            temperature=0.0
+            temperature=0.0,
+            validator=json_validator('pruned_ids')
         )
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(response)
         pruned_ids = result.get('pruned_ids', [])
 
         for node_id in pruned_ids:
@@ -490,33 +909,42 @@ class InterviewOrchestrator:
             print("# 剪定", KnowledgeNode.objects.get(id=node_id).title, file=sys.stderr)
 
     # 回答をノードと照らし合わせて評価する関数
-    def _evaluate_answer(self, current_node: KnowledgeNode, question_text: str, answer_text: str) -> int:
+    def _evaluate_answer(self, current_node: KnowledgeNode, question_text: str, answer_text: str, socratic_stage: int = 1) -> int:
         """
         LLMを使用して、質問に対する回答を評価する
+        採点基準で明らかな合格・不合格と判定できる回答は LLM を呼ばない
         """
+        verdict, detail = self.rubric_scorer.prescore(current_node, answer_text, socratic_stage)
+        print(f"[DEBUG] 事前採点: {verdict} {detail}", file=sys.stderr)
+        if verdict == 'fail':
+            return 1
+        if verdict == 'pass':
+            return 4
+        sections = PromptBuilder('evaluate_answer').section('question', question_text, priority=1).section('answer', answer_text).build()
         prompt = f"""
         あなたは {current_node.get_root().title} の専門家です。{current_node.title} に関する質問に対する学習者の回答を評価し、5段階評価（1~5）してください。
 
         ■ 質問
-        {question_text}
+        {sections['question']}
 
         ■ 学習者の回答
-        {answer_text}
+        {sections['answer']}
 
         ■ 5段階評価: 1（質問と無関係の回答；または誤った回答）～5（質問に対する回答として適切）
         
         ■ 出力形式 (JSON): {{"evaluation": (int)}}
         """
-        response = self.openai_client.chat.completions.create(
-            model=self.model,
+        response = self.llm.chat(
+            'evaluate_answer',
             messages=[
                 {"role": "system", "content": "あなたは回答を評価する教育専門家です。質問内容に忠実な回答かを5段階評価してください。"},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"},
-            temperature=0.0
+            temperature=0.0,
+            validator=json_validator('evaluation', allowed={'evaluation': [1, 2, 3, 4, 5]})
         )
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(response)
         return int(result.get('evaluation', 0))
 
     ###
@@ -558,32 +986,37 @@ class InterviewOrchestrator:
 
     # 与えられた 2 つのノードのうち、学習者の回答により関連するほうを返す
     def _compare_relevance(self, user_answer: str, a: KnowledgeNode, b: KnowledgeNode) -> KnowledgeNode:
+        # 最初のターンでは回答は説明フェーズの説明文全体になり、トーナメントの比較ごとに繰り返し送られるので予算内に収める
+        sections = PromptBuilder('compare_relevance').section('answer', user_answer).section(
+            'option_a', a.brief('summary'), priority=1
+        ).section('option_b', b.brief('summary'), priority=1).build()
         prompt = f"""
         あなたは学習者の回答を分析する専門家です。以下の学習者の回答に対し、オプションAとオプションBのどちらが関連性が高いか判断してください。
 
-        ■ 学習者の回答: {user_answer}
+        ■ 学習者の回答: {sections['answer']}
 
         ■ オプションA
         タイトル: {a.title}
-        説明: {a.description}
+        説明: {sections['option_a']}
 
         ■ オプションB
         タイトル: {b.title}
-        説明: {b.description}
+        説明: {sections['option_b']}
 
         ■ 出力形式 (JSON):
-        {{"option": (A or B)}}
+        {{"option": (A or B), "confidence": 判定の確信度 (0.0~1.0)}}
         """
-        response = self.openai_client.chat.completions.create(
-            model=self.model,
+        response = self.llm.chat(
+            'compare_relevance',
             messages=[
                 {"role": "system", "content": "あなたは、提示された2つのオプションを比較し、学習者の回答と関連性の高いほうの選択肢をJSONで返します。"},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"},
-            temperature=0.0 # 比較・分類タスクは 0.0 が望ましい
+            temperature=0.0, # 比較・分類タスクは 0.0 が望ましい
+            validator=json_validator('option', allowed={'option': ['A', 'B']})
         )
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(response)
         if result['option'] == 'A':
             print(f"- {a.title} > {b.title}", file=sys.stderr)
         elif result['option'] == 'B':
@@ -627,26 +1060,27 @@ class InterviewOrchestrator:
         next_node = self._find_matching_uncleared_child(user_answer, current_node, uncleared_node_ids) # 直下の未クリアの子ノードの中から最も関連するノードを探す
         print("[DEBUG] _find_uncleared_other_node() 内部", file=sys.stderr)
         print("[DEBUG] 省略審査開始", file=sys.stderr)
-        while True: # スキップ可能な限り（未クリアの子ノードの数が 1 であり、かつそのノードの内容をすでに発話している場合）はどんどん先に進む
-            print("")
-            print("[DEBUG] 省略前の現在地:", next_node.title, file=sys.stderr)
-            uncleared_child = []
-            for child in next_node.children.all():
-                if child.id in uncleared_node_ids:
-                    uncleared_child.append(child)
-            print("[DEBUG] 未クリアの子ノード数:", len(uncleared_child), file=sys.stderr)
-            if len(uncleared_child) == 1:
-                child = next_node.children.get(id=uncleared_child[0].id)
-                if self._can_skip_child(child, full_history):
-                    # 子ノードをクリアにして現在地を進める
-                    uncleared_node_ids.remove(child.id)
-                    print("# 省略", child.title, file=sys.stderr)
-                    next_node = child
-                    print("[DEBUG] 省略後の現在地:", next_node.title, file=sys.stderr)
+        with span('skip_review'):
+            while True: # スキップ可能な限り（未クリアの子ノードの数が 1 であり、かつそのノードの内容をすでに発話している場合）はどんどん先に進む
+                print("")
+                print("[DEBUG] 省略前の現在地:", next_node.title, file=sys.stderr)
+                uncleared_child = []
+                for child in next_node.children.all():
+                    if child.id in uncleared_node_ids:
+                        uncleared_child.append(child)
+                print("[DEBUG] 未クリアの子ノード数:", len(uncleared_child), file=sys.stderr)
+                if len(uncleared_child) == 1:
+                    child = next_node.children.get(id=uncleared_child[0].id)
+                    if self._can_skip_child(child, full_history):
+                        # 子ノードをクリアにして現在地を進める
+                        uncleared_node_ids.remove(child.id)
+                        print("# 省略", child.title, file=sys.stderr)
+                        next_node = child
+                        print("[DEBUG] 省略後の現在地:", next_node.title, file=sys.stderr)
+                    else:
+                        break
                 else:
                     break
-            else:
-                break
         print("[DEBUG] 省略審査終了", file=sys.stderr)
         return next_node
 
@@ -654,17 +1088,19 @@ class InterviewOrchestrator:
     ### ソクラテス式の質問を生成する関数！！！
     ###
     def _generate_question(self, current_node, socratic_stage, consec_fail_count, full_history):
-        lecture_content = ""
+        # 事前生成した質問があればそれを使う（なければ以下でその場で生成する）
+        asked_questions = [history['question'] for history in full_history if history['node_id'] == current_node.id]
+        pooled_question = self.question_pool.pick(current_node, socratic_stage, consec_fail_count > 0, asked_questions)
+        if pooled_question:
+            print("[DEBUG] 質問プールから出題", file=sys.stderr)
+            return self.question_pool.personalize(pooled_question, full_history[-1] if full_history else None)
+
+        related_chunks = []
         if not current_node.children.exists(): # 葉ノードであれば、そのノードに関連するチャンクから質問を生成（具体的な内容が講義資料に書いてあるはずだから）
             print("[DEBUG] 葉ノードに到達したので講義資料の具体的な記述から質問を生成", file=sys.stderr)
-            related_chunks = current_node.chunks.all() # 関連するチャンク（knowledge_tree/models.py の DocumentChunk モデルへの逆参照）
+            last_answer = full_history[-1]['answer'] if full_history else None
+            related_chunks = self.retriever.select(current_node, last_answer) # 関連するチャンクのうち、ノードと直前の回答に近いものをトークン予算内で選ぶ
             print("     >> 関連するチャンク:", related_chunks, file=sys.stderr)
-            if related_chunks:
-                lecture_content = "■ 講義資料の抜粋:\n"
-                for chunk in related_chunks:
-                    lecture_content += f"- {chunk.content}\n"
-            print("       ", lecture_content, file=sys.stderr)
-            lecture_content += "# 指示: 必ず上記の「講義資料の抜粋」に含まれる情報だけを元に質問を作成してください。"
         
         if socratic_stage == 1:
             system_message = "提供された資料に基づき、トピックの定義や主要な事実、専門用語を答えさせる質問を作成してください。"
@@ -678,11 +1114,19 @@ class InterviewOrchestrator:
         else:
             print("やばい", file=sys.stderr)
         
-        # このノードでの履歴だけを取り出す  
-        node_history = ""
-        for history in full_history:
-            if history['node_id'] == current_node.id:
-                node_history += f"\n  [Q] {history['question']}\n  [A] {history['answer']}"
+        # このノードでの履歴だけを取り出し、抜粋・履歴・概要をそれぞれの予算に収める（履歴は直近を優先）
+        sections = PromptBuilder('generate_question').section(
+            'excerpts', [f"- {chunk.content}" for chunk in related_chunks], priority=1
+        ).section(
+            'history', [f"\n  [Q] {history['question']}\n  [A] {history['answer']}" for history in full_history if history['node_id'] == current_node.id], keep='tail', separator=""
+        ).section('description', current_node.description, priority=2).build()
+        node_history = sections['history']
+        lecture_content = ""
+        if not current_node.children.exists():
+            if sections['excerpts']:
+                lecture_content = "■ 講義資料の抜粋:\n" + sections['excerpts'] + "\n"
+            print("       ", lecture_content, file=sys.stderr)
+            lecture_content += "# 指示: 必ず上記の「講義資料の抜粋」に含まれる情報だけを元に質問を作成してください。"
 
         print('================================================================================', file=sys.stderr)
         print("# このノードでの質問応答履歴:", node_history, file=sys.stderr)
@@ -691,7 +1135,7 @@ class InterviewOrchestrator:
         prompt = f"""
         あなたは {current_node.get_root().title} の専門家です。以下の情報に基づいて {current_node.title} に関する {question_type} を生成してください。特に、これまでの質問応答の流れを意識した質問を生成してください。
 
-        ■ 概要: {current_node.description}
+        ■ 概要: {sections['description']}
         
         {lecture_content}
 
@@ -711,8 +1155,8 @@ class InterviewOrchestrator:
             system_message += f"\nあなたは教育専門家です。学習者は {consec_fail_count} 回連続で回答に失敗しています。過去の質問とは「異なる視点」や「より簡単なレベル」の質問を生成してください。ただし、過去、特に直前のやり取りに基づいた応答にしてください。"
         
         # AIに質問生成を依頼
-        response = self.openai_client.chat.completions.create(
-            model=self.model,
+        response = self.llm.chat(
+            'generate_question',
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt}
@@ -720,4 +1164,40 @@ class InterviewOrchestrator:
             max_tokens=250,
             temperature=0.7
         )
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+        return response.strip()
+
+@shared_task(ignore_result=True)
+def analyze_explanation_segment_task(segment_id):
+    """説明フェーズの確定した区間を埋め込み、それより新しい区間がまだ届いていなければ説明全体の先読みを行う"""
+    segment = ExplanationSegment.objects.select_related('session').get(id=segment_id)
+    segments = list(segment.session.explanation_segments.all())
+    pending = [s for s in segments if not s.embedding] # 先に届いた区間もまとめて埋め込む
+    if pending:
+        for s, vector in zip(pending, embed_texts([s.content for s in pending])):
+            s.embedding = encode_vector(vector)
+        ExplanationSegment.objects.bulk_update(pending, ['embedding'])
+    if segments[-1].id != segment.id: # 発話が続いている間は、最後の区間のタスクにだけ先読みを任せる
+        return False
+    explanation = " ".join(s.content for s in segments)
+    return warm_first_step(segment.session, explanation, [decode_vector(s.embedding) for s in segments])
+
+@shared_task(ignore_result=True)
+def warm_explanation_task(session_id, explanation):
+    """校正後の説明文など、区間から組み立てられない説明文について先読みを行う"""
+    return warm_first_step(InterviewSession.objects.get(id=session_id), explanation)
+
+def warm_first_step(session, explanation, segment_vectors=None):
+    """説明フェーズ終了時の最初の呼び出しで行う網羅チェックと移動先の決定を先に済ませ、説明文ごとに保存する"""
+    if not settings.EXPLANATION_WARMUP.get('ENABLED', True) or session.status != 'explaining':
+        return False
+    if load_warmup(session.id, explanation) is not None:
+        return True
+    try:
+        with start_trace('explanation_warmup') as trace:
+            prepared = InterviewOrchestrator(session.material_id).prepare_first_step(explanation, segment_vectors)
+    except Exception as e: # 先読みできなくても最初の呼び出しで同じ処理を行うだけなので続行する
+        print(f"[warmup] error: {e}", file=sys.stderr)
+        return False
+    save_warmup(session.id, explanation, prepared)
+    print(f"[warmup] session {session.id}: 先読み完了 {trace.total_ms:.0f}ms (次のノード: {prepared['next_node_id']})", file=sys.stderr)
+    return True
@@ -0,0 +1,88 @@
+import numpy as np
+from django.conf import settings
+
+
+def page_thumbnail(page):
+    """ページを SLIDE_DEDUP['GRID'] の格子に縮小したグレースケール画像（uint8 のバイト列）
+
+    格子の 1 マスは数ピクセル四方の平均値にして、アンチエイリアスの揺れで差分が出ないようにする。
+    """
+    import fitz  # PyMuPDF（教材処理のワーカーでだけ読み込む）
+    rows, cols = settings.SLIDE_DEDUP.get('GRID', (48, 64))
+    zoom = cols * 4 / max(page.rect.width, 1)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)[:, :, 0].astype(np.float32)
+    ys = np.linspace(0, image.shape[0], rows + 1).astype(int)[:-1]
+    xs = np.linspace(0, image.shape[1], cols + 1).astype(int)[:-1]
+    sums = np.add.reduceat(np.add.reduceat(image, ys, axis=0), xs, axis=1)
+    counts = np.outer(np.diff(np.append(ys, image.shape[0])), np.diff(np.append(xs, image.shape[1])))
+    return (sums / np.maximum(counts, 1)).round().astype(np.uint8).tobytes()
+
+
+def page_words(page):
+    """ページのテキスト層の単語（テキスト層のないページは空のリスト）"""
+    return [word[4] for word in page.get_text('words')]
+
+
+def decode_thumbnail(data):
+    rows, cols = settings.SLIDE_DEDUP.get('GRID', (48, 64))
+    return np.frombuffer(data, dtype=np.uint8).reshape(rows, cols).astype(np.int16)
+
+
+def ink_mask(thumbnail):
+    """背景（最も多い明るさ = 中央値）から INK_DELTA 以上離れているマス（文字・図が描かれているところ）"""
+    background = np.median(thumbnail)
+    return np.abs(thumbnail - background) >= settings.SLIDE_DEDUP.get('INK_DELTA', 16)
+
+
+def is_build_step(previous, current):
+    """current が previous に少しだけ書き足したページ（アニメーションの途中経過）か
+
+    - previous で描かれていたマスは current でもほぼ同じ明るさで残っている（消えた・変わったマスが MAX_CHANGED_RATIO 以下）
+    - current で新しく描かれたマスは格子全体の MAX_ADDED_RATIO 以下
+    """
+    config = settings.SLIDE_DEDUP
+    previous_ink = ink_mask(previous)
+    current_ink = ink_mask(current)
+    changed = previous_ink & (np.abs(current - previous) >= config.get('INK_DELTA', 16))
+    added = current_ink & ~previous_ink
+    return (
+        changed.sum() <= config.get('MAX_CHANGED_RATIO', 0.02) * max(previous_ink.sum(), 1)
+        and added.sum() <= config.get('MAX_ADDED_RATIO', 0.12) * added.size
+    )
+
+
+def keeps_words(previous_words, current_words):
+    """current のテキスト層が previous の単語をすべて含んでいるか（どちらかにテキスト層がなければ縮小画像だけで判断する）
+
+    縮小画像の格子では、同じ位置の文字を書き換えたページ（数値だけが違うスライドなど）を書き足しと区別できない。
+    """
+    if not previous_words or not current_words:
+        return True
+    return set(previous_words) <= set(current_words)
+
+
+def group_build_pages(pages, thumbnails, words=None):
+    """連続するページのうち、前のページに書き足しただけのページを 1 つのグループにまとめる
+
+    pages: 昇順のページ番号。thumbnails: {ページ番号: page_thumbnail() の値}（ないページは単独のグループ）
+    words: {ページ番号: page_words() の値}。前のページの単語が消えたページは書き足しとみなさない
+    戻り値: [[最初のページ, ..., 最後のページ], ...]。最後のページが前のページの内容をすべて含む
+    """
+    max_pages = settings.SLIDE_DEDUP.get('MAX_GROUP_PAGES', 10)
+    words = words or {}
+    groups = []
+    previous = None
+    for page_number in pages:
+        current = decode_thumbnail(thumbnails[page_number]) if page_number in thumbnails else None
+        if (
+            groups and previous is not None and current is not None
+            and groups[-1][-1] == page_number - 1 and len(groups[-1]) < max_pages
+            and is_build_step(previous, current)
+            and keeps_words(words.get(page_number - 1), words.get(page_number))
+        ):
+            groups[-1].append(page_number)
+        else:
+            groups.append([page_number])
+        previous = current
+    return groups
@@ -0,0 +1,70 @@
+import sys
+from typing import List
+from django.conf import settings
+from pydantic import BaseModel
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from .models import KnowledgeNode
+
+
+class NodeSummary(BaseModel):
+    id: int
+    gist: str
+    summary: str
+
+
+class NodeSummaryBatch(BaseModel):
+    nodes: List[NodeSummary]
+
+
+class NodeSummarizer:
+    """複数ノードの一行要旨 (gist) と短い要約 (summary) を 1 回の呼び出しでまとめて生成する"""
+
+    def __init__(self):
+        self.llm = LLMClient()
+
+    def summarize(self, nodes):
+        nodes = list(nodes)
+        if not nodes:
+            return 0
+        # ノードを落とすと要約されないまま残るので、ノードごとに説明を切り詰める
+        builder = PromptBuilder('summarize_nodes')
+        for node in nodes:
+            builder.section(f"node_{node.id}", node.description, budget=builder.budgets.get('description'))
+        descriptions = builder.build()
+        node_list = "\n".join(f"- ID {node.id}: {node.title} / {descriptions[f'node_{node.id}']}" for node in nodes)
+        prompt = f"""
+        以下の各トピックについて、説明を短くまとめてください。
+
+        ■ トピック:
+        {node_list}
+
+        ■ 要件:
+        - gist: トピックの核心を表す一行（30文字以内）。タイトルの繰り返しは避けてください。
+        - summary: 説明の要点を1~2文（80文字以内）で。説明に書かれていない内容を加えないでください。
+        - すべてのトピックについて、ID をそのまま付けて返してください。
+        """
+        batch = self.llm.parse(
+            'summarize_nodes',
+            response_format=NodeSummaryBatch,
+            messages=[
+                {"role": "system", "content": "あなたは教材の編集者です。各トピックの説明を指定の長さで要約し、JSONで返します。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.0
+        )
+        if batch is None:
+            print(f"[summaries] {len(nodes)} ノードの要約を生成できませんでした", file=sys.stderr)
+            return 0
+
+        by_id = {node.id: node for node in nodes}
+        updated = []
+        for item in batch.nodes:
+            node = by_id.get(item.id)
+            if node is None:
+                continue
+            node.gist = item.gist.strip()[:KnowledgeNode._meta.get_field('gist').max_length]
+            node.summary = item.summary.strip()
+            updated.append(node)
+        KnowledgeNode.objects.bulk_update(updated, ['gist', 'summary'])
+        return len(updated)
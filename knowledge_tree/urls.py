@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import KnowledgeNodeViewSet, DocumentChunkViewSet
+from .views import KnowledgeNodeViewSet, DocumentChunkViewSet, LearningMaterialViewSet
 
 router = DefaultRouter()
 router.register(r'nodes', KnowledgeNodeViewSet)
 router.register(r'chunks', DocumentChunkViewSet)
+router.register(r'materials', LearningMaterialViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
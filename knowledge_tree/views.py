@@ -1,10 +1,14 @@
 import sys
-from interview_session.models import InterviewSession
+from django.db import transaction
+from interview_session.models import InterviewSession, TurnTrace
+from llm_gateway.tracing import start_trace
+from .warmup import load_warmup
+from .retries import PipelineRetryStats
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from .models import KnowledgeNode, DocumentChunk, LearningMaterial
-from .serializers import KnowledgeNodeSerializer, DocumentChunkSerializer
+from .serializers import KnowledgeNodeSerializer, DocumentChunkSerializer, LearningMaterialSerializer
 from .services import InterviewOrchestrator
 
 class KnowledgeNodeViewSet(viewsets.ReadOnlyModelViewSet):
@@ -60,54 +64,97 @@ class KnowledgeNodeViewSet(viewsets.ReadOnlyModelViewSet):
         print("# 学習者の回答:", user_answer, file=sys.stderr)
         print("", file=sys.stderr)
 
-        try:
-            # --- 2. 実際の「次、どうするか？」の判断は services.py に任せる ---
-            orchestrator = InterviewOrchestrator(material_id) # ここで InterviewOrchestrator の __init_() が呼ばれる
-            root_node = orchestrator.material.root_node # material_id とそれに対応する root_node は一対一
+        result_data, error = None, ''
+        with start_trace('interview_next_step') as trace:
+            try:
+                # --- 2. 実際の「次、どうするか？」の判断は services.py に任せる ---
+                orchestrator = InterviewOrchestrator(material_id) # ここで InterviewOrchestrator の __init_() が呼ばれる
+                root_node = orchestrator.material.root_node # material_id とそれに対応する root_node は一対一
 
-            # [A] current_node_id が None の場合は「説明フェーズ」 からの最初の呼び出し
-            if current_node_id is None:
-                print("# ルートノード:", file=sys.stderr)
-                print("  title:", root_node.title, file=sys.stderr)
-                print("  description:", root_node.description, file=sys.stderr)
-                print("=================================", file=sys.stderr)
+                # [A] current_node_id が None の場合は「説明フェーズ」 からの最初の呼び出し
+                if current_node_id is None:
+                    print("# ルートノード:", file=sys.stderr)
+                    print("  title:", root_node.title, file=sys.stderr)
+                    print("  description:", root_node.description, file=sys.stderr)
+                    print("=================================", file=sys.stderr)
 
-                # セッションのステータスを 'questioning' に更新
-                try:
-                    session = InterviewSession.objects.get(id=session_id)
-                    if session.status == 'explaining':
-                        session.status = 'questioning'
-                        session.save()
-                except InterviewSession.DoesNotExist:
-                    return Response({'error': '指定されたセッションが見つかりません'}, status=status.HTTP_404_NOT_FOUND)
+                    # セッションのステータスを 'questioning' に更新
+                    try:
+                        session = InterviewSession.objects.get(id=session_id)
+                        if session.status == 'explaining':
+                            session.status = 'questioning'
+                            session.save()
+                    except InterviewSession.DoesNotExist:
+                        error = 'InterviewSession.DoesNotExist'
+                        return Response({'error': '指定されたセッションが見つかりません'}, status=status.HTTP_404_NOT_FOUND)
+                    
+                    prepared = load_warmup(session.id, user_answer) # 説明フェーズの途中で同じ説明文について先読みしていれば使う
+                    if prepared is not None:
+                        print("# 先読み済みの網羅チェックと移動先を使用", file=sys.stderr)
+                        all_node_ids = prepared['uncleared_node_ids'] + [root_node.id]
+                    else:
+                        # これから訪問すべき全ノードのIDリストを作成
+                        all_descendants_nodes = root_node.get_descendants()
+                        all_node_ids = [node.id for node in all_descendants_nodes] + [root_node.id] # まだ質問してない項目のリスト
+                        # 説明フェーズの発話ですでに説明された葉ノードは最初にクリアしておく
+                        orchestrator.clear_explained_nodes(user_answer, all_node_ids)
+                    # 次の行動を決定（現在地は根ノード）
+                    result_data = orchestrator.determine_next_step(
+                        user_answer, current_node_id=root_node.id, uncleared_node_ids=all_node_ids, consec_fail_count=0, socratic_stage=1,
+                        prepared_node_id=prepared['next_node_id'] if prepared else None
+                    )
                 
-                # これから訪問すべき全ノードのIDリストを作成
-                all_descendants_nodes = root_node.get_descendants()
-                all_node_ids = [node.id for node in all_descendants_nodes] + [root_node.id] # まだ質問してない項目のリスト
-                # 次の行動を決定（現在地は根ノード）
-                result_data = orchestrator.determine_next_step(user_answer, current_node_id=root_node.id, uncleared_node_ids=all_node_ids, consec_fail_count=0, socratic_stage=1)
-            
-            # [B] current_node_id が 存在する場合は「質問フェーズ」 のループ中の呼び出し
-            else:
-                if not uncleared_node_ids:
-                    print("この処理は実行されないはず", file=sys.stderr)
+                # [B] current_node_id が 存在する場合は「質問フェーズ」 のループ中の呼び出し
+                else:
+                    if not uncleared_node_ids:
+                        print("この処理は実行されないはず", file=sys.stderr)
+                    
+                    # 次の行動を決定
+                    result_data = orchestrator.determine_next_step(user_answer, current_node_id, uncleared_node_ids, current_question=current_question, consec_fail_count=int(consec_fail_count), socratic_stage=int(socratic_stage), full_history=full_history)
                 
-                # 次の行動を決定
-                result_data = orchestrator.determine_next_step(user_answer, current_node_id, uncleared_node_ids, current_question=current_question, consec_fail_count=int(consec_fail_count), socratic_stage=int(socratic_stage), full_history=full_history)
-            
-            # 決定した結果をフロントエンド（explanation_phase.js / questioning-phase.js）に返す
-            return Response(result_data)
+                # 決定した結果をフロントエンド（explanation_phase.js / questioning-phase.js）に返す
+                return Response(result_data)
 
-        except (LearningMaterial.DoesNotExist, KnowledgeNode.DoesNotExist):
-            return Response(
-                {'error': '指定された教材またはノードが見つかりません'}, 
-                status=status.HTTP_404_NOT_FOUND
-            )
-        except Exception as e:
-            return Response(
-                {'error': f'処理中に予期せぬエラーが発生しました: {str(e)}'}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            except (LearningMaterial.DoesNotExist, KnowledgeNode.DoesNotExist) as e:
+                error = f'{type(e).__name__}: {e}'
+                return Response(
+                    {'error': '指定された教材またはノードが見つかりません'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                return Response(
+                    {'error': f'処理中に予期せぬエラーが発生しました: {str(e)}'}, 
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+            finally:
+                # 失敗したターン（LLM の締め切り超過など）も、どこで時間を使ったか分かるように処理時間の内訳を記録する
+                self._save_turn_trace(session_id, trace, result_data, error)
+
+    def _save_turn_trace(self, session_id, trace, result_data, error=''):
+        """このターンのスパン（フェーズごと・LLM 呼び出しごとの所要時間）をセッションに紐づけて保存する
+
+        result_data: 例外で終わったターンでは None（error に例外の内容を入れる）
+        """
+        result_data = result_data or {}
+        try:
+            print(f"# ターン処理時間: {trace.total_ms:.0f}ms {trace.phase_durations()}" + (f" error={error}" if error else ''), file=sys.stderr)
+            with transaction.atomic():
+                # 同じセッションのターンが同時に保存されても turn_index が重ならないよう、セッションの行をロックしてから数える
+                InterviewSession.objects.select_for_update().filter(id=session_id).first()
+                TurnTrace.objects.create(
+                    session_id=session_id,
+                    turn_index=TurnTrace.objects.filter(session_id=session_id).count(),
+                    node_id=result_data.get('next_node_id'),
+                    result_status=result_data.get('status', 'error' if error else ''),
+                    error=error[:1000],
+                    total_ms=trace.total_ms,
+                    phase_durations=trace.phase_durations(),
+                    spans=trace.spans,
+                    **trace.llm_totals()
+                )
+        except Exception as e: # トレースの保存に失敗してもインタビューは止めない
+            print(f"[trace] save error: {e}", file=sys.stderr)
 
 class DocumentChunkViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = DocumentChunk.objects.all()
@@ -123,7 +170,7 @@ class DocumentChunkViewSet(viewsets.ReadOnlyModelViewSet):
             # 指定されたノードに関連するチャンクを取得
             try:
                 node = KnowledgeNode.objects.get(id=node_id)
-                chunks = node.chunks.all()
+                chunks = node.related_chunks.all()
                 serializer = self.get_serializer(chunks, many=True)
                 return Response(serializer.data)
             except KnowledgeNode.DoesNotExist:
@@ -136,3 +183,30 @@ class DocumentChunkViewSet(viewsets.ReadOnlyModelViewSet):
         chunks = DocumentChunk.objects.all()[:10]
         serializer = self.get_serializer(chunks, many=True)
         return Response(serializer.data)
+
+
+class LearningMaterialViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = LearningMaterial.objects.all()
+    serializer_class = LearningMaterialSerializer
+
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """教材処理の進み具合（分析済みページ数・保存済みチャンク数・ツリー生成の完了・再試行）を取得"""
+        material = self.get_object()
+        if material.processed:
+            stage = 'completed'
+        elif material.pages_total and material.pages_analyzed >= material.pages_total:
+            stage = 'generating_tree'
+        elif material.pages_total:
+            stage = 'analyzing_pages'
+        else:
+            stage = 'preparing'
+        return Response({
+            'material_id': material.id,
+            'stage': stage,
+            'pages_total': material.pages_total,
+            'pages_analyzed': material.pages_analyzed,
+            'chunks': material.chunks.count(), # 保存済みのチャンクはツリー生成前から検索できる
+            'processed': material.processed,
+            'retries': PipelineRetryStats(material.id).stats(), # タスクごとの再試行回数と待ち時間[秒]
+        })
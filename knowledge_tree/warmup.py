@@ -0,0 +1,39 @@
+import re
+import sys
+import json
+import hashlib
+from django.conf import settings
+from redis.exceptions import RedisError
+from llm_gateway.backend import get_redis
+
+
+def explanation_digest(text):
+    """空白の違いを無視した説明文のハッシュ（区間をつないだ文字起こしと、最後に送信された説明文を照合する）"""
+    return hashlib.sha1(re.sub(r'\s+', '', text or '').encode('utf-8')).hexdigest()
+
+
+def _key(session_id, explanation):
+    return f"explanation_warmup:{session_id}:{explanation_digest(explanation)}"
+
+
+def save_warmup(session_id, explanation, prepared):
+    """説明フェーズの途中で決めておいた最初のステップ（網羅チェック後の未クリアノードと最初の移動先）を保存する
+
+    Celery ワーカーが書き、Web プロセスが読むので、プロセス間で共有する Redis に置く。
+    """
+    try:
+        get_redis().set(_key(session_id, explanation), json.dumps(prepared), ex=settings.EXPLANATION_WARMUP.get('CACHE_TTL', 60 * 30))
+    except RedisError as e:
+        print(f"[warmup] save error: {e}", file=sys.stderr)
+
+
+def load_warmup(session_id, explanation):
+    """同じ説明文について先に決めておいた最初のステップ（なければ None）"""
+    if not settings.EXPLANATION_WARMUP.get('ENABLED', True) or not session_id or not explanation:
+        return None
+    try:
+        raw = get_redis().get(_key(session_id, explanation))
+    except RedisError as e:
+        print(f"[warmup] load error: {e}", file=sys.stderr)
+        return None
+    return json.loads(raw) if raw else None
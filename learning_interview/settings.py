@@ -45,6 +45,7 @@ INSTALLED_APPS = [
     'interview_session',
     'question_engine',
     'frontend',
+    'llm_gateway',
 ]
 
 MIDDLEWARE = [
@@ -185,5 +186,244 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Asia/Tokyo'
+CELERY_RESULT_EXPIRES = 60 * 60  # 結果を参照するタスクはほとんどないので 1 時間で消す
 
-VISION_MODEL = "gpt-4o-2024-11-20"
\ No newline at end of file
+# 教材処理のタスクの再試行（OpenAI の一時的なエラーのとき。ワーカーは待たずに Celery の countdown で再投入する）
+# retry-after ヘッダがあればその秒数、なければ BASE_DELAY * 2^回数 を上限としたランダムな秒数（最大 MAX_DELAY）だけ待つ
+# レート制御の枠待ち（LLMRateLimited）は再試行回数に数えず、ゲートウェイが順番に割り当てた時刻に MAX_DEFERRALS 回まで再投入する
+PIPELINE_RETRY = {
+    'MAX_RETRIES': 5,
+    'BASE_DELAY': 2,
+    'MAX_DELAY': 120,
+    'MAX_DEFERRALS': 50,
+}
+
+# 教材処理の途中データ（ページ画像・分析結果）を置くディレクトリ（Web プロセスと全ワーカーから見える場所）
+PIPELINE_ARTIFACT_ROOT = os.getenv('PIPELINE_ARTIFACT_ROOT', str(MEDIA_ROOT / 'pipeline'))
+
+# PDF ページの画像化（ページ範囲ごとのタスクに分け、各タスクが PDF を開き直して並列にレンダリングする）
+PAGE_RENDER = {
+    'PAGES_PER_TASK': 8,  # 1 タスクでレンダリングするページ数（小さいほど並列度が上がるが、PDF を開く回数が増える）
+    'ZOOM': 2.0,          # 解像度の倍率（2 倍ズームで文字を読み取りやすくする）
+}
+
+# アニメーションの途中経過のページ（箇条書きを 1 つずつ表示するスライドなど）をまとめて、最後のページだけを分析する
+# ページを GRID（行, 列）の格子に縮小し、前のページに書き足しただけの連続するページを 1 グループにする
+SLIDE_DEDUP = {
+    'ENABLED': True,
+    'GRID': (48, 64),
+    'INK_DELTA': 16,             # 背景の明るさからこれ以上離れたマスを「描かれている」とみなす（0〜255）
+    'MAX_ADDED_RATIO': 0.12,     # 新しく描かれたマスが格子全体のこの割合以下なら書き足しとみなす
+    'MAX_CHANGED_RATIO': 0.02,   # 前のページで描かれていたマスのうち、消えた・変わったマスの割合の上限
+    'MAX_GROUP_PAGES': 10,
+}
+
+# テキスト層のあるページは、テキストをそのまま使い、図・数式の領域だけを切り出して GPT-4o に送る
+# （画像ブロック・描画の位置から図の領域を、数式用フォントのブロックから数式の領域を求める）
+PAGE_LAYOUT = {
+    'ENABLED': True,
+    'MIN_TEXT_CHARS': 20,           # テキスト層の文字数がこれ未満のページ（スキャン画像など）はページ全体を分析する
+    'MAX_FIGURE_AREA_RATIO': 0.6,   # 図の面積の合計がページのこの割合を超えるページもページ全体を分析する
+    'MIN_FIGURE_AREA_RATIO': 0.01,  # これより小さい領域（区切り線・アイコン）は図とみなさない
+    'MERGE_MARGIN': 8,              # この距離[pt]以内の画像・描画は 1 つの図にまとめる
+    'MAX_DRAWINGS': 500,            # 描画（線・図形）の数がこれを超えるページ（散布図など）もページ全体を分析する
+    'CROP_MARGIN': 4,               # 切り出すときに図の周りに付ける余白[pt]
+    'CONTEXT_CHARS': 1500,          # 図の説明の参考として一緒に送る同じページのテキストの文字数
+    'MATH_FONT_PATTERN': r'CMMI|CMSY|CMEX|Math|Symbol',
+}
+
+# ページ全体の画像で分析する小さなページ（PNG のサイズが小さい = 情報量の少ないスライド）を 1 回の呼び出しにまとめる
+# 画像の見積もりトークン数の合計が MAX_IMAGE_TOKENS、ページ数が MAX_PAGES に達するまで詰める
+# 応答はページ数に比例して長くなるので、max_tokens は 1 ページあたり MAX_TOKENS_PER_PAGE を確保する
+# 応答をページごとに分けられなかったバッチは 1 ページずつの分析に切り替える
+PAGE_BATCH = {
+    'ENABLED': True,
+    'SMALL_PAGE_BYTES': 250000,
+    'MAX_PAGES': 4,
+    'MAX_IMAGE_TOKENS': 5000,       # 2 倍ズームのスライドは 1 ページ 765（4:3）〜1105（16:9, A4）トークンなので MAX_PAGES ページが収まる
+    'MAX_TOKENS_PER_PAGE': 4000,    # 応答の max_tokens はこの値 × ページ数（合計が 16000 を超えるページ数はまとめない）
+}
+
+VISION_MODEL = "gpt-4o-2024-11-20"
+
+# Redis（LLM 応答キャッシュなど、Web と Celery ワーカーで共有する状態の置き場）
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/1')
+
+# LLM ゲートウェイ設定
+LLM_GATEWAY = {
+    'CACHE_ENABLED': True,
+    'CACHE_TTL': 60 * 60 * 24 * 7,  # 1 週間
+    'CACHE_MAX_ENTRIES': 50000,     # これを超えたら最も長く参照されていない応答から削除（LRU）
+    'EMBEDDING_CACHE_ENABLED': True,  # Embedding をモデル・次元数・正規化したテキストのハッシュごとに DB に保存して使い回す
+    'ESCALATION_MIN_CONFIDENCE': 0.6,  # 高速モデルの confidence がこれ未満なら上位モデルで再実行
+    # 負荷が高いときは 1 段安いモデルに切り替えて 1 ターンの待ち時間を抑える
+    'LOAD_DOWNGRADE': {
+        'MAX_IN_FLIGHT': 40,       # 全プロセス合計の実行中リクエスト数
+        'P95_LATENCY_MS': 8000,    # 呼び出しタイプごとの直近 p95 レイテンシ
+        'LATENCY_WINDOW': 200,     # p95 の計算に使う直近のサンプル数
+    },
+    # 全プロセス共有の OpenAI レート制御（アカウントの上限より少し低めに設定する）
+    'RATE_LIMIT': {
+        'ENABLED': True,
+        'RPM': int(os.getenv('OPENAI_RPM_LIMIT', 500)),
+        'TPM': int(os.getenv('OPENAI_TPM_LIMIT', 200000)),
+        'BACKGROUND_RESERVE': 0.2,  # 教材処理はバケットの 20% を対話用に残す
+        'MAX_WAIT_SECONDS': {'interactive': 30, 'background': 600},
+    },
+    # 1 回の呼び出しの締め切りと、遅い応答に対するヘッジ（同じリクエストをもう 1 本送る）
+    'HEDGING': {
+        'ENABLED': True,                # 対話中（priority=interactive）の呼び出しのみ
+        'DEADLINE_SECONDS': {'route': 15, 'evaluate': 15, 'generate': 30, 'correct': 120, 'vision': 180},
+        'DEFAULT_HEDGE_DELAY_MS': 3000,  # p95 の実績がまだないときの待ち時間
+        'MIN_HEDGE_DELAY_MS': 500,
+        'MAX_RETRIES': 2,
+    },
+    # 再試行はリクエスト数の 10%（最低でも 1 分あたり 10 回）まで
+    'RETRY_BUDGET': {
+        'RATIO': 0.1,
+        'MIN_PER_MINUTE': 10,
+    },
+}
+
+# モデルの段階（先頭ほど高性能・高コスト）。負荷が高いときは 1 つ後ろのモデルに切り替える
+LLM_MODEL_TIERS = ['gpt-4o-2024-11-20', 'gpt-4o-mini']
+
+# 呼び出しタイプごとの既定モデルと、出力が不十分なときの昇格先
+LLM_ROUTES = {
+    'route': {'model': 'gpt-4o-mini', 'escalate_to': 'gpt-4o-2024-11-20'},     # ノード選択・省略・剪定などの判定
+    'evaluate': {'model': 'gpt-4o-mini', 'escalate_to': 'gpt-4o-2024-11-20'},  # 回答評価
+    'generate': {'model': 'gpt-4o-2024-11-20'},                                # 質問・知識ツリー生成
+    'correct': {'model': 'gpt-4o-mini'},                                       # 文章校正
+    'vision': {'model': VISION_MODEL},                                         # ページ画像の分析
+}
+
+# LLM 呼び出し箇所ごとの設定
+# type: LLM_ROUTES の呼び出しタイプ
+# cache: temperature=0 の応答を共有キャッシュする（同じ教材を学ぶ学習者間で同一入力が繰り返されるため）
+# downgrade: 負荷が高いときに安いモデルへ切り替えてよいか（教材処理は品質を優先する）
+# priority: レート制御の優先度（interactive: インタビュー中 / background: 教材処理）。既定は interactive
+# deadline: 締め切り[秒]。省略時は LLM_GATEWAY['HEDGING']['DEADLINE_SECONDS'] の呼び出しタイプごとの値
+# celery_retry: Celery タスクが countdown 付きで再投入する呼び出し（レート制御の枠やレート制限をワーカー内で待たず、ゲートウェイでは再試行しない）
+# max_wait: レート制御の枠を待つ最大秒数。省略時は LLM_GATEWAY['RATE_LIMIT']['MAX_WAIT_SECONDS'] の優先度ごとの値
+LLM_CALL_SITES = {
+    'analyze_page': {'type': 'vision', 'cache': True, 'downgrade': False, 'priority': 'background', 'celery_retry': True},
+    'analyze_figures': {'type': 'vision', 'cache': True, 'downgrade': False, 'priority': 'background', 'celery_retry': True},
+    'analyze_pages': {'type': 'vision', 'cache': True, 'downgrade': False, 'priority': 'background', 'deadline': 300, 'celery_retry': True},
+    'generate_tree': {'type': 'generate', 'cache': True, 'downgrade': False, 'priority': 'background', 'deadline': 600, 'celery_retry': True},
+    'embed_chunks': {'priority': 'background', 'celery_retry': True},
+    'compare_relevance': {'type': 'route', 'cache': True},
+    'can_skip_child': {'type': 'route', 'cache': True},
+    'skip_sibling': {'type': 'route', 'cache': True},
+    'evaluate_answer': {'type': 'evaluate', 'cache': True},
+    'generate_question': {'type': 'generate'},
+    'detect_topics': {'type': 'route'},
+    'socratic_question': {'type': 'generate'},
+    'legacy_evaluate_answer': {'type': 'evaluate'},
+    'follow_up_question': {'type': 'generate'},
+    'correct_text': {'type': 'correct'},
+    'generate_question_pool': {'type': 'generate', 'priority': 'background', 'deadline': 180, 'celery_retry': True},
+    'personalize_question': {'type': 'route'},
+    'generate_rubric': {'type': 'generate', 'cache': True, 'priority': 'background', 'deadline': 120, 'celery_retry': True},
+    'embed_rubric': {'priority': 'background', 'celery_retry': True},
+    'embed_answer': {'type': 'route', 'hedge': False},
+    'embed_nodes': {'priority': 'background', 'max_wait': 30}, # ツリー生成の途中で呼ぶので再投入できない
+    'summarize_nodes': {'type': 'route', 'cache': True, 'priority': 'background', 'deadline': 120, 'celery_retry': True},
+    'confirm_coverage': {'type': 'route', 'cache': True},
+    'embed_query': {'type': 'route', 'hedge': False},
+}
+
+# 教材処理時に事前生成する質問プール
+# インタビュー中はプールから出題し、PERSONALIZE が True なら直前のやり取りへの一声だけを安いモデルで付け足す
+QUESTION_POOL = {
+    'ENABLED': True,
+    'QUESTIONS_PER_STAGE': 3,  # 各ソクラテス段階の通常の質問数
+    'REMEDIAL_PER_STAGE': 2,   # 各段階のやさしい言い換え（リメディアル）の質問数
+    'PERSONALIZE': True,
+}
+
+# 知識ノードの埋め込み（タイトル+説明）。ノードの関連度判定を LLM に頼らず行列計算で済ませるために使う
+# DIMENSIONS: text-embedding-3 系は次元を指定して短くできる。float16 で保存するので 1 ノードあたり DIMENSIONS * 2 バイト
+NODE_EMBEDDING = {
+    'MODEL': 'text-embedding-3-large',
+    'DIMENSIONS': 1024,
+    'BATCH_SIZE': 256,
+}
+
+# ノードと関連チャンクの対応付け（ノードとチャンクの埋め込みの類似度で決める）
+CHUNK_LINKING = {
+    'TOP_K': 3,             # 1 ノードあたりの最大チャンク数
+    'MIN_SIMILARITY': 0.3,  # これ未満のチャンクは関連付けない
+    'PAGE_MARGIN': 1,       # LLM が挙げたチャンクのページ範囲を前後に広げる幅
+}
+
+# 質問生成のプロンプトに入れる講義資料の抜粋の選び方
+RETRIEVAL = {
+    'TOKEN_BUDGET': 1200,  # 抜粋全体のトークン数の上限
+    'MAX_PASSAGES': 5,
+    'ANSWER_WEIGHT': 0.5,  # 学習者の直前の回答との類似度の重み（0 なら回答を埋め込まない）
+    'CACHE_TTL': 60 * 60,  # ノードごとの候補（ノードとの類似度・トークン数）のキャッシュ時間[秒]
+}
+
+# ノードの要旨・要約を 1 回の呼び出しでまとめて生成するノード数
+NODE_SUMMARY_BATCH_SIZE = 30
+
+# プロンプトのセクションごとのトークン予算（llm_gateway.prompting.PromptBuilder）
+# total: プロンプト全体の上限。超えたら priority の低いセクションから削る
+PROMPT_BUDGETS = {
+    'generate_tree': {'total': 100000, 'material': 100000},  # gpt-4o の入力上限から出力分 (16k) と指示文を除いた量
+    'generate_question': {'total': 3000, 'excerpts': 1200, 'history': 1200, 'description': 500},
+    'evaluate_answer': {'question': 500, 'answer': 1500},
+    'can_skip_child': {'total': 3000, 'history': 2500, 'topic': 500},
+    'skip_sibling': {'total': 5000, 'history': 2500, 'topics': 2500},
+    'detect_topics': {'total': 6000, 'topics': 2000, 'explanation': 4000},
+    'confirm_coverage': {'total': 6000, 'topics': 2000, 'explanation': 4000},
+    'compare_relevance': {'total': 2000, 'answer': 1500, 'option_a': 250, 'option_b': 250},  # トーナメントの比較ごとに送られる
+    'generate_question_pool': {'total': 6000, 'excerpts': 4500, 'description': 1000},
+    'generate_rubric': {'total': 6000, 'excerpts': 4500, 'description': 1000},
+    'summarize_nodes': {'total': 30000, 'description': 800},  # description はノード 1 つあたり
+    'personalize_question': {'total': 1200, 'question': 300, 'answer': 800},
+    'socratic_question': {'history': 1500},
+    'legacy_evaluate_answer': {'total': 2500, 'description': 500, 'question': 500, 'answer': 1500},
+    'follow_up_question': {'total': 6000, 'explanation': 2500, 'history': 2500, 'answer': 1000},
+}
+
+# 説明フェーズ終了時の網羅チェック（説明済みの葉ノードを質問フェーズの前にクリアする）
+# 説明を SEGMENT_CHARS 程度に区切って埋め込み、類似度が MIN_SIMILARITY 以上の葉ノード（最大 MAX_CANDIDATES 個）を 1 回の呼び出しで確認する
+COVERAGE_PREPASS = {
+    'ENABLED': True,
+    'SEGMENT_CHARS': 200,
+    'MIN_SIMILARITY': 0.45,
+    'MAX_CANDIDATES': 20,
+}
+
+# 説明で言及されたトピックの検出（interview_session.services.ExplanationAnalyzer）
+# 説明の区間の埋め込みとノードの埋め込みの類似度で MAX_TOPICS 個まで候補に絞り、CONFIRM なら候補だけを LLM で確認する
+TOPIC_DETECTION = {
+    'MIN_SIMILARITY': 0.4,
+    'MAX_TOPICS': 15,
+    'CONFIRM': True,
+}
+
+# 説明フェーズの途中解析（確定した文字起こしの区間ごとに埋め込み、発話が途切れたら網羅チェックと最初の移動先を先に決めておく）
+# DEBOUNCE_SECONDS: 最後の区間からこの秒数だけ新しい区間が届かなければ先読みを行う
+EXPLANATION_WARMUP = {
+    'ENABLED': True,
+    'DEBOUNCE_SECONDS': 3,
+    'CACHE_TTL': 60 * 30,
+}
+
+# ノードごとの採点基準による回答の事前採点
+# 明らかな合格（要点との類似度と用語の網羅率がともに高い）・不合格（空・ギブアップ・話題外）は LLM の評価を省略する
+RUBRIC = {
+    'ENABLED': True,
+    'EMBEDDING_MODEL': 'text-embedding-3-small',
+    # 回答全体（空白・句読点を除く）がいずれかと一致したときだけギブアップとみなす
+    'GIVE_UP_PHRASES': [
+        'わかりません', '分かりません', 'わからない', '分からない', '知りません', '忘れました', '覚えていません', 'パス',
+        'すみませんわかりません', 'すみません分かりません', 'ちょっとわからないです', 'わからないです', '分からないです',
+    ],
+    'PASS_SIMILARITY': 0.6,
+    'PASS_COVERAGE': 0.5,
+    'PASS_STAGES': [1],  # 手元で合格にする段階（採点基準はノードの定義・用語なので、理由・応用を問う段階は LLM で評価する）
+    'FAIL_SIMILARITY': 0.2,
+}
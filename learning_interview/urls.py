@@ -7,6 +7,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/knowledge-tree/', include('knowledge_tree.urls')),
     path('api/interview/', include('interview_session.urls')),
+    path('api/llm/', include('llm_gateway.urls')),
     path('', include('frontend.urls')),
 ]
 
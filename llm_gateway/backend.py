@@ -0,0 +1,16 @@
+import redis
+from django.conf import settings
+
+_redis_client = None
+
+
+def get_redis():
+    """LLM ゲートウェイが共有する Redis クライアントを返す（プロセスごとに 1 つ）"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=0.5,  # キャッシュのために API 呼び出しより遅くなっては意味がない
+            socket_connect_timeout=0.5
+        )
+    return _redis_client
@@ -0,0 +1,92 @@
+import sys
+import json
+import time
+import hashlib
+from django.conf import settings
+from redis.exceptions import RedisError
+from .backend import get_redis
+
+
+class LLMResponseCache:
+    """temperature=0 の決定的な LLM 応答を Redis 上で全プロセス共有するキャッシュ"""
+
+    KEY_PREFIX = 'llm_cache'
+    LRU_KEY = 'llm_cache:lru'      # キー -> 最終参照時刻 (sorted set)
+    STATS_KEY = 'llm_cache:stats'  # 呼び出し箇所ごとのヒット/ミス数 (hash)
+
+    def __init__(self):
+        config = settings.LLM_GATEWAY
+        self.enabled = config.get('CACHE_ENABLED', True)
+        self.ttl = config.get('CACHE_TTL', 60 * 60 * 24 * 7)
+        self.max_entries = config.get('CACHE_MAX_ENTRIES', 50000)
+        self.redis = get_redis()
+
+    def is_enabled_for(self, call_site, params):
+        """呼び出し箇所がキャッシュにオプトインしていて、かつ決定的な呼び出しかどうか"""
+        if not self.enabled:
+            return False
+        if not settings.LLM_CALL_SITES.get(call_site, {}).get('cache', False):
+            return False
+        return params.get('temperature') == 0.0
+
+    @staticmethod
+    def make_key(model, messages, params):
+        """モデル・メッセージ・パラメータからキャッシュキーを作る"""
+        payload = json.dumps(
+            {'model': model, 'messages': messages, 'params': params},
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, call_site, key):
+        """キャッシュされた応答を返す（なければ None）"""
+        try:
+            value = self.redis.get(f'{self.KEY_PREFIX}:{key}')
+            pipe = self.redis.pipeline()
+            if value is None:
+                pipe.hincrby(self.STATS_KEY, f'{call_site}:misses', 1)
+                pipe.zrem(self.LRU_KEY, key)  # TTL で消えたエントリが LRU に残っていれば掃除
+            else:
+                pipe.hincrby(self.STATS_KEY, f'{call_site}:hits', 1)
+                pipe.zadd(self.LRU_KEY, {key: time.time()})
+            pipe.execute()
+        except RedisError as e:
+            # Redis が使えなくても API 呼び出しにフォールバックするだけ
+            print(f"[LLM cache] get error: {e}", file=sys.stderr)
+            return None
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, call_site, key, value):
+        """応答を保存し、上限を超えたら最も長く参照されていないものから追い出す"""
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(f'{self.KEY_PREFIX}:{key}', value, ex=self.ttl)
+            pipe.zadd(self.LRU_KEY, {key: time.time()})
+            pipe.zcard(self.LRU_KEY)
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                self._evict(size - self.max_entries)
+        except RedisError as e:
+            print(f"[LLM cache] set error: {e}", file=sys.stderr)
+
+    def _evict(self, count):
+        evicted = self.redis.zpopmin(self.LRU_KEY, count)
+        if evicted:
+            self.redis.delete(*[f'{self.KEY_PREFIX}:{key.decode()}' for key, _ in evicted])
+
+    def stats(self):
+        """呼び出し箇所ごとのヒット/ミス数とヒット率"""
+        try:
+            raw = self.redis.hgetall(self.STATS_KEY)
+            entries = self.redis.zcard(self.LRU_KEY)
+        except RedisError as e:
+            return {'error': str(e)}
+
+        call_sites = {}
+        for field, count in raw.items():
+            call_site, kind = field.decode().rsplit(':', 1)
+            call_sites.setdefault(call_site, {'hits': 0, 'misses': 0})[kind] = int(count)
+        for counts in call_sites.values():
+            total = counts['hits'] + counts['misses']
+            counts['hit_rate'] = counts['hits'] / total if total else 0.0
+        return {'entries': entries, 'max_entries': self.max_entries, 'call_sites': call_sites}
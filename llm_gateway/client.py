@@ -0,0 +1,203 @@
+import sys
+import time
+from django.conf import settings
+from redis.exceptions import RedisError
+from .cache import LLMResponseCache
+from .embedding_cache import EmbeddingCache
+from .governor import RateGovernor, estimate_tokens
+from .hedging import HedgedCaller
+from .routing import ModelRouter
+from . import tracing
+
+
+class LLMClient:
+    """OpenAI 呼び出しの共通窓口（モデル選択・応答キャッシュ・レート制御・締め切り付き）"""
+
+    def __init__(self):
+        self._openai_client = None
+        self.cache = LLMResponseCache()
+        self.embedding_cache = EmbeddingCache()
+        self.router = ModelRouter()
+        self.governor = RateGovernor()
+        self.hedger = HedgedCaller()
+
+    @property
+    def openai_client(self):
+        """OpenAI SDK は最初の API 呼び出しで読み込む（キャッシュだけで済む呼び出しやコマンドの起動を軽くするため）"""
+        if self._openai_client is None:
+            from openai import OpenAI
+            # 再試行は SDK ではなく HedgedCaller が再試行予算の範囲で行う
+            self._openai_client = OpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        return self._openai_client
+
+    @openai_client.setter
+    def openai_client(self, client):
+        self._openai_client = client
+
+    def chat(self, call_site, messages, model=None, validator=None, **params):
+        """チャット補完を実行し、応答テキストを返す
+
+        model を省略すると呼び出しタイプに応じてルーターが選ぶ。
+        validator が False を返した場合は、より大きいモデルで 1 度だけ再実行する。
+        """
+        started = time.monotonic()
+        model = model or self.router.select(call_site)
+        key = self._cache_key(call_site, model, messages, params)
+        if key:
+            cached = self.cache.get(call_site, key)
+            if cached is not None:
+                tracing.record_llm_call(call_site, model, started, cached=True)
+                return cached
+
+        content = self._create(call_site, model, messages, params)
+        is_valid = validator is None or validator(content)
+        if not is_valid:
+            escalated = self.router.escalation_model(call_site, model)
+            if escalated:
+                print(f"[LLM router] {call_site}: {model} の出力が不十分なため {escalated} で再実行", file=sys.stderr)
+                content = self._create(call_site, escalated, messages, params)
+                is_valid = validator(content)
+
+        if key and content is not None and is_valid:
+            self.cache.set(call_site, key, content)
+        return content
+
+    def parse(self, call_site, messages, response_format, model=None, **params):
+        """Structured Outputs で応答を解析し、Pydantic モデルとして返す"""
+        started = time.monotonic()
+        model = model or self.router.select(call_site)
+        key = self._cache_key(call_site, model, messages, dict(params, response_format=response_format.model_json_schema()))
+        if key:
+            cached = self.cache.get(call_site, key)
+            if cached is not None:
+                tracing.record_llm_call(call_site, model, started, cached=True)
+                return response_format.model_validate_json(cached)
+
+        parsed = self._parse(call_site, model, messages, response_format, params)
+        if parsed is None:
+            escalated = self.router.escalation_model(call_site, model)
+            if escalated:
+                print(f"[LLM router] {call_site}: {model} の出力を解析できないため {escalated} で再実行", file=sys.stderr)
+                parsed = self._parse(call_site, escalated, messages, response_format, params)
+
+        if key and parsed is not None:
+            self.cache.set(call_site, key, parsed.model_dump_json())
+        return parsed
+
+    def embed(self, call_site, inputs, model, **params):
+        """複数テキストの Embedding を一括取得する
+
+        キャッシュ済みのテキストは DB から返し、残りだけを重複を除いて 1 回で埋め込む。
+        """
+        return self.embedding_cache.embed(
+            call_site, list(inputs), model, params.get('dimensions'),
+            lambda texts: self._embed(call_site, texts, model, **params)
+        )
+
+    def _embed(self, call_site, inputs, model, **params):
+        priority = self._priority(call_site)
+        estimated = sum(len(text) for text in inputs)
+
+        def send(timeout):
+            response = self.openai_client.embeddings.create(
+                model=model,
+                input=inputs,
+                timeout=timeout,
+                **params
+            )
+            self.governor.adjust(priority, estimated, self._total_tokens(response))
+            return response
+
+        response = self._call(call_site, model, send, priority, estimated)
+        return [item.embedding for item in response.data]
+
+    def _create(self, call_site, model, messages, params):
+        priority = self._priority(call_site)
+        estimated = estimate_tokens(messages, params.get('max_tokens'))
+
+        def send(timeout):
+            with self.router.track(self.router.call_type(call_site)):
+                response = self.openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=timeout,
+                    **params
+                )
+            self.governor.adjust(priority, estimated, self._total_tokens(response))
+            return response
+
+        response = self._call(call_site, model, send, priority, estimated)
+        return response.choices[0].message.content
+
+    def _parse(self, call_site, model, messages, response_format, params):
+        priority = self._priority(call_site)
+        estimated = estimate_tokens(messages, params.get('max_tokens'))
+
+        def send(timeout):
+            with self.router.track(self.router.call_type(call_site)):
+                response = self.openai_client.beta.chat.completions.parse(
+                    model=model,
+                    messages=messages,
+                    response_format=response_format,
+                    timeout=timeout,
+                    **params
+                )
+            self.governor.adjust(priority, estimated, self._total_tokens(response))
+            return response
+
+        response = self._call(call_site, model, send, priority, estimated)
+        return response.choices[0].message.parsed
+
+    def _call(self, call_site, model, send, priority, estimated):
+        """締め切り付きで send を実行する。対話中の呼び出しは p95 を過ぎたらヘッジする
+
+        レート制御の枠は締め切りの計測を始める前に呼び出し元のスレッドで確保する
+        （枠を待つ時間で締め切りを使い切ったり、締め切り後のスレッドが遅れて送信したりしないように）。
+        成否にかかわらず、所要時間とトークン数を現在のトレースに記録する。
+        """
+        started = time.monotonic()
+        config = settings.LLM_GATEWAY.get('HEDGING', {})
+        call_type = self.router.call_type(call_site)
+        site_config = settings.LLM_CALL_SITES.get(call_site, {})
+        celery_retry = site_config.get('celery_retry', False) # ワーカー内で待たず、Celery タスクの再投入に任せる
+        try:
+            self.governor.acquire(priority, estimated, site_config.get('max_wait'), defer=celery_retry)
+        except Exception as e:
+            tracing.record_llm_call(call_site, model, started, error=type(e).__name__)
+            raise
+        deadline = site_config.get('deadline') or config.get('DEADLINE_SECONDS', {}).get(call_type, 60)
+
+        hedge_delay = None
+        if config.get('ENABLED', True) and self._priority(call_site) == 'interactive' and site_config.get('hedge', True):
+            try:
+                p95 = self.router.p95(call_type)
+            except RedisError:
+                p95 = None
+            delay_ms = max(config.get('MIN_HEDGE_DELAY_MS', 500), p95 or config.get('DEFAULT_HEDGE_DELAY_MS', 3000))
+            hedge_delay = delay_ms / 1000
+        try:
+            response = self.hedger.call(
+                call_site, send, deadline, hedge_delay,
+                acquire=lambda max_wait: self.governor.acquire(priority, estimated, max_wait), # 再試行の前
+                try_acquire=lambda: self.governor.try_acquire(priority, estimated), # ヘッジの前（枠がなければヘッジしない）
+                max_retries=0 if celery_retry else None
+            )
+        except Exception as e:
+            tracing.record_llm_call(call_site, model, started, error=type(e).__name__)
+            raise
+        tracing.record_llm_call(call_site, model, started, response)
+        return response
+
+    def _priority(self, call_site):
+        return settings.LLM_CALL_SITES.get(call_site, {}).get('priority', 'interactive')
+
+    @staticmethod
+    def _total_tokens(response):
+        usage = getattr(response, 'usage', None)
+        total = getattr(usage, 'total_tokens', None)
+        return total if isinstance(total, int) else None
+
+    def _cache_key(self, call_site, model, messages, params):
+        if not self.cache.is_enabled_for(call_site, params):
+            return None
+        return self.cache.make_key(model, messages, params)
@@ -0,0 +1,100 @@
+import re
+import sys
+import hashlib
+import unicodedata
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError
+from redis.exceptions import RedisError
+from .backend import get_redis
+from .models import EmbeddingCacheEntry
+
+
+def normalize_text(text):
+    """全角・半角と空白の違いを吸収する（キャッシュキーにだけ使い、埋め込むのは元のテキスト）"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text or '')).strip()
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Embedding を DB に保存して全プロセスで使い回すキャッシュ
+
+    バッチ内の重複をまとめ、キャッシュにないテキストだけを 1 回の呼び出しで埋め込んでまとめて保存する。
+    """
+
+    STATS_KEY = 'embedding_cache:stats'  # 呼び出し箇所ごとのヒット/ミス/バッチ内重複の数 (hash)
+    LOOKUP_BATCH_SIZE = 500  # IN 句に並べるハッシュの数
+
+    def __init__(self):
+        self.enabled = settings.LLM_GATEWAY.get('EMBEDDING_CACHE_ENABLED', True)
+        self.redis = get_redis()
+
+    def embed(self, call_site, texts, model, dimensions, fetch):
+        """texts のベクトルを返す（fetch(キャッシュにないテキストのリスト) で足りない分だけ埋め込む）"""
+        if not self.enabled:
+            return fetch(texts)
+        hashes = [text_hash(text) for text in texts]
+        unique = {}
+        for key, text in zip(hashes, texts):
+            unique.setdefault(key, text)
+
+        try:
+            found = self._lookup(model, dimensions or 0, list(unique))
+        except DatabaseError as e: # DB が使えなくても API 呼び出しにフォールバックするだけ
+            print(f"[embedding cache] lookup error: {e}", file=sys.stderr)
+            found = {}
+        misses = [key for key in unique if key not in found]
+        if misses:
+            vectors = fetch([unique[key] for key in misses])
+            found.update(zip(misses, vectors))
+            self._store(model, dimensions or 0, misses, vectors)
+        self._record(call_site, hits=len(unique) - len(misses), misses=len(misses), duplicates=len(texts) - len(unique))
+        return [found[key] for key in hashes]
+
+    def _lookup(self, model, dimensions, keys):
+        found = {}
+        for i in range(0, len(keys), self.LOOKUP_BATCH_SIZE):
+            entries = EmbeddingCacheEntry.objects.filter(
+                model=model, dimensions=dimensions, text_hash__in=keys[i:i + self.LOOKUP_BATCH_SIZE]
+            ).values_list('text_hash', 'vector')
+            found.update((key, np.frombuffer(bytes(vector), dtype=np.float32).tolist()) for key, vector in entries)
+        return found
+
+    def _store(self, model, dimensions, keys, vectors):
+        try:
+            EmbeddingCacheEntry.objects.bulk_create([
+                EmbeddingCacheEntry(model=model, dimensions=dimensions, text_hash=key, vector=np.asarray(vector, dtype=np.float32).tobytes())
+                for key, vector in zip(keys, vectors)
+            ], batch_size=500, ignore_conflicts=True) # 同じテキストを別のプロセスが先に保存していてもよい
+        except DatabaseError as e:
+            print(f"[embedding cache] store error: {e}", file=sys.stderr)
+
+    def _record(self, call_site, **counts):
+        try:
+            pipe = self.redis.pipeline()
+            for kind, count in counts.items():
+                if count:
+                    pipe.hincrby(self.STATS_KEY, f'{call_site}:{kind}', count)
+            pipe.execute()
+        except RedisError:
+            pass
+
+    def stats(self):
+        """呼び出し箇所ごとのヒット/ミス数とヒット率（バッチ内の重複は API 呼び出しを減らした分として別に数える）"""
+        try:
+            raw = self.redis.hgetall(self.STATS_KEY)
+            entries = EmbeddingCacheEntry.objects.count()
+        except (RedisError, DatabaseError) as e:
+            return {'error': str(e)}
+
+        call_sites = {}
+        for field, count in raw.items():
+            call_site, kind = field.decode().rsplit(':', 1)
+            call_sites.setdefault(call_site, {'hits': 0, 'misses': 0, 'duplicates': 0})[kind] = int(count)
+        for counts in call_sites.values():
+            total = counts['hits'] + counts['misses'] + counts['duplicates']
+            counts['hit_rate'] = (counts['hits'] + counts['duplicates']) / total if total else 0.0
+        return {'entries': entries, 'call_sites': call_sites}
@@ -0,0 +1,235 @@
+import sys
+import time
+import uuid
+import random
+from django.conf import settings
+from redis.exceptions import RedisError
+from .backend import get_redis
+
+
+# RPM・TPM の 2 つのトークンバケットを原子的に補充・消費する
+# KEYS: rpm バケット, tpm バケット, 待機中の対話リクエスト (sorted set)
+# ARGV: 現在時刻, RPM 上限, TPM 上限, 必要トークン数, 予約率, バックグラウンドか (1/0)
+# 戻り値: {許可されたか (1/0), 待つべき秒数 (文字列)}
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rpm_cap = tonumber(ARGV[2])
+local tpm_cap = tonumber(ARGV[3])
+local need = math.min(tonumber(ARGV[4]), tpm_cap)
+local reserve = tonumber(ARGV[5])
+local is_background = ARGV[6] == '1'
+
+local function refill(key, cap)
+  local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(bucket[1]) or cap
+  local ts = tonumber(bucket[2]) or now
+  return math.min(cap, tokens + math.max(0, now - ts) * cap / 60)
+end
+
+local rpm = refill(KEYS[1], rpm_cap)
+local tpm = refill(KEYS[2], tpm_cap)
+
+local allowed = rpm - 1 >= rpm_cap * reserve and tpm - need >= tpm_cap * reserve
+if allowed and is_background then
+  redis.call('ZREMRANGEBYSCORE', KEYS[3], 0, now - 30)
+  allowed = redis.call('ZCARD', KEYS[3]) == 0
+end
+if allowed then
+  rpm = rpm - 1
+  tpm = tpm - need
+end
+
+redis.call('HSET', KEYS[1], 'tokens', rpm, 'ts', now)
+redis.call('HSET', KEYS[2], 'tokens', tpm, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+
+if allowed then
+  return {1, '0'}
+end
+local wait_rpm = (1 + rpm_cap * reserve - rpm) * 60 / rpm_cap
+local wait_tpm = (need + tpm_cap * reserve - tpm) * 60 / tpm_cap
+return {0, tostring(math.max(wait_rpm, wait_tpm, 0.05))}
+"""
+
+
+# 枠待ちで再投入するタスクの実行時刻を、前に予約されたタスクから interval 秒ずつずらして予約する
+# KEYS: 次に予約できる時刻
+# ARGV: 現在時刻, バケットが空くまでの秒数, 1 件あたりの間隔[秒]
+# 戻り値: 待つべき秒数 (文字列)
+DEFER_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = tonumber(ARGV[2])
+local interval = tonumber(ARGV[3])
+local at = math.max(now + wait, tonumber(redis.call('GET', KEYS[1])) or 0)
+redis.call('SET', KEYS[1], tostring(at + interval), 'EX', math.ceil(at + interval - now) + 60)
+return tostring(at - now)
+"""
+
+
+class LLMRateLimited(Exception):
+    """レート制御の枠が空いていない（待たずに返すので、呼び出し元は retry_after 秒後に再試行する）"""
+
+    def __init__(self, priority, retry_after):
+        super().__init__(f"{priority}: レート制御の枠が空いていません（{retry_after:.1f} 秒後に再試行）")
+        self.retry_after = retry_after
+
+
+class RateGovernor:
+    """Web プロセスと Celery ワーカーで共有する OpenAI のレート制御（RPM / TPM トークンバケット）
+
+    - interactive: インタビュー中の呼び出し。バケットを空になるまで使える
+    - background: 教材処理（ページ分析・Embedding など）。予約分を残し、対話リクエストが待っている間は譲る
+    """
+
+    RPM_KEY = 'llm_governor:rpm'
+    TPM_KEY = 'llm_governor:tpm'
+    WAITING_KEY = 'llm_governor:waiting:interactive'
+    USAGE_KEY = 'llm_governor:usage:{minute}'  # 分ごとの優先度別使用量 (hash)
+    DEFER_KEY = 'llm_governor:deferred:{priority}'  # 枠待ちで再投入したタスクに次に割り当てる時刻
+
+    def __init__(self):
+        config = settings.LLM_GATEWAY.get('RATE_LIMIT', {})
+        self.enabled = config.get('ENABLED', True)
+        self.rpm_limit = config.get('RPM', 500)
+        self.tpm_limit = config.get('TPM', 200000)
+        self.background_reserve = config.get('BACKGROUND_RESERVE', 0.2)
+        self.max_wait = config.get('MAX_WAIT_SECONDS', {'interactive': 30, 'background': 600})
+        self.redis = get_redis()
+        self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+        self.defer_script = self.redis.register_script(DEFER_SCRIPT)
+
+    def acquire(self, priority, tokens, max_wait=None, defer=False):
+        """リクエスト 1 件分と推定トークン数を確保できるまで待つ
+
+        最大待ち時間（max_wait 秒。省略時は MAX_WAIT_SECONDS の優先度ごとの値）を過ぎたら諦めて通す
+        （最終的なレート制限は OpenAI 側に任せる）。
+        defer=True なら待たずに LLMRateLimited を送出する（Celery タスクが countdown 付きで再投入し、待つ間ワーカーを空ける）。
+        retry_after は _defer_slot() で先に待っているタスクの後ろに並べた時刻までの秒数。
+        """
+        if not self.enabled:
+            return
+        is_background = priority == 'background'
+        max_wait = self.max_wait.get(priority, 30) if max_wait is None else max_wait
+        waiter_id = uuid.uuid4().hex
+        started = time.time()
+        try:
+            while True:
+                allowed, wait = self._take(priority, tokens)
+                if allowed:
+                    return
+                if defer:
+                    raise LLMRateLimited(priority, max(self._defer_slot(priority, tokens, wait), 1.0))
+                if time.time() - started > max_wait:
+                    print(f"[LLM governor] {priority}: {max_wait:.0f} 秒待っても枠が空かないため送信します", file=sys.stderr)
+                    return
+                if not is_background:
+                    self.redis.zadd(self.WAITING_KEY, {waiter_id: time.time()})
+                time.sleep(min(wait, 1.0) + random.uniform(0, 0.05))
+        except RedisError as e:
+            print(f"[LLM governor] acquire error: {e}", file=sys.stderr)
+        finally:
+            if not is_background:
+                try:
+                    self.redis.zrem(self.WAITING_KEY, waiter_id)
+                except RedisError:
+                    pass
+
+    def try_acquire(self, priority, tokens):
+        """待たずに枠を確保できれば True（ヘッジのような、送らなくてもよいリクエスト用）"""
+        if not self.enabled:
+            return True
+        try:
+            return self._take(priority, tokens)[0]
+        except RedisError as e:
+            print(f"[LLM governor] acquire error: {e}", file=sys.stderr)
+            return True
+
+    def _take(self, priority, tokens):
+        """バケットから 1 回だけ確保を試みる。戻り値: (確保できたか, 待つべき秒数)"""
+        is_background = priority == 'background'
+        allowed, wait = self.acquire_script(
+            keys=[self.RPM_KEY, self.TPM_KEY, self.WAITING_KEY],
+            args=[time.time(), self.rpm_limit, self.tpm_limit, tokens, self.background_reserve if is_background else 0.0, int(is_background)]
+        )
+        if allowed:
+            self._record_usage(priority, tokens)
+        return bool(allowed), float(wait)
+
+    def _defer_slot(self, priority, tokens, wait):
+        """枠待ちで再投入するタスクの実行までの秒数
+
+        同時に枠待ちになったタスクが同じ時刻に再開して再び枠待ちにならないよう、
+        バケットが 1 件分（tokens と 1 リクエスト）を補充する時間ずつずらして順に割り当てる。
+        """
+        interval = max(min(tokens, self.tpm_limit) * 60 / self.tpm_limit, 60 / self.rpm_limit)
+        return float(self.defer_script(keys=[self.DEFER_KEY.format(priority=priority)], args=[time.time(), wait, interval]))
+
+    def adjust(self, priority, estimated_tokens, actual_tokens):
+        """推定と実際の使用トークン数の差をバケットに反映する"""
+        if not self.enabled or actual_tokens is None:
+            return
+        delta = actual_tokens - estimated_tokens
+        key = self._usage_key()
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrbyfloat(self.TPM_KEY, 'tokens', -delta)
+            pipe.hincrby(key, f'{priority}:tokens', delta)
+            pipe.expire(key, 60 * 60) # 分の切り替わり直後はこの呼び出しで使用量のキーが作られることがある
+            pipe.execute()
+        except RedisError:
+            pass
+
+    def _record_usage(self, priority, tokens):
+        key = self._usage_key()
+        pipe = self.redis.pipeline()
+        pipe.hincrby(key, f'{priority}:requests', 1)
+        pipe.hincrby(key, f'{priority}:tokens', tokens)
+        pipe.expire(key, 60 * 60)
+        pipe.execute()
+
+    def _usage_key(self, minute=None):
+        return self.USAGE_KEY.format(minute=minute if minute is not None else int(time.time() // 60))
+
+    def stats(self):
+        """現在のバケット残量と直近の優先度別使用量（統計エンドポイント用）"""
+        try:
+            now = time.time()
+            levels = {}
+            for name, key, cap in (('rpm', self.RPM_KEY, self.rpm_limit), ('tpm', self.TPM_KEY, self.tpm_limit)):
+                tokens, ts = self.redis.hmget(key, 'tokens', 'ts')
+                if tokens is None:
+                    levels[name] = cap
+                else:
+                    levels[name] = min(cap, float(tokens) + max(0.0, now - float(ts)) * cap / 60)
+            current_minute = int(now // 60)
+            usage = {}
+            for minute in range(current_minute - 4, current_minute + 1):
+                for field, value in self.redis.hgetall(self._usage_key(minute)).items():
+                    priority, kind = field.decode().split(':')
+                    bucket = usage.setdefault(priority, {'requests': 0, 'tokens': 0})
+                    bucket[kind] += int(value)
+            return {
+                'limits': {'rpm': self.rpm_limit, 'tpm': self.tpm_limit},
+                'available': levels,
+                'waiting_interactive': self.redis.zcard(self.WAITING_KEY),
+                'usage_last_5_minutes': usage,
+            }
+        except RedisError as e:
+            return {'error': str(e)}
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """リクエストの消費トークン数を見積もる（OpenAI のレート制限は max_tokens 分も数える）"""
+    total = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            total += len(content)  # 日本語は概ね 1 文字 1 トークン以下なので多めの見積もりになる
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    total += len(part.get('text', ''))
+                elif part.get('type') == 'image_url':
+                    total += 1000
+    return total + (max_tokens or 1024)
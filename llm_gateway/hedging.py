@@ -0,0 +1,185 @@
+import sys
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+from redis.exceptions import RedisError
+from .backend import get_redis
+
+
+def transient_errors():
+    """再試行してよい一時的なエラー（openai の読み込みは重いので、最初の呼び出しまで遅らせる）"""
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    return (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+
+# ヘッジ用の重複リクエストもこのプールで実行する（プロセスごとに 1 つ）
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm-hedge')
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """締め切りまでに LLM の応答が得られなかった"""
+
+
+class RetryBudget:
+    """直近のリクエスト数に対する再試行の割合を制限する（上流の障害時に再試行の嵐を起こさない）"""
+
+    KEY = 'llm_retry_budget:{minute}'
+
+    def __init__(self):
+        config = settings.LLM_GATEWAY.get('RETRY_BUDGET', {})
+        self.ratio = config.get('RATIO', 0.1)
+        self.min_per_minute = config.get('MIN_PER_MINUTE', 10)
+        self.redis = get_redis()
+
+    def record_request(self):
+        self._incr('requests')
+
+    def try_spend(self):
+        """再試行してよければ予算を 1 つ消費して True を返す"""
+        try:
+            minute = int(time.time() // 60)
+            requests = retries = 0
+            for m in (minute - 1, minute):  # 分の切り替わり直後に予算が空にならないよう直近 2 分で見る
+                counts = self.redis.hgetall(self.KEY.format(minute=m))
+                requests += int(counts.get(b'requests', 0))
+                retries += int(counts.get(b'retries', 0))
+        except RedisError:
+            return True
+        if retries >= max(self.min_per_minute, requests * self.ratio):
+            return False
+        self._incr('retries')
+        return True
+
+    def stats(self):
+        minute = int(time.time() // 60)
+        counts = self.redis.hgetall(self.KEY.format(minute=minute))
+        return {key.decode(): int(value) for key, value in counts.items()}
+
+    def _incr(self, field):
+        key = self.KEY.format(minute=int(time.time() // 60))
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(key, field, 1)
+            pipe.expire(key, 180)
+            pipe.execute()
+        except RedisError:
+            pass
+
+
+class HedgedCaller:
+    """締め切り付きで LLM を呼び出す
+
+    - hedge_delay 秒（p95 を目安）を過ぎても応答がなければ、同じリクエストをもう 1 本送り、先に返った方を使う
+    - 一時的なエラーは、締め切りと再試行予算の範囲内でのみ再試行する
+    """
+
+    STATS_KEY = 'llm_hedge:stats'
+
+    def __init__(self):
+        config = settings.LLM_GATEWAY.get('HEDGING', {})
+        self.max_retries = config.get('MAX_RETRIES', 2)
+        self.budget = RetryBudget()
+        self.redis = get_redis()
+
+    def call(self, call_site, send, deadline, hedge_delay=None, acquire=None, try_acquire=None, max_retries=None):
+        """send(timeout) を呼び出して結果を返す。hedge_delay が None ならヘッジしない
+
+        最初のリクエストのレート制御の枠は呼び出し元が確保しておく。
+        acquire(max_wait): 再試行の前に、残りの締め切りまで枠を待つ。
+        try_acquire(): ヘッジの前に、待たずに枠を確保できれば True（できなければヘッジしない）。
+        max_retries: 省略時は HEDGING['MAX_RETRIES']（Celery タスク側で再試行する呼び出しは 0）。
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            self.budget.record_request()
+            remaining = deadline - (time.monotonic() - started)
+            try:
+                return self._hedged(call_site, send, remaining, hedge_delay, try_acquire)
+            except transient_errors() as e:
+                attempt += 1
+                backoff = min(2 ** attempt * 0.25, 2.0) * random.uniform(0.5, 1.0)
+                remaining = deadline - (time.monotonic() - started)
+                if attempt > max_retries or remaining <= backoff:
+                    raise
+                if not self.budget.try_spend():
+                    print(f"[LLM hedge] {call_site}: 再試行予算が尽きたため再試行しません ({e})", file=sys.stderr)
+                    raise
+                print(f"[LLM hedge] {call_site}: {type(e).__name__} のため再試行 ({attempt}/{max_retries})", file=sys.stderr)
+                time.sleep(backoff)
+                if acquire is not None: # 枠を待った結果締め切りを過ぎていれば、_hedged が送信せずに LLMDeadlineExceeded にする
+                    acquire(max(0.0, deadline - (time.monotonic() - started)))
+
+    def _hedged(self, call_site, send, remaining, hedge_delay, try_acquire=None):
+        if remaining <= 0:
+            raise LLMDeadlineExceeded(f"{call_site}: 締め切りを過ぎました")
+        started = time.monotonic()
+        primary = _executor.submit(send, remaining)
+        pending = {primary}
+        hedge = None
+        last_error = None
+        self._incr(call_site, 'requests')
+
+        while pending:
+            elapsed = time.monotonic() - started
+            if elapsed >= remaining:
+                break
+            timeout = remaining - elapsed
+            if hedge is None and hedge_delay is not None:
+                timeout = min(timeout, max(0.0, hedge_delay - elapsed))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._record_hedge_win(call_site, primary, started)
+                    return future.result()
+                last_error = future.exception()
+
+            elapsed = time.monotonic() - started
+            if hedge is None and hedge_delay is not None and primary in pending and elapsed >= hedge_delay:
+                if try_acquire is not None and not try_acquire():
+                    hedge_delay = None # レート制御の枠が空いていなければヘッジせず、元のリクエストだけを待つ
+                    self._incr(call_site, 'hedge_skipped')
+                    continue
+                hedge = _executor.submit(send, remaining - elapsed)
+                pending.add(hedge)
+                self._incr(call_site, 'hedged')
+
+        if last_error is not None and not pending:
+            raise last_error
+        raise LLMDeadlineExceeded(f"{call_site}: {remaining:.1f} 秒以内に応答がありませんでした")
+
+    def _record_hedge_win(self, call_site, primary, started):
+        """ヘッジが勝った回数と、元のリクエストが返るまで待った場合との差（短縮できた時間）を記録する"""
+        hedge_done = time.monotonic()
+        self._incr(call_site, 'hedge_wins')
+
+        def on_primary_done(future):
+            saved_ms = int((time.monotonic() - hedge_done) * 1000)
+            self._incr(call_site, 'saved_ms', saved_ms)
+
+        primary.add_done_callback(on_primary_done)
+
+    def _incr(self, call_site, field, amount=1):
+        try:
+            self.redis.hincrby(self.STATS_KEY, f'{call_site}:{field}', amount)
+        except RedisError:
+            pass
+
+    def stats(self):
+        """呼び出し箇所ごとのヘッジ発動率・勝率・短縮時間（統計エンドポイント用）"""
+        try:
+            raw = self.redis.hgetall(self.STATS_KEY)
+            retry_budget = self.budget.stats()
+        except RedisError as e:
+            return {'error': str(e)}
+        call_sites = {}
+        for field, value in raw.items():
+            call_site, kind = field.decode().rsplit(':', 1)
+            call_sites.setdefault(call_site, {'requests': 0, 'hedged': 0, 'hedge_skipped': 0, 'hedge_wins': 0, 'saved_ms': 0})[kind] = int(value)
+        for counts in call_sites.values():
+            counts['hedge_rate'] = counts['hedged'] / counts['requests'] if counts['requests'] else 0.0
+            counts['win_rate'] = counts['hedge_wins'] / counts['hedged'] if counts['hedged'] else 0.0
+        return {'call_sites': call_sites, 'retry_budget_this_minute': retry_budget}
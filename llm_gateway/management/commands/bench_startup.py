@@ -0,0 +1,67 @@
+import sys
+import json
+import statistics
+import subprocess
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 起動時に読み込まれては困る重いライブラリ（使う処理の中で読み込む）
+HEAVY_MODULES = ['torch', 'sentence_transformers', 'chromadb', 'fitz', 'openai', 'tiktoken', 'websockets']
+
+# エントリポイントごとに、起動時に実行される import
+ENTRY_POINTS = {
+    'manage': "import django; django.setup()",
+    'web': "import learning_interview.wsgi; import learning_interview.urls",
+    'worker': "from learning_interview.celery import app; app.loader.import_default_modules(); import knowledge_tree.services",
+}
+
+# 新しいプロセスで import の時間と最大 RSS、読み込まれた重いライブラリを測る
+PROBE = """
+import os, sys, json, time, resource
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', {settings_module!r})
+started = time.perf_counter()
+{statement}
+elapsed = (time.perf_counter() - started) * 1000
+try:  # ru_maxrss は fork 元の値を引き継ぐことがあるので、Linux では現在の RSS を読む
+    with open('/proc/self/status') as status:
+        rss_kb = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+except (OSError, StopIteration):
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    'import_ms': elapsed,
+    'rss_mb': rss_kb / 1024,
+    'heavy': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = "エントリポイント（manage / web / worker）ごとの起動時の import 時間と RSS を測る"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entry', action='append', choices=list(ENTRY_POINTS), help="測るエントリポイント（省略時はすべて）")
+        parser.add_argument('--repeat', type=int, default=3, help="エントリポイントごとの試行回数（中央値を表示）")
+        parser.add_argument('--check', action='store_true', help="重いライブラリが起動時に読み込まれていれば失敗する")
+
+    def handle(self, *args, **options):
+        entries = options['entry'] or list(ENTRY_POINTS)
+        failures = []
+        self.stdout.write(f"{'entry':<8} {'import[ms]':>11} {'rss[MB]':>9}  heavy modules")
+        for entry in entries:
+            runs = [self._probe(ENTRY_POINTS[entry]) for _ in range(max(1, options['repeat']))]
+            import_ms = statistics.median(run['import_ms'] for run in runs)
+            rss_mb = statistics.median(run['rss_mb'] for run in runs)
+            heavy = sorted({name for run in runs for name in run['heavy']})
+            self.stdout.write(f"{entry:<8} {import_ms:>11.0f} {rss_mb:>9.1f}  {', '.join(heavy) or '-'}")
+            if heavy:
+                failures.append(f"{entry}: {', '.join(heavy)}")
+
+        if options['check'] and failures:
+            raise CommandError("起動時に重いライブラリが読み込まれています: " + "; ".join(failures))
+
+    def _probe(self, statement):
+        code = PROBE.format(settings_module=settings.SETTINGS_MODULE, statement=statement, heavy=HEAVY_MODULES)
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=settings.BASE_DIR)
+        if result.returncode != 0:
+            raise CommandError(f"起動に失敗しました:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
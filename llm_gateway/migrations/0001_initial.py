@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-19 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, verbose_name='モデル')),
+                ('dimensions', models.IntegerField(default=0, verbose_name='次元数')),
+                ('text_hash', models.CharField(max_length=64, verbose_name='テキストのハッシュ')),
+                ('vector', models.BinaryField(verbose_name='ベクトル')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Embedding キャッシュ',
+                'verbose_name_plural': 'Embedding キャッシュ',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='embeddingcacheentry',
+            constraint=models.UniqueConstraint(fields=('model', 'dimensions', 'text_hash'), name='unique_embedding_cache_entry'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import models
+
+
+class EmbeddingCacheEntry(models.Model):
+    """Embedding のキャッシュ（モデル・次元数・正規化したテキストのハッシュごとに 1 件）"""
+    model = models.CharField(max_length=100, verbose_name="モデル")
+    dimensions = models.IntegerField(default=0, verbose_name="次元数")  # 0 はモデルの既定の次元数
+    text_hash = models.CharField(max_length=64, verbose_name="テキストのハッシュ")
+    vector = models.BinaryField(verbose_name="ベクトル")  # float32 のバイト列
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Embedding キャッシュ"
+        verbose_name_plural = "Embedding キャッシュ"
+        constraints = [
+            models.UniqueConstraint(fields=['model', 'dimensions', 'text_hash'], name='unique_embedding_cache_entry'),
+        ]
+
+    def __str__(self):
+        return f"{self.model}/{self.dimensions}: {self.text_hash[:12]}"
@@ -0,0 +1,107 @@
+import sys
+from django.conf import settings
+from .tokens import count_tokens
+
+TRUNCATION_MARK = "…（省略）"
+
+
+class PromptBuilder:
+    """プロンプトの各セクションにトークン予算を割り当てて組み立てる
+
+    - 各セクションはまず自分の予算に収まるよう切り詰める
+    - それでも全体の予算を超えるときは priority の低いセクションから削る
+    - テキストのリストを渡すと、要素単位（履歴の 1 往復、チャンク 1 つなど）で落としてから文字単位で切る
+    予算は settings.PROMPT_BUDGETS[call_site] の値が既定で、section() の引数で上書きできる。
+    """
+
+    def __init__(self, call_site, total_budget=None, model='gpt-4o'):
+        self.call_site = call_site
+        self.model = model
+        self.budgets = settings.PROMPT_BUDGETS.get(call_site, {})
+        self.total_budget = total_budget or self.budgets.get('total')
+        self.sections = {}
+
+    def section(self, name, content, budget=None, priority=0, keep='head', separator="\n"):
+        """セクションを追加する
+
+        content: 文字列、または文字列のリスト（separator で連結する）
+        priority: 全体の予算を超えたとき、値の小さいセクションから削る
+        keep: 'head' なら先頭を残し、'tail' なら末尾（直近の履歴など）を残す
+        """
+        items = content if isinstance(content, list) else [content or ""]
+        self.sections[name] = {
+            'items': [item for item in items if item],
+            'budget': budget or self.budgets.get(name),
+            'priority': priority,
+            'keep': keep,
+            'separator': separator,
+        }
+        return self
+
+    def build(self):
+        """{セクション名: 予算内に収めたテキスト} を返し、各セクションのトークン数を記録する"""
+        texts, tokens, original = {}, {}, {}
+        for name, section in self.sections.items():
+            text = section['separator'].join(section['items'])
+            original[name] = count_tokens(text, self.model)
+            texts[name] = self._fit(section, section['budget'])
+            tokens[name] = count_tokens(texts[name], self.model)
+
+        if self.total_budget:
+            overflow = sum(tokens.values()) - self.total_budget
+            for name in sorted(self.sections, key=lambda n: self.sections[n]['priority']):
+                if overflow <= 0:
+                    break
+                budget = max(0, tokens[name] - overflow)
+                texts[name] = self._fit(self.sections[name], budget)
+                overflow -= tokens[name] - count_tokens(texts[name], self.model)
+                tokens[name] = count_tokens(texts[name], self.model)
+
+        detail = ", ".join(
+            f"{name}={tokens[name]}" + (f"/{original[name]}" if tokens[name] < original[name] else "")
+            for name in self.sections
+        )
+        print(f"[prompt] {self.call_site}: {sum(tokens.values())} tokens ({detail})", file=sys.stderr)
+        return texts
+
+    def _fit(self, section, budget):
+        items, keep, separator = list(section['items']), section['keep'], section['separator']
+        text = separator.join(items)
+        if budget is None or count_tokens(text, self.model) <= budget:
+            return text
+        # 省略記号の分を差し引いた予算に収める
+        budget -= count_tokens(separator + TRUNCATION_MARK, self.model)
+        if budget <= 0:
+            return ""
+
+        # 要素単位で落とす（keep の側から収まる分だけ残す。最低 1 要素は残して文字単位で切る）
+        ordered = items[::-1] if keep == 'tail' else items
+        separator_tokens = count_tokens(separator, self.model)
+        kept, used = [], 0
+        for item in ordered:
+            used += count_tokens(item, self.model) + (separator_tokens if kept else 0)
+            if kept and used > budget:
+                break
+            kept.append(item)
+        text = separator.join(kept[::-1] if keep == 'tail' else kept)
+
+        # 残った要素も収まらなければ文字単位で切る
+        if count_tokens(text, self.model) > budget:
+            text = self._truncate(text, budget, keep)
+        return f"{TRUNCATION_MARK}{separator}{text}" if keep == 'tail' else f"{text}{separator}{TRUNCATION_MARK}"
+
+    def _truncate(self, text, budget, keep):
+        """budget トークン以内になるよう二分探索で切り詰める"""
+        if budget <= 0:
+            return ""
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            candidate = text[-middle:] if keep == 'tail' else text[:middle]
+            if count_tokens(candidate, self.model) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        if low == 0:
+            return ""
+        return text[-low:] if keep == 'tail' else text[:low]
@@ -0,0 +1,140 @@
+import sys
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from redis.exceptions import RedisError
+from .backend import get_redis
+
+
+class ModelRouter:
+    """呼び出しタイプ（route / evaluate / generate / correct / vision）ごとにモデルを選ぶ
+
+    - 既定は各タイプの高速モデル。出力が不十分なら escalate_to のモデルで再実行する
+    - 実行中リクエスト数や p95 レイテンシが閾値を超えたら、1 段安いモデルに自動で切り替える
+    """
+
+    IN_FLIGHT_KEY = 'llm_router:in_flight'  # リクエストID -> 開始時刻 (sorted set)
+    LATENCY_KEY = 'llm_router:latency:{call_type}'  # 直近のレイテンシ[ms] (list)
+    IN_FLIGHT_STALE_SECONDS = 120  # 異常終了したプロセスの分を数え続けないように
+
+    def __init__(self):
+        self.routes = settings.LLM_ROUTES
+        self.tiers = settings.LLM_MODEL_TIERS
+        self.load_config = settings.LLM_GATEWAY.get('LOAD_DOWNGRADE', {})
+        self.redis = get_redis()
+
+    def call_type(self, call_site):
+        return settings.LLM_CALL_SITES.get(call_site, {}).get('type', 'generate')
+
+    def select(self, call_site):
+        """呼び出し箇所に使うモデルを返す"""
+        call_type = self.call_type(call_site)
+        model = self.routes[call_type]['model']
+        if not settings.LLM_CALL_SITES.get(call_site, {}).get('downgrade', True):
+            return model
+        reason = self._overload_reason(call_type)
+        if reason:
+            cheaper = self._cheaper_tier(model)
+            if cheaper:
+                print(f"[LLM router] {call_site}: {reason}ため {model} -> {cheaper}", file=sys.stderr)
+                return cheaper
+        return model
+
+    def escalation_model(self, call_site, model):
+        """出力が不十分だったときに再実行するモデル（なければ None）"""
+        escalate_to = self.routes[self.call_type(call_site)].get('escalate_to')
+        if escalate_to and escalate_to != model:
+            return escalate_to
+        return None
+
+    def _cheaper_tier(self, model):
+        if model not in self.tiers:
+            return None
+        index = self.tiers.index(model)
+        return self.tiers[index + 1] if index + 1 < len(self.tiers) else None
+
+    def _overload_reason(self, call_type):
+        max_in_flight = self.load_config.get('MAX_IN_FLIGHT')
+        max_p95 = self.load_config.get('P95_LATENCY_MS')
+        try:
+            if max_in_flight and self.in_flight() > max_in_flight:
+                return f"実行中リクエスト数が {max_in_flight} を超えた"
+            p95 = self.p95(call_type)
+            if max_p95 and p95 is not None and p95 > max_p95:
+                return f"p95 レイテンシ {p95:.0f}ms が {max_p95}ms を超えた"
+        except RedisError as e:
+            print(f"[LLM router] load check error: {e}", file=sys.stderr)
+        return None
+
+    @contextmanager
+    def track(self, call_type):
+        """API 呼び出しを実行中リクエストとして数え、終了時にレイテンシを記録する"""
+        request_id = uuid.uuid4().hex
+        started = time.time()
+        try:
+            self.redis.zadd(self.IN_FLIGHT_KEY, {request_id: started})
+        except RedisError:
+            pass
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.time() - started) * 1000
+            key = self.LATENCY_KEY.format(call_type=call_type)
+            try:
+                pipe = self.redis.pipeline()
+                pipe.zrem(self.IN_FLIGHT_KEY, request_id)
+                pipe.lpush(key, elapsed_ms)
+                pipe.ltrim(key, 0, self.load_config.get('LATENCY_WINDOW', 200) - 1)
+                pipe.execute()
+            except RedisError:
+                pass
+
+    def in_flight(self):
+        self.redis.zremrangebyscore(self.IN_FLIGHT_KEY, 0, time.time() - self.IN_FLIGHT_STALE_SECONDS)
+        return self.redis.zcard(self.IN_FLIGHT_KEY)
+
+    def p95(self, call_type):
+        samples = sorted(float(v) for v in self.redis.lrange(self.LATENCY_KEY.format(call_type=call_type), 0, -1))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def stats(self):
+        """現在の負荷状況（統計エンドポイント用）"""
+        try:
+            return {
+                'in_flight': self.in_flight(),
+                'p95_latency_ms': {call_type: self.p95(call_type) for call_type in self.routes},
+                'thresholds': self.load_config,
+            }
+        except RedisError as e:
+            return {'error': str(e)}
+
+
+def json_validator(*required_keys, allowed=None):
+    """JSON 応答の検証関数を作る
+
+    解析できない・必須キーがない・想定外の値・confidence が閾値未満のいずれかなら False を返す。
+    """
+    min_confidence = settings.LLM_GATEWAY.get('ESCALATION_MIN_CONFIDENCE', 0.6)
+
+    def validate(content):
+        try:
+            data = json.loads(content)
+        except (TypeError, ValueError):
+            return False
+        if not isinstance(data, dict) or any(key not in data for key in required_keys):
+            return False
+        for key, values in (allowed or {}).items():
+            if data.get(key) not in values:
+                return False
+        if 'confidence' in data:
+            try:
+                return float(data['confidence']) >= min_confidence
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    return validate
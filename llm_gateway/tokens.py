@@ -0,0 +1,32 @@
+_encodings = {}  # モデル名 -> tiktoken のエンコーディング（tiktoken がなければ None）
+
+
+def _encoding(model):
+    """model のエンコーディング（tiktoken の読み込みは重いので、起動時ではなく最初に数えるときに読み込む）"""
+    if model not in _encodings:
+        try:
+            import tiktoken
+        except ImportError:  # tiktoken がなければ文字数から見積もる
+            _encodings[model] = None
+            return None
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('o200k_base')
+    return _encodings[model]
+
+
+def count_tokens(text, model='gpt-4o'):
+    """テキストのトークン数（tiktoken がない環境では概算）"""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def estimate_tokens(text):
+    """概算: 日本語などの非 ASCII 文字は 1 文字 1 トークン、ASCII は 4 文字 1 トークン"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
@@ -0,0 +1,115 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+# 現在処理中のトレース（リクエストごと）
+_current_trace = contextvars.ContextVar('llm_trace', default=None)
+
+
+class Trace:
+    """1 回の処理（インタビューの 1 ターンなど）のスパンを集める"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.spans = []
+        self._stack = []  # 実行中のスパンの index（入れ子の親を辿るため）
+
+    def _offset_ms(self, at=None):
+        return round(((at or time.monotonic()) - self.started) * 1000, 1)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """処理フェーズのスパン（入れ子可）"""
+        started = time.monotonic()
+        index = len(self.spans)
+        self.spans.append({
+            'name': name,
+            'kind': 'phase',
+            'parent': self._stack[-1] if self._stack else None,
+            'start_ms': self._offset_ms(started),
+            'duration_ms': None,
+            **attrs,
+        })
+        self._stack.append(index)
+        try:
+            yield self.spans[index]
+        finally:
+            self._stack.pop()
+            self.spans[index]['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+
+    def record_llm_call(self, call_site, model, started, **attrs):
+        """LLM 呼び出し 1 回分のスパン（started は time.monotonic() の値）"""
+        self.spans.append({
+            'name': call_site,
+            'kind': 'llm',
+            'parent': self._stack[-1] if self._stack else None,
+            'start_ms': self._offset_ms(started),
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+            'model': model,
+            **attrs,
+        })
+
+    @property
+    def total_ms(self):
+        return self._offset_ms()
+
+    def phase_durations(self):
+        """フェーズ名ごとの合計時間[ms]（同じフェーズが複数回あれば足し合わせる）"""
+        durations = {}
+        for span in self.spans:
+            if span['kind'] == 'phase' and span['duration_ms'] is not None:
+                durations[span['name']] = round(durations.get(span['name'], 0) + span['duration_ms'], 1)
+        return durations
+
+    def llm_totals(self):
+        calls = [span for span in self.spans if span['kind'] == 'llm']
+        return {
+            'llm_calls': len(calls),
+            'prompt_tokens': sum(span.get('prompt_tokens') or 0 for span in calls),
+            'completion_tokens': sum(span.get('completion_tokens') or 0 for span in calls),
+        }
+
+
+@contextmanager
+def start_trace(name):
+    """トレースを開始し、with ブロック内の span() と LLM 呼び出しを記録する"""
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """現在のトレースにフェーズのスパンを追加する（トレース中でなければ何もしない）"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attrs) as current:
+        yield current
+
+
+def record_llm_call(call_site, model, started, response=None, **attrs):
+    """現在のトレースに LLM 呼び出しを記録する（トレース中でなければ何もしない）"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    usage = getattr(response, 'usage', None)
+    trace.record_llm_call(
+        call_site, model, started,
+        prompt_tokens=getattr(usage, 'prompt_tokens', None),
+        completion_tokens=getattr(usage, 'completion_tokens', None),
+        **attrs
+    )
+
+
+def percentile(samples, q):
+    """samples の q パーセンタイル（最近傍法）。空なら None"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
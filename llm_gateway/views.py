@@ -0,0 +1,21 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from .cache import LLMResponseCache
+from .embedding_cache import EmbeddingCache
+from .governor import RateGovernor
+from .hedging import HedgedCaller
+from .routing import ModelRouter
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def gateway_stats(request):
+    """LLM ゲートウェイの統計情報（キャッシュのヒット率・負荷状況・レート制御の使用量・ヘッジの効果など）を返す"""
+    return Response({
+        'cache': LLMResponseCache().stats(),
+        'embedding_cache': EmbeddingCache().stats(),
+        'router': ModelRouter().stats(),
+        'rate_limit': RateGovernor().stats(),
+        'hedging': HedgedCaller().stats(),
+    })
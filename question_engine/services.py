@@ -1,7 +1,12 @@
 import json
-from openai import OpenAI
 from django.conf import settings
+from llm_gateway.client import LLMClient
+from llm_gateway.prompting import PromptBuilder
+from llm_gateway.routing import json_validator
 from knowledge_tree.models import KnowledgeNode, DocumentChunk
+from knowledge_tree.question_pool import QuestionPool
+from knowledge_tree.rubric import RubricScorer
+from knowledge_tree.retrieval import ContextRetriever
 from interview_session.models import Question, Answer, InterviewSession
 
 
@@ -9,11 +14,18 @@ class SocraticQuestionGenerator:
     """ソクラテス式質問生成器"""
     
     def __init__(self):
-        self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.llm = LLMClient()
+        self.question_pool = QuestionPool(self.llm)
+        self.retriever = ContextRetriever(self.llm)
         
     def generate_question(self, node, session, depth_level=1, previous_answers=None):
         """指定されたノードに対してソクラテス式質問を生成"""
         try:
+            # 事前生成した質問があればそれを使う
+            question = self._pooled_question(node, session, depth_level, previous_answers)
+            if question:
+                return question
+
             # コンテキストを構築
             context = self._build_context(node, session, previous_answers)
             
@@ -24,8 +36,8 @@ class SocraticQuestionGenerator:
             prompt = self._build_prompt(node, context, question_type, depth_level)
             
             # LLMで質問を生成
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
+            response = self.llm.chat(
+                'socratic_question',
                 messages=[
                     {"role": "system", "content": self._get_system_prompt()},
                     {"role": "user", "content": prompt}
@@ -34,7 +46,7 @@ class SocraticQuestionGenerator:
                 max_tokens=300
             )
             
-            question_content = response.choices[0].message.content.strip()
+            question_content = response.strip()
             
             # 質問をデータベースに保存
             question = Question.objects.create(
@@ -52,6 +64,25 @@ class SocraticQuestionGenerator:
             print(f"Question generation error: {e}")
             return None
     
+    def _pooled_question(self, node, session, depth_level, previous_answers):
+        """質問プールから未出題の質問を取り出して保存する（深掘りレベル 1~3 をソクラテス段階とみなす）"""
+        asked_questions = list(Question.objects.filter(session=session, node=node).values_list('content', flat=True))
+        content = self.question_pool.pick(node, depth_level, False, asked_questions)
+        if not content:
+            return None
+        last_history = None
+        if previous_answers:
+            last_answer = previous_answers[-1] # 古い順に渡される
+            last_history = {'question': last_answer.question.content, 'answer': last_answer.content}
+        return Question.objects.create(
+            session=session,
+            node=node,
+            content=self.question_pool.personalize(content, last_history),
+            question_type=self._determine_question_type(depth_level, previous_answers),
+            depth_level=depth_level,
+            context_chunks=[]
+        )
+    
     def _build_context(self, node, session, previous_answers):
         """質問生成のためのコンテキストを構築"""
         context = {
@@ -64,12 +95,13 @@ class SocraticQuestionGenerator:
             'previous_answers': []
         }
         
-        # 関連チャンクを取得
-        chunks = node.chunks.all()[:3]  # 最大3チャンク
+        # 関連チャンクのうち、ノードと直前の回答に近いものをトークン予算内で取得
+        last_answer = previous_answers[-1].content if previous_answers else None
+        chunks = self.retriever.select(node, last_answer)
         context['chunks'] = [
             {
                 'content': chunk.content,
-                'page_number': chunk.page_number
+                'page_number': chunk.page_label
             }
             for chunk in chunks
         ]
@@ -113,13 +145,14 @@ class SocraticQuestionGenerator:
         
         # チャンク情報を追加
         for chunk in context['chunks']:
-            base_prompt += f"\n- ページ{chunk['page_number']}: {chunk['content'][:200]}..."
+            base_prompt += f"\n- ページ{chunk['page_number']}: {chunk['content']}"
         
-        # 過去の回答情報を追加
+        # 過去の回答情報を追加（直近のやり取りを優先して予算内に収める）
         if context['previous_answers']:
-            base_prompt += "\n\n過去の質問と回答:"
-            for qa in context['previous_answers']:
-                base_prompt += f"\nQ: {qa['question']}\nA: {qa['answer'][:100]}..."
+            history = PromptBuilder('socratic_question').section(
+                'history', [f"Q: {qa['question']}\nA: {qa['answer'][:100]}..." for qa in context['previous_answers']], keep='tail'
+            ).build()['history']
+            base_prompt += "\n\n過去の質問と回答:\n" + history
         
         # 質問タイプ別の指示を追加
         type_instructions = {
@@ -155,8 +188,23 @@ class SocraticQuestionGenerator:
 class AnswerEvaluator:
     """回答評価器"""
     
+    # 採点基準による事前採点で判定がついた場合の評価結果
+    PRESCORED_EVALUATIONS = {
+        'pass': {
+            'score': 0.8,
+            'needs_deeper_questioning': False,
+            'feedback': '要点を押さえた回答です。',
+        },
+        'fail': {
+            'score': 0.1,
+            'needs_deeper_questioning': True,
+            'feedback': '回答が短いか、トピックとの関連が見られません。',
+        },
+    }
+    
     def __init__(self):
-        self.openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.llm = LLMClient()
+        self.rubric_scorer = RubricScorer(self.llm)
     
     def evaluate_answer(self, answer):
         """回答を評価して理解度スコアと次のアクションを決定"""
@@ -164,22 +212,28 @@ class AnswerEvaluator:
             question = answer.question
             node = question.node
             
-            # 評価プロンプトを構築
-            prompt = self._build_evaluation_prompt(question, answer, node)
-            
-            # LLMで評価
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": self._get_evaluation_system_prompt()},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1
-            )
-            
-            # 評価結果を解析
-            evaluation_text = response.choices[0].message.content
-            evaluation = self._parse_evaluation(evaluation_text)
+            # 採点基準で明らかな合格・不合格なら LLM の評価を省略
+            verdict, detail = self.rubric_scorer.prescore(node, answer.content, question.depth_level)
+            if verdict:
+                evaluation = dict(self.PRESCORED_EVALUATIONS[verdict], strengths=detail.get('covered_terms', []), improvements=[])
+            else:
+                # 評価プロンプトを構築
+                prompt = self._build_evaluation_prompt(question, answer, node)
+                
+                # LLMで評価
+                evaluation_text = self.llm.chat(
+                    'legacy_evaluate_answer',
+                    messages=[
+                        {"role": "system", "content": self._get_evaluation_system_prompt()},
+                        {"role": "user", "content": prompt}
+                    ],
+                    response_format={"type": "json_object"},
+                    temperature=0.1,
+                    validator=json_validator('score', 'needs_deeper_questioning')
+                )
+                
+                # 評価結果を解析
+                evaluation = self._parse_evaluation(evaluation_text)
             
             # 回答を更新
             answer.understanding_score = evaluation['score']
@@ -201,17 +255,20 @@ class AnswerEvaluator:
     
     def _build_evaluation_prompt(self, question, answer, node):
         """評価プロンプトを構築"""
+        sections = PromptBuilder('legacy_evaluate_answer').section(
+            'description', node.description, priority=1
+        ).section('question', question.content, priority=2).section('answer', answer.content).build()
         return f"""
         以下の質問に対する学習者の回答を評価してください。
 
         トピック: {node.title}
-        トピック説明: {node.description}
+        トピック説明: {sections['description']}
         
-        質問: {question.content}
+        質問: {sections['question']}
         質問タイプ: {question.get_question_type_display()}
         深掘りレベル: {question.depth_level}
         
-        学習者の回答: {answer.content}
+        学習者の回答: {sections['answer']}
         
         以下の形式でJSONとして評価結果を返してください:
         {{
@@ -49,6 +49,7 @@ document.addEventListener("DOMContentLoaded", () => {
         explanationInput.value = newValue;
         
         autoResize(explanationInput);
+        postExplanationSegment(text.trim()); // 確定した区間をサーバーに送り、説明の途中から解析を進めておく
         
         // ★★★ テキストが追加されたら、両方のボタンの状態を更新 ★★★
         updateCorrectButtonState();
@@ -220,6 +221,19 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // --- ▼▼▼ 確定した文字起こしの区間を送信（応答は待たない。失敗しても説明の保存には影響しない） ▼▼▼ ---
+  function postExplanationSegment(text) {
+    const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value || '';
+    fetch(`/api/interview/sessions/${window.sessionId}/explanation_segments/`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-CSRFToken': csrfToken
+      },
+      body: JSON.stringify({ 'content': text })
+    }).catch((error) => console.warn("説明の区間の送信に失敗しました:", error));
+  }
+
   // --- ▼▼▼ 「説明保存」＆「フェーズ移行」 (あなたのフローチャートAPIを呼ぶ) ▼▼▼ ---
   async function saveExplanationAndProceed() {
     